@@ -0,0 +1,539 @@
+"""
+基准/压测工具：在进程内用伪造的Elasticsearch回放请求流，统计各接口的延迟分位数、吞吐和内存峰值
+
+用法:
+    python benchmark.py                                  # 内置场景，覆盖所有主要接口
+    python benchmark.py --requests traffic.jsonl         # 回放录制的请求流
+    python benchmark.py --es-latency-ms 20 --buckets 50  # 调整伪造ES的延迟和返回大小
+    python benchmark.py --save baseline.json             # 保存结果作为基线
+    python benchmark.py --baseline baseline.json         # 与基线对比，p95退化超过阈值时退出码为1
+    python benchmark.py --es-replay es_recordings.jsonl.gz  # 用录制的ES响应代替伪造ES
+
+请求流文件为JSONL，每行一个请求: {"method": "POST", "path": "/generate-dsl", "json": {...}}
+不依赖真实ES和LLM(使用离线LLM替身)，可在本地或无CI环境运行，用于发现提示词生成、JSON提取、结果处理的性能退化。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+try:
+    import psutil
+except ImportError:  # 没有psutil时退化为进程级的峰值RSS
+    psutil = None
+
+# 基准默认关闭各级缓存和后台刷新，让每个请求都走完整处理路径；必须在导入main之前设置
+BENCH_ENV_DEFAULTS = {
+    "LOG_LEVEL": "WARNING",
+    "LLM_PROVIDER": "stub",
+    "FIXED_NOW": "2025-06-16T04:00:00Z",
+    "RESULT_CACHE_ENABLED": "false",
+    "DSL_CACHE_ENABLED": "false",
+    "SINGLEFLIGHT_ENABLED": "false",
+}
+CACHE_ENV_KEYS = ("RESULT_CACHE_ENABLED", "DSL_CACHE_ENABLED", "SINGLEFLIGHT_ENABLED")
+
+FAKE_INDICES = [
+    "apm-7.17.0-transaction-000001",
+    "apm-7.17.0-error-000001",
+    "apm-7.17.0-span-000001",
+    "apm-7.17.0-metric-000001",
+]
+FAKE_PROPERTIES = {
+    "@timestamp": {"type": "date"},
+    "service": {"properties": {"name": {"type": "keyword"}, "environment": {"type": "keyword"}}},
+    "host": {"properties": {"name": {"type": "keyword"}}},
+    "event": {"properties": {"outcome": {"type": "keyword"}}},
+    "http": {"properties": {"response": {"properties": {"status_code": {"type": "long"}}}}},
+    "labels": {"properties": {"region": {"type": "keyword"}}},
+}
+FAKE_EVENT_PROPERTIES = {
+    "transaction": {"transaction": {"properties": {
+        "name": {"type": "keyword"}, "type": {"type": "keyword"},
+        "duration": {"properties": {"us": {"type": "long"}}}}}},
+    "error": {"error": {"properties": {
+        "exception": {"properties": {"type": {"type": "keyword"},
+                                     "message": {"type": "text", "fields": {"keyword": {"type": "keyword"}}}}},
+        "grouping_key": {"type": "keyword"}}}},
+    "span": {"span": {"properties": {"name": {"type": "keyword"}, "type": {"type": "keyword"},
+                                     "duration": {"properties": {"us": {"type": "long"}}}}}},
+    "metric": {"system": {"properties": {"cpu": {"properties": {"total": {"properties": {
+        "norm": {"properties": {"pct": {"type": "scaled_float"}}}}}}}}}},
+}
+
+
+class FakeResponse:
+    """模拟elasticsearch-py的ObjectApiResponse，只提供body"""
+
+    def __init__(self, body: Any):
+        self.body = body
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.body.get(key, default)
+
+
+class FakeNamespace:
+    """indices / cat 命名空间，把调用转发给FakeElasticsearch"""
+
+    def __init__(self, es: "FakeElasticsearch", handlers: Dict[str, Any]):
+        self._es = es
+        self._handlers = handlers
+
+    def __getattr__(self, name: str):
+        handler = self._handlers[name]
+
+        async def call(**kwargs):
+            await self._es.delay()
+            return FakeResponse(handler(**kwargs))
+        return call
+
+
+class FakeElasticsearch:
+    """进程内的ES替身：按DSL的聚合结构生成结果，可配置延迟和返回的桶数/文档数/文档大小"""
+
+    def __init__(self, latency_ms: float = 5.0, jitter_ms: float = 2.0, buckets: int = 10, hits: int = 10,
+                 doc_bytes: int = 512, fixture: Optional[Dict[str, Any]] = None, seed: int = 42):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.buckets = buckets
+        self.hits = hits
+        self.doc_bytes = doc_bytes
+        self.fixture = fixture  # 录制的固定search响应，设置后所有search都返回它
+        self.random = random.Random(seed)
+        self.now_ms = int(datetime.fromisoformat(
+            os.environ["FIXED_NOW"].replace("Z", "+00:00")).timestamp() * 1000)
+        self.calls: Dict[str, int] = {}
+        self.indices = FakeNamespace(self, {
+            "get_mapping": self._get_mapping,
+            "get_alias": lambda **_: {name: {"aliases": {}} for name in FAKE_INDICES},
+            "get_data_stream": lambda **_: {"data_streams": []},
+        })
+        self.cat = FakeNamespace(self, {"indices": self._cat_indices})
+
+    def options(self, **_: Any) -> "FakeElasticsearch":
+        return self
+
+    async def delay(self):
+        latency = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms))
+        await asyncio.sleep(latency / 1000)
+
+    def count_call(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    async def info(self, **_: Any) -> FakeResponse:
+        self.count_call("info")
+        await self.delay()
+        return FakeResponse({"cluster_name": "benchmark", "version": {"number": "7.17.0"}})
+
+    async def search(self, index: str = "", body: Optional[Dict[str, Any]] = None, **kwargs: Any) -> FakeResponse:
+        self.count_call("search")
+        await self.delay()
+        if self.fixture is not None:
+            return FakeResponse(self.fixture)
+        if body is None:
+            body = {k: kwargs[k] for k in ("query", "aggs", "aggregations", "size", "sort") if k in kwargs}
+        return FakeResponse(self.build_search_response(body))
+
+    async def msearch(self, searches: List[Dict[str, Any]], **_: Any) -> FakeResponse:
+        self.count_call("msearch")
+        await self.delay()
+        bodies = searches[1::2]
+        responses = [{**(self.fixture or self.build_search_response(body)), "status": 200} for body in bodies]
+        return FakeResponse({"took": 1, "responses": responses})
+
+    async def close(self):
+        pass
+
+    def build_search_response(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        size = body.get("size", 10)
+        response = {
+            "took": self.random.randint(1, 50),
+            "timed_out": False,
+            "_shards": {"total": len(FAKE_INDICES), "successful": len(FAKE_INDICES), "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": 10000, "relation": "gte"},
+                "max_score": None,
+                "hits": [self.build_hit(i) for i in range(min(size if isinstance(size, int) else 10, self.hits))]
+            }
+        }
+        aggs = body.get("aggs") or body.get("aggregations")
+        if isinstance(aggs, dict):
+            response["aggregations"] = self.build_aggs(aggs)
+        return response
+
+    def build_hit(self, i: int) -> Dict[str, Any]:
+        return {
+            "_index": FAKE_INDICES[i % len(FAKE_INDICES)],
+            "_id": f"doc-{i}",
+            "_score": None,
+            "_source": {
+                "@timestamp": datetime.utcfromtimestamp((self.now_ms - i * 1000) / 1000).isoformat() + "Z",
+                "service": {"name": f"service-{i % 7}"},
+                "transaction": {"name": f"GET /api/v1/resource/{i}", "duration": {"us": self.random.randint(1000, 900000)}},
+                "message": "x" * self.doc_bytes
+            }
+        }
+
+    def build_aggs(self, aggs: Dict[str, Any]) -> Dict[str, Any]:
+        return {name: self.build_agg(spec) for name, spec in aggs.items() if isinstance(spec, dict)}
+
+    def build_agg(self, spec: Dict[str, Any]) -> Dict[str, Any]:
+        sub_aggs = spec.get("aggs") or spec.get("aggregations") or {}
+        agg_type = next((k for k in spec if k not in ("aggs", "aggregations", "meta")), "")
+        params = spec.get(agg_type) or {}
+        field = params.get("field", "") if isinstance(params, dict) else ""
+
+        def bucket(key: Any, doc_count: int) -> Dict[str, Any]:
+            return {"key": key, "doc_count": doc_count, **self.build_aggs(sub_aggs)}
+
+        if agg_type in ("terms", "significant_terms", "rare_terms", "multi_terms"):
+            count = min(params.get("size", 10), self.buckets)
+            keys = FAKE_INDICES if field == "_index" else [f"{field or 'key'}-{i}" for i in range(count)]
+            return {"doc_count_error_upper_bound": 0, "sum_other_doc_count": 0,
+                    "buckets": [bucket(key, 1000 - i) for i, key in enumerate(keys[:count])]}
+        if agg_type == "composite":
+            buckets = [bucket({"key": f"key-{i}"}, 1000 - i) for i in range(min(params.get("size", 10), self.buckets))]
+            return {"after_key": buckets[-1]["key"] if buckets else None, "buckets": buckets}
+        if agg_type in ("date_histogram", "histogram", "auto_date_histogram"):
+            buckets = []
+            for i in range(self.buckets):
+                key = self.now_ms - (self.buckets - i) * 60000
+                buckets.append({"key_as_string": datetime.utcfromtimestamp(key / 1000).isoformat() + "Z",
+                                **bucket(key, self.random.randint(0, 1000))})
+            return {"buckets": buckets}
+        if agg_type in ("range", "date_range"):
+            return {"buckets": [bucket(f"range-{i}", 100) for i in range(len(params.get("ranges", [])))]}
+        if agg_type in ("filter", "global", "missing", "nested", "reverse_nested"):
+            return {"doc_count": 1000, **self.build_aggs(sub_aggs)}
+        if agg_type == "filters":
+            filters = params.get("filters", {})
+            names = filters if isinstance(filters, dict) else range(len(filters))
+            return {"buckets": {str(name): {"doc_count": 100, **self.build_aggs(sub_aggs)} for name in names}}
+        if agg_type in ("min", "max") and field == "@timestamp":
+            value = self.now_ms - 86400000 if agg_type == "min" else self.now_ms
+            return {"value": value, "value_as_string": datetime.utcfromtimestamp(value / 1000).isoformat() + "Z"}
+        if agg_type in ("percentiles", "percentile_ranks"):
+            percents = params.get("percents", [1, 5, 25, 50, 75, 95, 99])
+            return {"values": {str(float(p)): self.random.uniform(1000, 900000) for p in percents}}
+        if agg_type in ("stats", "extended_stats"):
+            values = sorted(self.random.uniform(1000, 900000) for _ in range(2))
+            return {"count": 1000, "min": values[0], "max": values[1], "avg": sum(values) / 2, "sum": sum(values) * 500}
+        if agg_type == "top_hits":
+            hits = [self.build_hit(i) for i in range(min(params.get("size", 3), self.hits))]
+            return {"hits": {"total": {"value": len(hits), "relation": "eq"}, "hits": hits}}
+        if agg_type in ("cardinality", "value_count"):
+            return {"value": self.random.randint(1, 5000)}
+        return {"value": self.random.uniform(1000, 900000)}
+
+    def _get_mapping(self, **_: Any) -> Dict[str, Any]:
+        mappings = {}
+        for name in FAKE_INDICES:
+            event_type = name.split("-")[2]
+            mappings[name] = {"mappings": {"properties": {**FAKE_PROPERTIES, **FAKE_EVENT_PROPERTIES[event_type]}}}
+        return mappings
+
+    def _cat_indices(self, **_: Any) -> List[Dict[str, Any]]:
+        return [{"index": name, "health": "green", "status": "open", "docs.count": "100000",
+                 "store.size": "104857600"} for name in FAKE_INDICES]
+
+
+BROKEN_MARKDOWN = """好的，下面是查询：
+```json
+{
+  'size': 0，
+  "query": {"bool": {"filter": [{"range": {"@timestamp": {"gte": "now-1h", "lte": "now"}}},]}},
+  "aggs": {"services": {"terms": {"field": "service.name", "size": 10, "order": {"avg_duration": "desc"}},
+           "aggs": {"avg_duration": {"avg": {"field": "transaction.duration.us"}}}}},
+  "track_total_hits": True,
+```"""
+
+SLOW_DSL = {
+    "size": 0,
+    "query": {"bool": {"filter": [{"range": {"@timestamp": {"gte": "now-1h", "lte": "now"}}}]}},
+    "aggs": {"services": {"terms": {"field": "service.name", "size": 20, "order": {"avg_duration": "desc"}},
+                          "aggs": {"avg_duration": {"avg": {"field": "transaction.duration.us"}},
+                                   "p95": {"percentiles": {"field": "transaction.duration.us", "percents": [95, 99]}}}}}
+}
+ERROR_DSL = {
+    "size": 5,
+    "query": {"bool": {"filter": [{"range": {"@timestamp": {"gte": "now-24h", "lte": "now"}}},
+                                  {"exists": {"field": "error.exception.type"}}]}},
+    "aggs": {"error_types": {"terms": {"field": "error.exception.type", "size": 10},
+                             "aggs": {"services": {"terms": {"field": "service.name", "size": 5}}}}}
+}
+TREND_DSL = {
+    "size": 0,
+    "query": {"bool": {"filter": [{"range": {"@timestamp": {"gte": "now-6h", "lte": "now"}}}]}},
+    "aggs": {"per_minute": {"date_histogram": {"field": "@timestamp", "fixed_interval": "5m"},
+                            "aggs": {"by_service": {"terms": {"field": "service.name", "size": 5}}}}}
+}
+
+# 内置场景：接口 → 轮流发送的请求体
+DEFAULT_SCENARIOS: List[Dict[str, Any]] = [
+    {"method": "GET", "path": "/health"},
+    {"method": "POST", "path": "/analyze-time-context", "bodies": [
+        {"query": "最近一小时哪个服务最慢", "timezone": "Asia/Shanghai"},
+        {"query": "昨天的错误有多少", "timezone": "Asia/Shanghai"},
+    ]},
+    {"method": "POST", "path": "/extract-time-range", "bodies": [
+        {"query": "过去三天 checkout-service 的错误趋势"},
+        {"query": "2025-06-01 到 2025-06-07 的流量", "timezone": "Asia/Shanghai"},
+        {"query": "上周的慢接口"},
+    ]},
+    {"method": "POST", "path": "/process-time-analysis", "bodies": [
+        {"content": '```json\n{"time_range": "24h", "reasoning": "用户关注昨天", "confidence": "high"}\n```'},
+        {"content": "分析结果：{'time_range': '1h'，'reasoning': '最近', 'confidence': 'medium',}"},
+    ]},
+    {"method": "POST", "path": "/generate-dsl", "bodies": [
+        {"query": "最近一小时哪个服务最慢", "time_range": "1h", "timezone": "Asia/Shanghai"},
+        {"query": "service-3 的错误类型分布", "time_range": "24h", "compare": "day_ago"},
+        {"query": "各服务的请求量", "start_time": "2025-06-10", "end_time": "2025-06-12"},
+    ]},
+    {"method": "POST", "path": "/clean-dsl", "bodies": [
+        {"content": BROKEN_MARKDOWN},
+        {"content": "```json\n" + json.dumps(SLOW_DSL) + "\n```"},
+    ]},
+    {"method": "POST", "path": "/execute-query", "bodies": [
+        {"dsl": SLOW_DSL, "original_query": "最近一小时哪个服务最慢"},
+        {"dsl": ERROR_DSL, "original_query": "昨天的错误类型", "format": "detailed"},
+        {"dsl": TREND_DSL, "original_query": "最近6小时各服务流量趋势"},
+        {"content": BROKEN_MARKDOWN, "original_query": "最近一小时哪个服务最慢"},
+    ]},
+    {"method": "POST", "path": "/execute-queries", "bodies": [
+        {"queries": [{"dsl": SLOW_DSL, "original_query": "慢服务"},
+                     {"dsl": ERROR_DSL, "original_query": "错误类型"},
+                     {"dsl": TREND_DSL, "original_query": "流量趋势"}]},
+    ]},
+    {"method": "POST", "path": "/pipeline", "bodies": [
+        {"query": "最近一小时哪个服务最慢", "timezone": "Asia/Shanghai"},
+        {"query": "最近有哪些错误"},
+        {"query": "今天各服务的流量", "analyze": True},
+    ]},
+]
+
+
+def load_request_stream(path: str) -> List[Dict[str, Any]]:
+    """读取录制的JSONL请求流，按 (method, path) 分组为场景，保持原始顺序"""
+    scenarios: Dict[tuple, Dict[str, Any]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if not isinstance(record, dict) or not str(record.get("path", "")).startswith("/"):
+                print(f"跳过第{line_no}行：缺少path字段", file=sys.stderr)
+                continue
+            method = record.get("method", "POST").upper()
+            scenario = scenarios.setdefault((method, record["path"]),
+                                            {"method": method, "path": record["path"], "bodies": []})
+            body = record.get("json", record.get("body"))
+            if body is not None:
+                scenario["bodies"].append(body)
+    return list(scenarios.values())
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """最近秩法求分位数"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def current_rss() -> int:
+    """当前进程RSS(字节)；没有psutil时返回进程生命周期内的峰值"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+async def sample_peak_rss(state: Dict[str, int], interval: float = 0.01):
+    """后台采样RSS，记录峰值"""
+    while True:
+        state["peak"] = max(state["peak"], current_rss())
+        await asyncio.sleep(interval)
+
+
+def is_failed_response(status_code: int, payload: Any) -> bool:
+    """HTTP错误，或接口以execution_success=false报告的查询失败"""
+    if status_code >= 400:
+        return True
+    if isinstance(payload, dict):
+        execution = payload.get("execution", payload)
+        return isinstance(execution, dict) and execution.get("execution_success") is False
+    return False
+
+
+async def run_scenario(client, scenario: Dict[str, Any], requests: int, concurrency: int,
+                       warmup: int) -> Dict[str, Any]:
+    """以固定并发发送requests个请求，请求体轮流使用"""
+    bodies = scenario.get("bodies") or [None]
+    latencies: List[float] = []
+    errors: List[str] = []
+
+    async def send(i: int):
+        body = bodies[i % len(bodies)]
+        start = time.perf_counter()
+        response = await client.request(scenario["method"], scenario["path"], json=body)
+        elapsed = time.perf_counter() - start
+        payload = response.json() if "json" in response.headers.get("content-type", "") else None
+        failed = is_failed_response(response.status_code, payload)
+        if failed and len(errors) < 3:
+            errors.append(f"{response.status_code}: {response.text[:200]}")
+        return elapsed, failed
+
+    for i in range(warmup):
+        await send(i)
+    counter = iter(range(warmup, warmup + requests))
+    failures = 0
+
+    async def worker():
+        nonlocal failures
+        for i in counter:
+            elapsed, failed = await send(i)
+            latencies.append(elapsed)
+            failures += failed
+
+    rss = {"peak": current_rss()}
+    sampler = asyncio.create_task(sample_peak_rss(rss))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    wall = time.perf_counter() - start
+    sampler.cancel()
+    rss["peak"] = max(rss["peak"], current_rss())
+
+    latencies.sort()
+    return {
+        "endpoint": f"{scenario['method']} {scenario['path']}",
+        "requests": len(latencies),
+        "errors": failures,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "rps": round(len(latencies) / wall, 1) if wall > 0 else 0.0,
+        "peak_rss_mb": round(rss["peak"] / 1024 / 1024, 1),
+        "sample_errors": errors,
+    }
+
+
+def print_report(results: List[Dict[str, Any]]):
+    header = f"{'endpoint':<30}{'reqs':>7}{'errs':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'rps':>9}{'rss(MB)':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['endpoint']:<30}{r['requests']:>7}{r['errors']:>6}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+              f"{r['p99_ms']:>10.2f}{r['rps']:>9.1f}{r['peak_rss_mb']:>9.1f}")
+        for error in r["sample_errors"]:
+            print(f"    ! {error}")
+
+
+def compare_with_baseline(results: List[Dict[str, Any]], baseline_path: str, max_regression: float) -> List[str]:
+    """对比基线的p95延迟和吞吐，返回超过阈值的退化描述"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {r["endpoint"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        base = baseline.get(r["endpoint"])
+        if not base:
+            continue
+        if base["p95_ms"] > 0 and r["p95_ms"] > base["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{r['endpoint']} p95 {base['p95_ms']:.2f}ms → {r['p95_ms']:.2f}ms")
+        if base["rps"] > 0 and r["rps"] < base["rps"] * (1 - max_regression):
+            regressions.append(f"{r['endpoint']} rps {base['rps']:.1f} → {r['rps']:.1f}")
+        if r["errors"] > base.get("errors", 0):
+            regressions.append(f"{r['endpoint']} 错误数 {base.get('errors', 0)} → {r['errors']}")
+    return regressions
+
+
+async def run_benchmark(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    import httpx
+    import main
+
+    fixture = None
+    if args.es_fixture:
+        with open(args.es_fixture, "r", encoding="utf-8") as f:
+            fixture = json.load(f)
+    fake_es = FakeElasticsearch(latency_ms=args.es_latency_ms, jitter_ms=args.es_jitter_ms, buckets=args.buckets,
+                                hits=args.hits, doc_bytes=args.doc_bytes, fixture=fixture)
+    if not args.es_replay:  # 回放模式下main已把es_client换成读取录制文件的客户端
+        main.es_client = fake_es
+    # 用伪造的映射和采样走一遍真实的刷新逻辑，让模式校验、索引裁剪和字段取值注入参与基准
+    await main.refresh_field_index_map()
+    await main.refresh_index_catalog()
+    await main.refresh_top_values()
+
+    scenarios = load_request_stream(args.requests) if args.requests else DEFAULT_SCENARIOS
+    if args.endpoint:
+        scenarios = [s for s in scenarios if any(s["path"].startswith(e) for e in args.endpoint)]
+
+    results = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=60) as client:
+        for scenario in scenarios:
+            results.append(await run_scenario(client, scenario, args.requests_per_endpoint,
+                                              args.concurrency, args.warmup))
+    if args.es_replay:
+        stats = main.es_record_store.stats
+        print(f"ES回放: 命中 {stats['replayed']} 次, 未录制 {stats['misses']} 次", file=sys.stderr)
+    else:
+        print(f"伪造ES调用次数: {fake_es.calls}", file=sys.stderr)
+    return results
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="APM Text2DSL 基准测试（进程内伪造ES）")
+    parser.add_argument("--requests", help="录制的请求流(JSONL)，为空时使用内置场景")
+    parser.add_argument("--endpoint", action="append", help="只测试指定路径前缀，可重复")
+    parser.add_argument("-n", "--requests-per-endpoint", type=int, default=200, help="每个接口的请求数")
+    parser.add_argument("-c", "--concurrency", type=int, default=10, help="每个接口的并发数")
+    parser.add_argument("--warmup", type=int, default=5, help="每个接口不计入统计的预热请求数")
+    parser.add_argument("--es-latency-ms", type=float, default=5.0, help="伪造ES的平均延迟")
+    parser.add_argument("--es-jitter-ms", type=float, default=2.0, help="伪造ES延迟的随机抖动")
+    parser.add_argument("--buckets", type=int, default=10, help="每个桶聚合最多返回的桶数")
+    parser.add_argument("--hits", type=int, default=10, help="最多返回的文档数")
+    parser.add_argument("--doc-bytes", type=int, default=512, help="每个文档的填充字节数")
+    parser.add_argument("--es-fixture", help="录制的ES search响应(JSON)，所有查询都返回它")
+    parser.add_argument("--es-replay", help="ES录制文件(ES_RECORD_MODE=record生成)，回放录制的响应代替伪造ES")
+    parser.add_argument("--with-cache", action="store_true", help="保留结果缓存/DSL缓存/并发合并的默认配置")
+    parser.add_argument("--save", help="把结果保存为JSON，可作为基线")
+    parser.add_argument("--baseline", help="对比的基线JSON")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="允许的p95/吞吐退化比例")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    for key, value in BENCH_ENV_DEFAULTS.items():
+        if args.with_cache and key in CACHE_ENV_KEYS:
+            continue
+        os.environ.setdefault(key, value)
+    if args.es_replay:
+        os.environ["ES_RECORD_MODE"] = "replay"
+        os.environ["ES_RECORD_FILE"] = args.es_replay
+
+    results = asyncio.run(run_benchmark(args))
+    print_report(results)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"created_at": datetime.now().isoformat(), "args": vars(args), "results": results},
+                      f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.max_regression)
+        for line in regressions:
+            print(f"退化: {line}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,10 @@
+# gunicorn配置(镜像启动命令通过 --config 加载)
+import os
+
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    """worker退出时标记其Prometheus指标文件已失效，livesum等Gauge不再计入该进程"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
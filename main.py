@@ -1,20 +1,221 @@
-from fastapi import FastAPI, HTTPException
+import time
+
+IMPORT_STARTED = time.perf_counter()  # 统计模块导入耗时(含依赖)
+
+from fastapi import APIRouter, FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
-from elasticsearch import Elasticsearch
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional, Dict, Any, List, AsyncIterator
 from datetime import datetime, timedelta
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import asyncio
+import contextvars
+import copy
+import difflib
+import fnmatch
+import functools
+import gzip
+import hashlib
+import logging
+import random
+import unicodedata
 import json
 import re
 import os
+import pytz
+import uuid
 
-app = FastAPI(title="APM Text2DSL API", version="1.0.0")
+# 路由在模块导入时注册，应用实例由 create_app() 创建
+router = APIRouter()
 
 # 配置
 ES_HOST = "http://192.168.48.128:9200"  # 修改为你的ES地址
 
 # 初始化ES客户端 - 支持环境变量配置
 ES_URL = os.getenv("ES_HOST", ES_HOST)
-es_client = Elasticsearch([ES_URL], verify_certs=False)
+
+# ES连接池与并发配置
+ES_MAX_CONNECTIONS = int(os.getenv("ES_MAX_CONNECTIONS", "20"))  # 每个节点的连接池大小
+ES_MAX_CONCURRENT_QUERIES = int(os.getenv("ES_MAX_CONCURRENT_QUERIES", "16"))  # 同时执行的ES查询上限
+ES_QUEUE_TIMEOUT = float(os.getenv("ES_QUEUE_TIMEOUT", "10"))  # 等待并发槽位的最长时间(秒)
+ES_DEFAULT_QUERY_TIMEOUT = float(os.getenv("ES_DEFAULT_QUERY_TIMEOUT", "30"))  # 默认查询超时(秒)
+ES_MAX_QUERY_TIMEOUT = float(os.getenv("ES_MAX_QUERY_TIMEOUT", "60"))  # 单次请求允许的最大超时(秒)
+ES_MSEARCH_MAX_ITEMS = int(os.getenv("ES_MSEARCH_MAX_ITEMS", "20"))  # 批量查询单次最多包含的DSL数
+ES_CLIENT_TIMEOUT_MARGIN = 5  # 客户端等待时间在ES搜索超时之外留出的余量(秒)
+
+
+
+def create_es_client():
+    """创建异步ES客户端，所有请求共享同一个连接池，不阻塞事件循环"""
+    from elasticsearch import AsyncElasticsearch  # 导入较慢，首次使用时才导入
+
+    return AsyncElasticsearch(
+        [ES_URL],
+        verify_certs=False,
+        connections_per_node=ES_MAX_CONNECTIONS,
+        request_timeout=ES_MAX_QUERY_TIMEOUT
+    )
+
+
+class LazyESClient:
+    """首次调用时才创建ES客户端和连接池：导入模块、启动应用都不依赖ES可达，
+    多进程部署时连接池在各worker进程内创建，不会在fork前共享"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+
+    @property
+    def created(self) -> bool:
+        return self._client is not None
+
+    def get(self):
+        if self._client is None:
+            self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
+
+    async def close(self):
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.close()
+
+
+es_client = LazyESClient(create_es_client)
+
+# 限制同时发往ES的查询数量，避免慢聚合把集群压垮
+es_query_semaphore = asyncio.Semaphore(ES_MAX_CONCURRENT_QUERIES)
+
+# 查询结果缓存配置
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "512"))  # 本地LRU最大条目数
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "60"))  # 缓存有效期(秒)
+RESULT_CACHE_TIME_GRANULARITY = int(os.getenv("RESULT_CACHE_TIME_GRANULARITY", "60"))  # 时间范围对齐粒度(秒)
+RESULT_CACHE_BACKEND = os.getenv("RESULT_CACHE_BACKEND", "local")  # local / memory / redis
+RESULT_CACHE_REDIS_URL = os.getenv("RESULT_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+
+# 日志配置
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json / text
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))  # 记录完整DSL/响应的请求比例
+LOG_PAYLOAD_MAX_BYTES = int(os.getenv("LOG_PAYLOAD_MAX_BYTES", "2048"))  # 单条日志中payload的最大字节数
+
+# 当前请求的关联ID，以及该请求是否被采样记录payload
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+payload_sampled_var: contextvars.ContextVar[bool] = contextvars.ContextVar("payload_sampled", default=False)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """输出单行JSON日志，附带请求关联ID和结构化字段"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": request_id_var.get(),
+            "event": record.getMessage()
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextLogFormatter(logging.Formatter):
+    """本地调试用的文本日志格式"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(f"{k}={v}" for k, v in getattr(record, "fields", {}).items())
+        line = f"{self.formatTime(record)} {record.levelname} [{request_id_var.get()}] {record.getMessage()}"
+        return f"{line} {fields}" if fields else line
+
+
+def setup_logging() -> logging.Logger:
+    """初始化服务日志"""
+    service_logger = logging.getLogger("text2dsl")
+    service_logger.setLevel(LOG_LEVEL)
+    if not service_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else TextLogFormatter())
+        service_logger.addHandler(handler)
+    service_logger.propagate = False
+    return service_logger
+
+
+logger = setup_logging()
+
+
+def log_event(level: int, event: str, **fields: Any):
+    """记录结构化日志事件，未开启的级别不做任何格式化"""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={"fields": fields})
+
+
+def cap_payload(payload: Any, max_bytes: int = LOG_PAYLOAD_MAX_BYTES) -> str:
+    """序列化payload并截断到指定字节数"""
+    text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False, default=str,
+                                                              separators=(",", ":"))
+    encoded = text.encode("utf-8")
+    if len(encoded) <= max_bytes:
+        return text
+    return encoded[:max_bytes].decode("utf-8", errors="ignore") + f"...(共{len(encoded)}字节)"
+
+
+def log_payload(event: str, payload: Any, **fields: Any):
+    """仅对被采样的请求（或DEBUG级别）记录payload，避免每次都序列化大响应"""
+    if payload_sampled_var.get() or logger.isEnabledFor(logging.DEBUG):
+        log_event(logging.INFO, event, payload=cap_payload(payload), **fields)
+
+
+# Prometheus指标；多worker部署时各进程把指标写入该目录，/metrics汇总所有worker(须在启动前创建并清空)
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "text2dsl_http_request_duration_seconds", "HTTP请求耗时", ["endpoint", "method", "status"],
+    buckets=LATENCY_BUCKETS
+)
+HTTP_RESPONSE_SIZE = Histogram(
+    "text2dsl_http_response_size_bytes", "HTTP响应体大小", ["endpoint"], buckets=SIZE_BUCKETS
+)
+HTTP_IN_FLIGHT = Gauge("text2dsl_http_in_flight_requests", "正在处理的请求数", ["endpoint"],
+                       multiprocess_mode="livesum")
+STAGE_DURATION = Histogram(
+    "text2dsl_stage_duration_seconds", "处理流程各阶段耗时", ["stage"], buckets=LATENCY_BUCKETS
+)
+ES_TOOK = Histogram("text2dsl_es_took_seconds", "ES返回的took耗时", buckets=LATENCY_BUCKETS)
+ES_WALL = Histogram("text2dsl_es_wall_seconds", "ES查询往返耗时(含网络和排队)", buckets=LATENCY_BUCKETS)
+ERRORS = Counter("text2dsl_errors_total", "按类别统计的错误数", ["category"])
+JSON_REPAIRS = Counter("text2dsl_json_repairs_total", "从LLM输出提取JSON时的修复次数", ["repair"])
+
+# 已注册的路由路径，用作指标的endpoint标签（首次请求时收集）
+ROUTE_PATHS: set = set()
+
+
+def endpoint_label(path: str) -> str:
+    """未注册的路径统一归类为other，避免指标标签基数失控"""
+    if not ROUTE_PATHS:
+        ROUTE_PATHS.update(route.path for route in router.routes if hasattr(route, "path"))
+    return path if path in ROUTE_PATHS else "other"
+
+
+@contextmanager
+def observe_stage(stage: str):
+    """记录一个处理阶段的耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.labels(stage).observe(time.perf_counter() - start)
 
 
 # 请求响应模型
@@ -23,6 +224,10 @@ class QueryRequest(BaseModel):
     time_range: Optional[str] = "15m"  # 恢复默认值，也可以传入LLM分析的结果
     language: Optional[str] = "auto"
     timezone: Optional[str] = "UTC"
+    prompt_version: Optional[str] = None  # 提示词模板版本，为空时使用默认版本
+    start_time: Optional[str] = None  # 绝对开始时间(ISO格式)，设置后优先于time_range
+    end_time: Optional[str] = None  # 绝对结束时间，为空时为当前时间
+    compare: Optional[str] = None  # 对比时间范围: previous_period/day_ago/week_ago
 
 
 class DSLRequest(BaseModel):
@@ -31,6 +236,13 @@ class DSLRequest(BaseModel):
     content: Optional[str] = None  # 支持Markdown格式的DSL
     original_query: str
     format: Optional[str] = "summary"
+    timeout: Optional[float] = None  # 查询超时(秒)，为空时使用默认值
+    bypass_cache: Optional[bool] = False  # 为True时跳过结果缓存，强制查询ES
+    analysis_max_bytes: Optional[int] = None  # 分析提示词字节预算，为空时使用默认值
+    optimize: Optional[bool] = True  # 执行前是否自动优化DSL
+    caller: Optional[str] = None  # 调用方标识，用于选择成本预算
+    stream: Optional[str] = None  # 流式返回格式：ndjson / sse，为空时一次性返回JSON
+    compare: Optional[str] = None  # 生成该DSL时/generate-dsl请求的compare，用于查询→DSL缓存的键
 
     def get_query_body(self) -> Dict[Any, Any]:
         """获取查询体，支持多种输入格式"""
@@ -51,6 +263,8 @@ class PromptResponse(BaseModel):
     query_type: str
     time_range_info: str
     schema_info: Dict[str, Any]
+    comparison_time_range_info: Optional[str] = None
+    cached_dsl: Optional[Dict[str, Any]] = None  # 相同问题已验证过的DSL(已替换为当前时间窗口)，有值时可跳过LLM
 
 
 class ExecuteResponse(BaseModel):
@@ -59,6 +273,50 @@ class ExecuteResponse(BaseModel):
     query_executed_at: str
     execution_success: bool
     error_message: Optional[str] = None
+    cache_hit: bool = False
+    truncation_report: Optional[Dict[str, Any]] = None  # 分析提示词中结果的裁剪情况
+    optimizations: Optional[List[str]] = None  # 执行前对DSL所做的优化改写
+    cost_estimate: Optional[Dict[str, Any]] = None  # 查询成本估算及准入决策
+    validation_issues: Optional[List[Dict[str, Any]]] = None  # 模式校验发现的问题(机器可读)
+
+
+class BatchDSLRequest(BaseModel):
+    queries: List[DSLRequest]
+    timeout: Optional[float] = None  # 整个批量查询的超时(秒)
+    bypass_cache: Optional[bool] = False
+
+
+class BatchExecuteResponse(BaseModel):
+    results: List[ExecuteResponse]
+    total: int
+    succeeded: int
+    failed: int
+    query_executed_at: str
+
+
+class PipelineRequest(BaseModel):
+    query: str
+    time_range: Optional[str] = None  # 为空时先用规则提取，置信度不足再由LLM分析
+    timezone: Optional[str] = "UTC"
+    language: Optional[str] = "auto"
+    prompt_version: Optional[str] = None
+    timeout: Optional[float] = None
+    bypass_cache: Optional[bool] = False
+    caller: Optional[str] = None
+    analyze: Optional[bool] = False  # 是否调用LLM生成最终分析结论
+
+
+class PipelineResponse(BaseModel):
+    original_query: str
+    query_type: str
+    time_range: str
+    time_range_info: str
+    time_analysis: Optional[Dict[str, Any]] = None
+    dsl: Optional[Dict[str, Any]] = None
+    dsl_cache_hit: bool = False  # DSL来自查询→DSL缓存，未调用LLM生成
+    execution: ExecuteResponse
+    answer: Optional[str] = None
+    stage_timings: Dict[str, float]
 
 
 class MarkdownRequest(BaseModel):
@@ -68,17 +326,23 @@ class MarkdownRequest(BaseModel):
 class CleanResponse(BaseModel):
     cleaned_dsl: Dict[Any, Any]
     original_content: str
+    repairs: List[str] = []  # 提取JSON时做过的修复
 
 
 class TimeContextRequest(BaseModel):
     query: str
     timezone: Optional[str] = "UTC"
+    prompt_version: Optional[str] = None
 
 
 class TimeContextResponse(BaseModel):
     prompt: str  # 返回给LLM的提示词
     query_type: str
     original_query: str
+    detected_time_range: Optional[str] = None  # 规则识别出的时间范围
+    confidence: str = "low"  # 规则识别的置信度 high/medium/low
+    reasoning: Optional[str] = None
+    needs_llm: bool = True  # 为False时可直接使用detected_time_range，跳过LLM时间分析
 
 
 class TimeAnalysisResponse(BaseModel):
@@ -86,12 +350,14 @@ class TimeAnalysisResponse(BaseModel):
     reasoning: str
     confidence: str
     original_query: str
+    repairs: List[str] = []  # 提取JSON时做过的修复
 
 
 # APM 索引和字段映射
 APM_SCHEMA = {
     "transaction_index": "apm-*-transaction-*",
     "error_index": "apm-*-error-*",
+    "span_index": "apm-*-span-*",
     "metric_index": "apm-*-metric-*",
     "common_fields": {
         "service.name": "服务名称",
@@ -106,15 +372,12 @@ APM_SCHEMA = {
 }
 
 
-def generate_time_context_prompt(query: str, timezone: str = "UTC") -> str:
-    """生成时间上下文分析提示词"""
-
-    prompt = f"""
+TIME_CONTEXT_PROMPT_TEMPLATE_V1 = """
 你是一个专业的APM监控时间范围分析专家。根据用户的查询内容，判断最合适的时间范围。
 
-当前时区: {timezone}
+当前时区: ${timezone}
 
-用户查询: {query}
+用户查询: ${query}
 
 请分析用户查询中的时间意图，并返回最合适的时间范围。考虑以下因素：
 
@@ -127,10 +390,10 @@ def generate_time_context_prompt(query: str, timezone: str = "UTC") -> str:
 2. 时间词汇理解：
    - "刚才"、"刚刚" → 5-10分钟
    - "最近"、"近期" → 根据查询类型：性能15-30分钟，错误1-2小时
-   - "今天" → 1天
-   - "昨天" → 查看昨天全天数据
-   - "这周"、"本周" → 7天
-   - "上周" → 14天（包含对比）
+   - "今天" → today（今天0点至今）
+   - "昨天" → yesterday（昨天全天）；"前天" → day_before_yesterday
+   - "这周"、"本周" → this_week；"上周" → last_week（自然周，周一开始）
+   - "这个月"、"本月" → this_month；"上个月" → last_month
    - 无明确时间词汇 → 根据查询类型推断
 
 3. 业务常识：
@@ -140,7 +403,7 @@ def generate_time_context_prompt(query: str, timezone: str = "UTC") -> str:
    - 故障排查需要事件发生前后的数据
 
 请返回JSON格式，包含：
-- time_range: 时间范围（格式：5m, 30m, 1h, 2h, 1d, 7d等）
+- time_range: 时间范围（格式：5m, 30m, 1h, 2h, 1d, 7d, 1w等，或日历范围 today/yesterday/day_before_yesterday/this_week/last_week/this_month/last_month）
 - reasoning: 判断理由
 - confidence: 置信度（high/medium/low）
 
@@ -148,59 +411,345 @@ def generate_time_context_prompt(query: str, timezone: str = "UTC") -> str:
 
 示例输出：
 ```json
-{{
+{
   "time_range": "1h",
   "reasoning": "性能问题查询，需要足够数据但保持实时性",
   "confidence": "high"
-}}
+}
 ```
 
 分析结果：
 """
-    return prompt
 
 
-def parse_time_range(time_str: str, timezone: str = "UTC") -> tuple:
-    """解析时间范围，支持中英文和时区"""
-    import pytz
-
-    # 获取时区对象
+def generate_time_context_prompt(query: str, timezone: str = "UTC", version: Optional[str] = None) -> str:
+    """生成时间上下文分析提示词"""
+    template = get_prompt_template("time_context", version)
+    return template.render(query=query, timezone=timezone)
+
+
+# 日历对齐的时间范围标记
+CALENDAR_TIME_RANGES = ("today", "yesterday", "day_before_yesterday", "this_week", "last_week",
+                        "this_month", "last_month")
+RELATIVE_TIME_PATTERN = re.compile(r'(\d+)\s*(m|min|分钟|h|hour|小时|d|day|天|w|week|周)')
+
+
+def local_midnight(tz, day) -> datetime:
+    """时区内某一天的0点"""
+    return tz.localize(datetime(day.year, day.month, day.day))
+
+
+def calendar_time_range(token: str, now: datetime, tz) -> tuple:
+    """计算日历对齐的时间范围 [开始, 结束)，进行中的周期以当前时间为结束"""
+    today = local_midnight(tz, now)
+    if token == "today":
+        return today, now
+    if token == "yesterday":
+        return local_midnight(tz, today - timedelta(days=1)), today
+    if token == "day_before_yesterday":
+        return local_midnight(tz, today - timedelta(days=2)), local_midnight(tz, today - timedelta(days=1))
+    week_start = local_midnight(tz, today - timedelta(days=today.weekday()))
+    if token == "this_week":
+        return week_start, now
+    if token == "last_week":
+        return local_midnight(tz, week_start - timedelta(days=7)), week_start
+    month_start = local_midnight(tz, today.replace(day=1))
+    if token == "this_month":
+        return month_start, now
+    # last_month
+    return local_midnight(tz, (month_start - timedelta(days=1)).replace(day=1)), month_start
+
+
+# 时间解析缓存：时区对象和时间范围表达式的解析结果与当前时间无关，可以复用
+TIME_CACHE_SIZE = int(os.getenv("TIME_CACHE_SIZE", "256"))
+# 固定“当前时间”(ISO格式)，用于测试和基准测试时得到确定的时间窗口；为空时使用系统时间
+FIXED_NOW = os.getenv("FIXED_NOW", "")
+
+
+@functools.lru_cache(maxsize=TIME_CACHE_SIZE)
+def resolve_timezone(timezone: Optional[str]):
+    """解析时区名称，无法识别时使用UTC"""
     try:
-        tz = pytz.timezone(timezone)
-    except:
-        tz = pytz.UTC  # 默认UTC
+        return pytz.timezone(timezone or "UTC")
+    except pytz.UnknownTimeZoneError:
+        return pytz.UTC
 
-    # 获取当前时间（带时区）
-    now = datetime.now(tz)
 
-    # 正则匹配数字和单位
-    pattern = r'(\d+)\s*(m|min|分钟|h|hour|小时|d|day|天)'
-    match = re.search(pattern, time_str.lower())
+def current_time(tz, now: Optional[datetime] = None) -> datetime:
+    """获取时区内的当前时间；now可注入固定时间(未带时区按UTC处理)"""
+    if now is None and FIXED_NOW:
+        now = datetime.fromisoformat(FIXED_NOW.replace('Z', '+00:00'))
+    if now is None:
+        return datetime.now(tz)
+    if now.tzinfo is None:
+        now = pytz.UTC.localize(now)
+    return now.astimezone(tz)
 
-    if not match:
-        # 默认15分钟
-        return now - timedelta(minutes=15), now
 
-    num = int(match.group(1))
-    unit = match.group(2)
+def parse_iso_time(value: str, end_of_day: bool = False) -> datetime:
+    """解析ISO时间，只有日期的结束时间取次日0点；返回值可能不带时区"""
+    value = value.strip().replace(' ', 'T', 1)
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if end_of_day and len(value) <= 10:
+        dt = dt + timedelta(days=1)
+    return dt
 
-    if unit in ['m', 'min', '分钟']:
-        delta = timedelta(minutes=num)
-    elif unit in ['h', 'hour', '小时']:
-        delta = timedelta(hours=num)
-    elif unit in ['d', 'day', '天']:
-        delta = timedelta(days=num)
-    else:
-        delta = timedelta(minutes=15)
 
-    return now - delta, now
+def localize_time(dt: datetime, tz) -> datetime:
+    """未带时区的时间按请求时区处理，带时区的转换到请求时区"""
+    return tz.localize(dt) if dt.tzinfo is None else dt.astimezone(tz)
+
+
+RELATIVE_UNIT_DELTAS = {
+    'm': timedelta(minutes=1), 'min': timedelta(minutes=1), '分钟': timedelta(minutes=1),
+    'h': timedelta(hours=1), 'hour': timedelta(hours=1), '小时': timedelta(hours=1),
+    'd': timedelta(days=1), 'day': timedelta(days=1), '天': timedelta(days=1),
+    'w': timedelta(weeks=1), 'week': timedelta(weeks=1), '周': timedelta(weeks=1),
+}
 
 
-def generate_dsl_prompt(query: str, time_range: str, timezone: str = "UTC") -> str:
-    """生成完整的APM专用LLM提示词"""
-    start_time, end_time = parse_time_range(time_range, timezone)
+@functools.lru_cache(maxsize=TIME_CACHE_SIZE)
+def parse_time_expression(time_str: str) -> tuple:
+    """解析时间范围表达式（与当前时间和时区无关的部分）：
+    ("calendar", 标记) / ("absolute", 开始, 结束或None) / ("relative", timedelta)"""
+    time_str = (time_str or "").strip()
+
+    # 日历对齐范围
+    if time_str.lower() in CALENDAR_TIME_RANGES:
+        return ("calendar", time_str.lower())
+
+    # 绝对范围：2025-06-16T10:00:00/2025-06-16T12:00:00，结束时间为空表示至今
+    if '/' in time_str:
+        start_str, end_str = time_str.split('/', 1)
+        try:
+            end = parse_iso_time(end_str, end_of_day=True) if end_str.strip() else None
+            return ("absolute", parse_iso_time(start_str), end)
+        except ValueError:
+            raise ValueError(f"绝对时间格式不正确: {time_str}")
 
-    prompt = f"""
+    # 正则匹配数字和单位
+    match = RELATIVE_TIME_PATTERN.search(time_str.lower())
+    if not match:
+        # 默认15分钟
+        return ("relative", timedelta(minutes=15))
+    return ("relative", int(match.group(1)) * RELATIVE_UNIT_DELTAS[match.group(2)])
+
+
+def parse_time_range(time_str: str, timezone: str = "UTC", now: Optional[datetime] = None) -> tuple:
+    """解析时间范围，支持中英文和时区：相对范围(15m/2h/7d/1w)、日历范围(today/yesterday/last_week等)、
+    绝对范围(开始/结束，ISO格式)；now可注入固定的当前时间"""
+    tz = resolve_timezone(timezone)
+    now = current_time(tz, now)
+    expression = parse_time_expression(time_str)
+
+    if expression[0] == "calendar":
+        return calendar_time_range(expression[1], now, tz)
+    if expression[0] == "absolute":
+        end = localize_time(expression[2], tz) if expression[2] is not None else now
+        return localize_time(expression[1], tz), end
+    return now - expression[1], now
+
+
+def resolve_request_time_range(time_range: Optional[str], timezone: str = "UTC",
+                               start_time: Optional[str] = None, end_time: Optional[str] = None,
+                               now: Optional[datetime] = None) -> tuple:
+    """解析请求的时间窗口：设置了绝对开始时间时优先使用(结束时间默认为当前时间)，否则按time_range解析"""
+    if not start_time:
+        return parse_time_range(time_range or "15m", timezone, now)
+    try:
+        start, end = parse_time_range(f"{start_time}/{end_time or ''}", timezone, now)
+    except ValueError:
+        raise ValueError(f"绝对时间格式不正确: {start_time} ~ {end_time or 'now'}")
+    if start >= end:
+        raise ValueError(f"开始时间必须早于结束时间: {start_time} ~ {end_time or 'now'}")
+    return start, end
+
+
+# 对比时间范围：与当前窗口等长，整体向前偏移
+COMPARISON_OFFSETS = {
+    "previous_period": None,  # 紧邻的上一个等长窗口
+    "day_ago": timedelta(days=1),
+    "week_ago": timedelta(weeks=1),
+}
+
+
+def comparison_time_range(start: datetime, end: datetime, compare: str) -> tuple:
+    """计算对比时间范围，如“上周同一时段”"""
+    if compare not in COMPARISON_OFFSETS:
+        raise ValueError(f"不支持的对比范围: {compare}，可选: {', '.join(COMPARISON_OFFSETS)}")
+    offset = COMPARISON_OFFSETS[compare] or (end - start)
+    # 按本地时间偏移，跨夏令时切换时仍对齐到同一钟点
+    tz = start.tzinfo
+    if hasattr(tz, "localize"):
+        return (tz.normalize(tz.localize(start.replace(tzinfo=None) - offset)),
+                tz.normalize(tz.localize(end.replace(tzinfo=None) - offset)))
+    return start - offset, end - offset
+
+
+class TimeContext:
+    """单个请求的时间上下文：时区、当前时间和解析后的时间窗口只计算一次，供提示词、时间信息和对比范围共用"""
+
+    def __init__(self, time_range: Optional[str], timezone: Optional[str] = "UTC",
+                 start_time: Optional[str] = None, end_time: Optional[str] = None,
+                 compare: Optional[str] = None, now: Optional[datetime] = None):
+        self.timezone = timezone or "UTC"
+        self.tz = resolve_timezone(self.timezone)
+        self.now = current_time(self.tz, now)
+        self.time_range = "custom" if start_time else (time_range or "15m")
+        self.start, self.end = resolve_request_time_range(time_range, self.timezone, start_time, end_time, self.now)
+        self.compare = compare
+        self.comparison = comparison_time_range(self.start, self.end, compare) if compare else None
+
+    def with_range(self, time_range: str) -> "TimeContext":
+        """同一请求内按新的时间范围重新计算（沿用同一个当前时间）"""
+        return TimeContext(time_range, self.timezone, compare=self.compare, now=self.now)
+
+    def describe(self) -> str:
+        return f"{self.start.strftime('%Y-%m-%d %H:%M')} 到 {self.end.strftime('%Y-%m-%d %H:%M')} ({self.timezone})"
+
+    def describe_comparison(self) -> Optional[str]:
+        if self.comparison is None:
+            return None
+        return (f"{self.comparison[0].strftime('%Y-%m-%d %H:%M')} 到 "
+                f"{self.comparison[1].strftime('%Y-%m-%d %H:%M')} ({self.timezone})")
+
+
+# 规则时间提取：中文数字
+CHINESE_DIGITS = {'零': 0, '一': 1, '二': 2, '两': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+
+
+def parse_chinese_number(text: str) -> Optional[int]:
+    """解析100以内的中文数字，如 十五、二十、三"""
+    if text.isdigit():
+        return int(text)
+    if text == '十':
+        return 10
+    if '十' in text:
+        tens, _, ones = text.partition('十')
+        tens_value = CHINESE_DIGITS.get(tens, 1) if tens else 1
+        ones_value = CHINESE_DIGITS.get(ones, 0) if ones else 0
+        return tens_value * 10 + ones_value
+    return CHINESE_DIGITS.get(text)
+
+
+TIME_NUMBER = r'(\d+|[零一二两三四五六七八九十]+|半)'
+TIME_UNIT_PATTERNS = [
+    (r'分钟|mins?\b|minutes?\b', 'm'),
+    (r'个?小时|个?钟头|hours?\b|hrs?\b', 'h'),
+    (r'天|日|days?\b', 'd'),
+    (r'个?星期|个?礼拜|周|weeks?\b', 'w'),
+]
+RELATIVE_CUE = r'(?:最近|过去|近|前|last|past|previous|within|in\s+the\s+(?:last|past))'
+
+# 编译后的时间表达式规则，按优先级匹配
+ABSOLUTE_RANGE_REGEX = re.compile(
+    r'(\d{4}-\d{1,2}-\d{1,2}(?:[ T]\d{1,2}:\d{2}(?::\d{2})?)?)\s*(?:到|至|~|～|to|--|—|-)\s*'
+    r'(\d{4}-\d{1,2}-\d{1,2}(?:[ T]\d{1,2}:\d{2}(?::\d{2})?)?)', re.I)
+CALENDAR_REGEXES = [
+    (re.compile(r'前天|day before yesterday', re.I), "day_before_yesterday"),
+    (re.compile(r'昨天|昨日|yesterday', re.I), "yesterday"),
+    (re.compile(r'今天|今日|today', re.I), "today"),
+    (re.compile(r'上周|上个?星期|上个?礼拜|last\s+week', re.I), "last_week"),
+    (re.compile(r'本周|这周|这个?星期|这个?礼拜|this\s+week', re.I), "this_week"),
+    (re.compile(r'上个?月|last\s+month', re.I), "last_month"),
+    (re.compile(r'本月|这个?月|this\s+month', re.I), "this_month"),
+]
+# 与time_range参数相同的紧凑写法(30m/2h/7d/1w)；数字后的单个字母也可能是大小、阈值(如“512m内存”)，只在带“最近/内”提示时识别
+COMPACT_UNIT_PATTERNS = [
+    (r'(?:min|m)(?![a-z])', 'm'),
+    (r'h(?![a-z])', 'h'),
+    (r'd(?![a-z])', 'd'),
+    (r'w(?![a-z])', 'w'),
+]
+# “N月”单独出现时多为月份(如“3月5日”)，月单位只在带“最近/内”提示时识别，按30天折算
+MONTH_UNIT_PATTERN = (r'个月|months?\b', 'M')
+RELATIVE_REGEXES = [
+    (re.compile(rf'{RELATIVE_CUE}\s*{TIME_NUMBER}\s*(?:{pattern})|{TIME_NUMBER}\s*(?:{pattern})\s*(?:内(?!存)|以内|以来|之内)',
+                re.I), unit)
+    for pattern, unit in TIME_UNIT_PATTERNS + COMPACT_UNIT_PATTERNS + [MONTH_UNIT_PATTERN]
+]
+BARE_RELATIVE_REGEXES = [(re.compile(rf'{TIME_NUMBER}\s*(?:{pattern})', re.I), unit)
+                         for pattern, unit in TIME_UNIT_PATTERNS]
+SINGLE_UNIT_REGEX = re.compile(r'\b(?:last|past|previous)\s+(minute|hour|day)\b', re.I)
+VAGUE_TIME_REGEXES = [
+    (re.compile(r'刚才|刚刚|just\s+now|right\s+now', re.I), "10m", "medium"),
+    (re.compile(r'半小时|half\s+an?\s+hour', re.I), "30m", "high"),
+]
+
+
+def relative_match_to_range(number: str, unit: str) -> Optional[str]:
+    """将匹配到的数字和单位转换为 15m/2h 形式，月(M)按30天折算为天"""
+    if number == '半':
+        return {'h': '30m', 'd': '12h', 'M': '15d'}.get(unit)
+    value = parse_chinese_number(number)
+    if not value:
+        return None
+    if unit == 'M':
+        return f"{value * 30}d"
+    return f"{value}{unit}"
+
+
+def extract_time_range(query: str, timezone: str = "UTC", now: Optional[datetime] = None) -> Dict[str, Any]:
+    """基于规则从查询中提取时间范围，返回 time_range/start_time/end_time/confidence/reasoning；
+    未识别到明确时间表达时 confidence 为 low，由LLM继续分析"""
+    result: Dict[str, Any] = {"time_range": None, "confidence": "low", "matched": None,
+                              "reasoning": "未识别到明确的时间表达"}
+    text = query or ""
+
+    match = ABSOLUTE_RANGE_REGEX.search(text)
+    if match:
+        time_range = f"{match.group(1).replace(' ', 'T')}/{match.group(2).replace(' ', 'T')}"
+        result.update(time_range=time_range, confidence="high", matched=match.group(0),
+                      reasoning="查询中包含明确的起止时间")
+    if result["time_range"] is None:
+        # “今天最近30分钟”这类组合以更精确的相对表达为准，先于日历表达匹配
+        for regex, unit in RELATIVE_REGEXES:
+            match = regex.search(text)
+            if match:
+                number = match.group(1) or match.group(2)
+                time_range = relative_match_to_range(number, unit)
+                if time_range:
+                    result.update(time_range=time_range, confidence="high", matched=match.group(0),
+                                  reasoning=f"相对时间表达“{match.group(0)}”")
+                    break
+    if result["time_range"] is None:
+        for regex, token in CALENDAR_REGEXES:
+            match = regex.search(text)
+            if match:
+                result.update(time_range=token, confidence="high", matched=match.group(0),
+                              reasoning=f"日历时间表达“{match.group(0)}”，按自然日/周/月对齐")
+                break
+    if result["time_range"] is None:
+        match = SINGLE_UNIT_REGEX.search(text)
+        if match:
+            result.update(time_range=f"1{match.group(1)[0].lower()}", confidence="high", matched=match.group(0),
+                          reasoning=f"相对时间表达“{match.group(0)}”")
+    if result["time_range"] is None:
+        for regex, time_range, confidence in VAGUE_TIME_REGEXES:
+            match = regex.search(text)
+            if match:
+                result.update(time_range=time_range, confidence=confidence, matched=match.group(0),
+                              reasoning=f"时间表达“{match.group(0)}”")
+                break
+    if result["time_range"] is None:
+        # 没有“最近/内”等提示词的数字+单位，可能是阈值(如“超过2小时”)，置信度降低
+        for regex, unit in BARE_RELATIVE_REGEXES:
+            match = regex.search(text)
+            if match:
+                time_range = relative_match_to_range(match.group(1), unit)
+                if time_range:
+                    result.update(time_range=time_range, confidence="medium", matched=match.group(0),
+                                  reasoning=f"可能的时间表达“{match.group(0)}”，缺少“最近/内”等提示")
+                    break
+
+    if result["time_range"] is not None:
+        start_time, end_time = parse_time_range(result["time_range"], timezone, now)
+        result["start_time"] = start_time.isoformat()
+        result["end_time"] = end_time.isoformat()
+    return result
+
+
+DSL_PROMPT_TEMPLATE_V1 = """
 你是一个专业的APM (Application Performance Monitoring) Elasticsearch DSL生成专家。
 根据用户的APM监控查询需求，生成高质量的Elasticsearch DSL查询。
 === APM数据结构详解 ===
@@ -261,21 +810,21 @@ parent.id: 父span ID (keyword)
 span.id: span ID (keyword)
 
 === 时间范围配置 ===
-查询时间范围: {{start_time.isoformat()}} 到 {{end_time.isoformat()}}
-时区: {{timezone}}
-用户查询: {{query}}
+查询时间范围: ${start_time} 到 ${end_time}
+时区: ${timezone}
+用户查询: ${query}
 === DSL生成规则与最佳实践 ===
 【1. 时间过滤 - 必须包含】
 固定模板:
-{{
-"range": {{
-"@timestamp": {{
-"gte": "{{start_time.isoformat()}}",
-"lte": "{{end_time.isoformat()}}",
+{
+"range": {
+"@timestamp": {
+"gte": "${start_time}",
+"lte": "${end_time}",
 "format": "strict_date_optional_time"
-}}
-}}
-}}
+}
+}
+}
 【2. 聚合排序限制 - 重要】
 ✅ 可用于排序的单值聚合:
 
@@ -295,8 +844,8 @@ extended_stats: 扩展统计
 histogram: 直方图
 date_histogram: 时间直方图
 
-正确排序示例: "order": {{"avg_duration": "desc"}}
-错误排序示例: "order": {{"p95_duration": "desc"}}
+正确排序示例: "order": {"avg_duration": "desc"}
+错误排序示例: "order": {"p95_duration": "desc"}
 【3. 性能优化配置】
 
 size: 0  # 不返回原始文档，只要聚合结果
@@ -305,177 +854,177 @@ track_total_hits: false  # 不精确计算总数，提升性能
 
 【4. 常见APM查询模式】
 A. 服务性能排名:
-{{
-"aggs": {{
-"services": {{
-"terms": {{
+{
+"aggs": {
+"services": {
+"terms": {
 "field": "service.name",
 "size": 10,
-"order": {{"avg_duration": "desc"}}
-}},
-"aggs": {{
-"avg_duration": {{"avg": {{"field": "transaction.duration.us"}}}},
-"max_duration": {{"max": {{"field": "transaction.duration.us"}}}},
-"request_count": {{"value_count": {{"field": "@timestamp"}}}},
-"error_rate": {{
-"filter": {{"term": {{"event.outcome": "failure"}}}},
-"aggs": {{
-"error_count": {{"value_count": {{"field": "@timestamp"}}}}
-}}
-}}
-}}
-}}
-}}
-}}
+"order": {"avg_duration": "desc"}
+},
+"aggs": {
+"avg_duration": {"avg": {"field": "transaction.duration.us"}},
+"max_duration": {"max": {"field": "transaction.duration.us"}},
+"request_count": {"value_count": {"field": "@timestamp"}},
+"error_rate": {
+"filter": {"term": {"event.outcome": "failure"}},
+"aggs": {
+"error_count": {"value_count": {"field": "@timestamp"}}
+}
+}
+}
+}
+}
+}
 B. 接口性能分析:
-{{
-"aggs": {{
-"transactions": {{
-"terms": {{
+{
+"aggs": {
+"transactions": {
+"terms": {
 "field": "transaction.name",
 "size": 10,
-"order": {{"avg_duration": "desc"}}
-}},
-"aggs": {{
-"avg_duration": {{"avg": {{"field": "transaction.duration.us"}}}},
-"request_count": {{"value_count": {{"field": "@timestamp"}}}},
-"percentiles_duration": {{
-"percentiles": {{
+"order": {"avg_duration": "desc"}
+},
+"aggs": {
+"avg_duration": {"avg": {"field": "transaction.duration.us"}},
+"request_count": {"value_count": {"field": "@timestamp"}},
+"percentiles_duration": {
+"percentiles": {
 "field": "transaction.duration.us",
 "percents": [50, 90, 95, 99]
-}}
-}}
-}}
-}}
-}}
-}}
+}
+}
+}
+}
+}
+}
 C. 错误分析:
-{{
-"query": {{
-"bool": {{
+{
+"query": {
+"bool": {
 "filter": [
-{{"term": {{"event.outcome": "failure"}}}},
+{"term": {"event.outcome": "failure"}},
 时间过滤
 ]
-}}
-}},
-"aggs": {{
-"error_types": {{
-"terms": {{
+}
+},
+"aggs": {
+"error_types": {
+"terms": {
 "field": "error.exception.type",
 "size": 10,
-"order": {{"error_count": "desc"}}
-}},
-"aggs": {{
-"error_count": {{"value_count": {{"field": "@timestamp"}}}},
-"affected_services": {{
-"cardinality": {{"field": "service.name"}}
-}},
-"sample_message": {{
-"top_hits": {{
+"order": {"error_count": "desc"}
+},
+"aggs": {
+"error_count": {"value_count": {"field": "@timestamp"}},
+"affected_services": {
+"cardinality": {"field": "service.name"}
+},
+"sample_message": {
+"top_hits": {
 "size": 1,
 "_source": ["error.exception.message", "service.name"]
-}}
-}}
-}}
-}}
-}}
-}}
+}
+}
+}
+}
+}
+}
 D. 时间趋势分析:
-{{
-"aggs": {{
-"timeline": {{
-"date_histogram": {{
+{
+"aggs": {
+"timeline": {
+"date_histogram": {
 "field": "@timestamp",
 "fixed_interval": "1m",
-"extended_bounds": {{
-"min": "{{start_time.isoformat()}}",
-"max": "{{end_time.isoformat()}}"
-}}
-}},
-"aggs": {{
-"avg_duration": {{"avg": {{"field": "transaction.duration.us"}}}},
-"request_count": {{"value_count": {{"field": "@timestamp"}}}},
-"error_count": {{
-"filter": {{"term": {{"event.outcome": "failure"}}}}
-}}
-}}
-}}
-}}
-}}
+"extended_bounds": {
+"min": "${start_time}",
+"max": "${end_time}"
+}
+},
+"aggs": {
+"avg_duration": {"avg": {"field": "transaction.duration.us"}},
+"request_count": {"value_count": {"field": "@timestamp"}},
+"error_count": {
+"filter": {"term": {"event.outcome": "failure"}}
+}
+}
+}
+}
+}
 E. 状态码分布:
-{{
-"aggs": {{
-"status_codes": {{
-"terms": {{
+{
+"aggs": {
+"status_codes": {
+"terms": {
 "field": "http.response.status_code",
 "size": 10,
-"order": {{"request_count": "desc"}}
-}},
-"aggs": {{
-"request_count": {{"value_count": {{"field": "@timestamp"}}}},
-"avg_duration": {{"avg": {{"field": "transaction.duration.us"}}}}
-}}
-}}
-}}
-}}
+"order": {"request_count": "desc"}
+},
+"aggs": {
+"request_count": {"value_count": {"field": "@timestamp"}},
+"avg_duration": {"avg": {"field": "transaction.duration.us"}}
+}
+}
+}
+}
 【5. 复杂过滤条件】
 服务过滤:
-{{"term": {{"service.name": "服务名"}}}}
+{"term": {"service.name": "服务名"}}
 多服务过滤:
-{{"terms": {{"service.name": ["service1", "service2"]}}}}
+{"terms": {"service.name": ["service1", "service2"]}}
 响应时间范围:
-{{"range": {{"transaction.duration.us": {{"gte": 100000, "lte": 5000000}}}}}}
+{"range": {"transaction.duration.us": {"gte": 100000, "lte": 5000000}}}
 状态码过滤:
-{{"range": {{"http.response.status_code": {{"gte": 400}}}}}}
+{"range": {"http.response.status_code": {"gte": 400}}}
 路径模糊匹配:
-{{"wildcard": {{"url.path": "api"}}}}
+{"wildcard": {"url.path": "api"}}
 正则表达式:
-{{"regexp": {{"transaction.name": ".login."}}}}
+{"regexp": {"transaction.name": ".login."}}
 存在性检查:
-{{"exists": {{"field": "user.id"}}}}
+{"exists": {"field": "user.id"}}
 【6. 高级聚合技巧】
 分桶后再聚合:
-{{
-"aggs": {{
-"duration_ranges": {{
-"range": {{
+{
+"aggs": {
+"duration_ranges": {
+"range": {
 "field": "transaction.duration.us",
 "ranges": [
-{{"to": 100000}},
-{{"from": 100000, "to": 500000}},
-{{"from": 500000, "to": 1000000}},
-{{"from": 1000000}}
+{"to": 100000},
+{"from": 100000, "to": 500000},
+{"from": 500000, "to": 1000000},
+{"from": 1000000}
 ]
-}},
-"aggs": {{
-"request_count": {{"value_count": {{"field": "@timestamp"}}}}
-}}
-}}
-}}
-}}
+},
+"aggs": {
+"request_count": {"value_count": {"field": "@timestamp"}}
+}
+}
+}
+}
 嵌套条件聚合:
-{{
-"aggs": {{
-"services": {{
-"terms": {{"field": "service.name"}},
-"aggs": {{
-"fast_requests": {{
-"filter": {{"range": {{"transaction.duration.us": {{"lt": 100000}}}}}},
-"aggs": {{
-"count": {{"value_count": {{"field": "@timestamp"}}}}
-}}
-}},
-"slow_requests": {{
-"filter": {{"range": {{"transaction.duration.us": {{"gte": 1000000}}}}}},
-"aggs": {{
-"count": {{"value_count": {{"field": "@timestamp"}}}}
-}}
-}}
-}}
-}}
-}}
-}}
+{
+"aggs": {
+"services": {
+"terms": {"field": "service.name"},
+"aggs": {
+"fast_requests": {
+"filter": {"range": {"transaction.duration.us": {"lt": 100000}}},
+"aggs": {
+"count": {"value_count": {"field": "@timestamp"}}
+}
+},
+"slow_requests": {
+"filter": {"range": {"transaction.duration.us": {"gte": 1000000}}},
+"aggs": {
+"count": {"value_count": {"field": "@timestamp"}}
+}
+}
+}
+}
+}
+}
 【7. 查询类型智能识别】
 根据用户查询内容智能选择索引和字段:
 性能相关关键词: "慢", "slow", "响应时间", "latency", "duration", "性能"
@@ -504,27 +1053,27 @@ E. 状态码分布:
 
 1. 聚合名称必须唯一且明确：
    ✅ 正确示例：
-   "aggs": {{
-     "services": {{
-       "terms": {{
+   "aggs": {
+     "services": {
+       "terms": {
          "field": "service.name",
-         "order": {{"avg_response": "desc"}}  // 排序字段名
-       }},
-       "aggs": {{
-         "avg_response": {{  // 聚合名称必须与排序字段名一致
-           "avg": {{"field": "transaction.duration.us"}}
-         }}
-       }}
-     }}
-   }}
+         "order": {"avg_response": "desc"}  // 排序字段名
+       },
+       "aggs": {
+         "avg_response": {  // 聚合名称必须与排序字段名一致
+           "avg": {"field": "transaction.duration.us"}
+         }
+       }
+     }
+   }
 
    ❌ 错误示例：
-   "order": {{"avg_duration": "desc"}}  // 排序字段名
-   "aggs": {{
-     "avg_response": {{  // 聚合名称不一致
-       "avg": {{"field": "transaction.duration.us"}}
-     }}
-   }}
+   "order": {"avg_duration": "desc"}  // 排序字段名
+   "aggs": {
+     "avg_response": {  // 聚合名称不一致
+       "avg": {"field": "transaction.duration.us"}
+     }
+   }
 
 2. 嵌套聚合排序规则：
    - 每层聚合只能使用本层定义的子聚合进行排序
@@ -538,21 +1087,146 @@ E. 状态码分布:
 
 请根据以上规则和用户查询，生成专业的APM Elasticsearch DSL查询：
 """
+
+
+class PromptTemplate:
+    """预编译的提示词模板：静态部分只解析一次，渲染时仅拼接 ${变量}"""
+
+    VAR_PATTERN = re.compile(r'\$\{(\w+)\}')
+
+    def __init__(self, name: str, version: str, text: str):
+        self.name = name
+        self.version = version
+        # 按变量切分：literals[i] 与 variables[i] 交替出现，最后一段为静态尾部
+        self.literals: List[str] = []
+        self.variables: List[str] = []
+        pos = 0
+        for match in self.VAR_PATTERN.finditer(text):
+            self.literals.append(text[pos:match.start()])
+            self.variables.append(match.group(1))
+            pos = match.end()
+        self.tail = text[pos:]
+        self.static_size = sum(len(part) for part in self.literals) + len(self.tail)
+
+    def render(self, **values: Any) -> str:
+        try:
+            parts = [None] * (len(self.literals) * 2 + 1)
+            for i, literal in enumerate(self.literals):
+                parts[2 * i] = literal
+                parts[2 * i + 1] = str(values[self.variables[i]])
+            parts[-1] = self.tail
+        except KeyError as e:
+            raise ValueError(f"提示词模板 {self.name}:{self.version} 缺少变量: {e.args[0]}")
+        return "".join(parts)
+
+
+# 提示词模板注册表：{模板名: {版本: PromptTemplate}}
+PROMPT_TEMPLATE_DIR = os.getenv("PROMPT_TEMPLATE_DIR", "")  # 可选：从目录加载 {name}.{version}.txt 模板
+DEFAULT_PROMPT_VERSION = os.getenv("DEFAULT_PROMPT_VERSION", "v1")
+PROMPT_TEMPLATES: Dict[str, Dict[str, PromptTemplate]] = {}
+
+
+def register_prompt_template(name: str, version: str, text: str) -> PromptTemplate:
+    """注册（或覆盖）一个版本的提示词模板"""
+    template = PromptTemplate(name, version, text)
+    PROMPT_TEMPLATES.setdefault(name, {})[version] = template
+    return template
+
+
+def load_prompt_templates_from_dir(directory: str) -> int:
+    """启动时从目录加载模板文件，文件名格式 {name}.{version}.txt"""
+    if not directory or not os.path.isdir(directory):
+        return 0
+    loaded = 0
+    for filename in sorted(os.listdir(directory)):
+        parts = filename.split('.')
+        if len(parts) != 3 or parts[2] != 'txt':
+            continue
+        with open(os.path.join(directory, filename), encoding='utf-8') as f:
+            register_prompt_template(parts[0], parts[1], f.read())
+        loaded += 1
+    return loaded
+
+
+def get_prompt_template(name: str, version: Optional[str] = None) -> PromptTemplate:
+    """按名称和版本获取模板，未指定版本时使用默认版本"""
+    versions = PROMPT_TEMPLATES.get(name, {})
+    template = versions.get(version or DEFAULT_PROMPT_VERSION)
+    if template is None:
+        raise ValueError(f"未知的提示词模板版本: {name}:{version}，可用版本: {sorted(versions)}")
+    return template
+
+
+register_prompt_template("dsl", "v1", DSL_PROMPT_TEMPLATE_V1)
+register_prompt_template("time_context", "v1", TIME_CONTEXT_PROMPT_TEMPLATE_V1)
+
+
+# 对比查询说明：只扫描两个窗口本身，而不是覆盖两者的整段时间
+COMPARISON_PROMPT_NOTE = """
+=== 对比时间范围 ===
+当前时间范围: {start_time} 到 {end_time}
+对比时间范围: {comparison_start} 到 {comparison_end}
+此查询需要对比两个时间窗口，时间过滤改为以下结构（放在bool.filter中，替代上面的单个range）:
+{{"bool": {{"should": [
+{{"range": {{"@timestamp": {{"gte": "{start_time}", "lte": "{end_time}", "format": "strict_date_optional_time"}}}}}},
+{{"range": {{"@timestamp": {{"gte": "{comparison_start}", "lte": "{comparison_end}", "format": "strict_date_optional_time"}}}}}}
+], "minimum_should_match": 1}}}}
+并在最外层使用 filters 聚合把结果分为 "current" 和 "comparison" 两个桶，其他聚合作为它的子聚合。
+"""
+
+
+def generate_dsl_prompt(query: str, time_range: str, timezone: str = "UTC",
+                        start_time: Optional[datetime] = None, end_time: Optional[datetime] = None,
+                        version: Optional[str] = None, comparison: Optional[tuple] = None) -> str:
+    """生成完整的APM专用LLM提示词（已解析的时间范围可直接传入，避免重复解析）；
+    传入对比时间范围时追加对比查询说明，有字段取值采样时追加数据参考"""
+    if start_time is None or end_time is None:
+        start_time, end_time = parse_time_range(time_range, timezone)
+
+    template = get_prompt_template("dsl", version)
+    prompt = template.render(
+        query=query,
+        timezone=timezone,
+        start_time=start_time.isoformat(),
+        end_time=end_time.isoformat()
+    )
+    if comparison is not None:
+        prompt += COMPARISON_PROMPT_NOTE.format(
+            start_time=start_time.isoformat(),
+            end_time=end_time.isoformat(),
+            comparison_start=comparison[0].isoformat(),
+            comparison_end=comparison[1].isoformat()
+        )
+    # 注入与查询相关的实际字段取值，减少LLM臆造服务名/标签导致的空结果和重试
+    with observe_stage("build_schema_context"):
+        prompt += top_values_cache.build_prompt_context(query)
     return prompt
 
-def validate_dsl(dsl: Dict[Any, Any]) -> tuple[bool, str]:
-    """验证DSL查询的基本结构"""
-    try:
-        # 检查必需的字段
-        if not isinstance(dsl, dict):
-            return False, "DSL必须是JSON对象"
 
-        # 放宽验证条件：只要是合法的ES查询结构即可
-        # 可以有query、aggs、size、sort等任意组合
-        valid_top_level_fields = {'query', 'aggs', 'size', 'sort', '_source', 'from', 'highlight', 'script_fields'}
-        if not any(field in dsl for field in valid_top_level_fields):
-            return False, "DSL必须包含query、aggs、size、sort等ES查询字段之一"
+def validate_dsl_detailed(dsl: Dict[Any, Any]) -> List[Dict[str, Any]]:
+    """验证DSL：基本结构 + 基于字段映射的模式校验，返回机器可读的问题列表"""
+    # 检查必需的字段
+    if not isinstance(dsl, dict):
+        return [{"level": "error", "code": "invalid_structure", "path": "", "message": "DSL必须是JSON对象"}]
+
+    # 放宽验证条件：只要是合法的ES查询结构即可
+    # 可以有query、aggs、size、sort等任意组合
+    valid_top_level_fields = {'query', 'aggs', 'size', 'sort', '_source', 'from', 'highlight', 'script_fields'}
+    if not any(field in dsl for field in valid_top_level_fields):
+        return [{"level": "error", "code": "invalid_structure", "path": "",
+                 "message": "DSL必须包含query、aggs、size、sort等ES查询字段之一"}]
+
+    if SCHEMA_VALIDATION_MODE == "off":
+        return []
+    return validate_dsl_schema(dsl)
 
+
+def validate_dsl(dsl: Dict[Any, Any]) -> tuple[bool, str]:
+    """验证DSL查询，返回 (是否通过, 说明)"""
+    try:
+        errors = [issue for issue in validate_dsl_detailed(dsl) if issue["level"] == "error"]
+        if errors:
+            return False, format_validation_issues(errors)
         return True, "DSL验证通过"
 
     except Exception as e:
@@ -574,63 +1248,1907 @@ def has_time_filter(query_part: Dict[Any, Any]) -> bool:
     return False
 
 
-def execute_es_query(dsl: Dict[Any, Any]) -> Dict[Any, Any]:
-    """执行Elasticsearch查询"""
+DATE_MATH_PATTERN = re.compile(r'^now((?:[+-]\d+[smhdwMy])*)(?:/([smhdwMy]))?$')
+DATE_MATH_UNIT_MS = {'s': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000, 'w': 604800000,
+                     'M': 2678400000, 'y': 31622400000}
+
+
+def parse_es_time_value(value: Any, now_ms: int, round_up: bool = False) -> Optional[int]:
+    """将range边界（ISO时间、epoch毫秒或now-15m形式的date math）转换为epoch毫秒，无法识别时返回None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    match = DATE_MATH_PATTERN.match(value)
+    if match:
+        result = now_ms
+        for sign, num, unit in re.findall(r'([+-])(\d+)([smhdwMy])', match.group(1)):
+            delta = int(num) * DATE_MATH_UNIT_MS[unit]
+            result = result + delta if sign == '+' else result - delta
+        if match.group(2):
+            # 取整按单位近似处理：下界向下、上界向上放宽一个单位，只会多选不会漏选索引
+            unit_ms = DATE_MATH_UNIT_MS[match.group(2)]
+            result = result + unit_ms if round_up else result - unit_ms
+        return result
+
+    if '||' in value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        return int((dt - datetime(1970, 1, 1)).total_seconds() * 1000)
+    return int(dt.timestamp() * 1000)
+
+
+def collect_required_time_ranges(node: Any, ranges: List[Dict[str, Any]]):
+    """收集对整个查询生效的@timestamp范围（只看filter/must，忽略should/must_not和聚合内的过滤）"""
+    if isinstance(node, list):
+        for item in node:
+            collect_required_time_ranges(item, ranges)
+        return
+    if not isinstance(node, dict):
+        return
+    range_clause = node.get('range')
+    if isinstance(range_clause, dict) and isinstance(range_clause.get('@timestamp'), dict):
+        ranges.append(range_clause['@timestamp'])
+    bool_clause = node.get('bool')
+    if isinstance(bool_clause, dict):
+        for occur in ('filter', 'must'):
+            collect_required_time_ranges(bool_clause.get(occur), ranges)
+    for wrapper in ('constant_score', 'function_score'):
+        inner = node.get(wrapper)
+        if isinstance(inner, dict):
+            collect_required_time_ranges(inner.get('filter', inner.get('query')), ranges)
+
+
+def extract_query_time_range(dsl: Dict[Any, Any], now_ms: Optional[int] = None) -> Optional[tuple]:
+    """提取查询实际覆盖的时间窗口 (开始毫秒, 结束毫秒)，缺少边界的一侧为None；没有时间过滤时返回None"""
+    ranges: List[Dict[str, Any]] = []
+    collect_required_time_ranges(dsl.get('query'), ranges)
+    if not ranges:
+        return None
+
+    now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+    start, end = None, None
+    for condition in ranges:
+        for key in ('gte', 'gt', 'from'):
+            if condition.get(key) is not None:
+                value = parse_es_time_value(condition[key], now_ms)
+                if value is not None:
+                    start = value if start is None else max(start, value)
+        for key in ('lte', 'lt', 'to'):
+            if condition.get(key) is not None:
+                value = parse_es_time_value(condition[key], now_ms, round_up=True)
+                if value is not None:
+                    end = value if end is None else min(end, value)
+    if start is None and end is None:
+        return None
+    return start, end
+
+
+# DSL优化配置
+OPTIMIZER_ENABLED = os.getenv("OPTIMIZER_ENABLED", "true").lower() == "true"
+OPTIMIZER_MAX_TERMS_SIZE = int(os.getenv("OPTIMIZER_MAX_TERMS_SIZE", "100"))  # terms类聚合的size上限
+OPTIMIZER_MAX_TOP_HITS_SIZE = int(os.getenv("OPTIMIZER_MAX_TOP_HITS_SIZE", "10"))  # top_hits的size上限
+OPTIMIZER_TRACK_TOTAL_HITS = int(os.getenv("OPTIMIZER_TRACK_TOTAL_HITS", "10000"))  # 返回文档时总数统计上限
+OPTIMIZER_MAP_HINT_MAX_WINDOW = int(os.getenv("OPTIMIZER_MAP_HINT_MAX_WINDOW", "3600"))  # 时间窗口小于该秒数时terms使用map
+OPTIMIZER_TOP_HITS_SOURCE = [
+    f.strip() for f in os.getenv(
+        "OPTIMIZER_TOP_HITS_SOURCE",
+        "@timestamp,service.name,transaction.name,transaction.duration.us,event.outcome,"
+        "http.response.status_code,url.path,error.exception.type,error.exception.message,error.culprit,trace.id"
+    ).split(",") if f.strip()
+]
+
+# 不影响相关性评分、可以放入filter上下文的查询子句
+NON_SCORING_CLAUSES = {"term", "terms", "range", "exists", "ids", "prefix", "wildcard", "regexp"}
+
+
+def optimize_aggregations(aggs: Dict[str, Any], path: str, use_map_hint: bool, rewrites: List[str]):
+    """递归优化聚合：限制桶数量、top_hits只取必要字段"""
+    for name, agg in aggs.items():
+        if not isinstance(agg, dict):
+            continue
+        agg_path = f"{path}.{name}"
+        for agg_type in ("terms", "significant_terms", "rare_terms", "multi_terms"):
+            body = agg.get(agg_type)
+            if not isinstance(body, dict):
+                continue
+            size = body.get("size")
+            if isinstance(size, int) and size > OPTIMIZER_MAX_TERMS_SIZE:
+                body["size"] = OPTIMIZER_MAX_TERMS_SIZE
+                rewrites.append(f"{agg_path}: {agg_type}.size {size} → {OPTIMIZER_MAX_TERMS_SIZE}")
+            shard_size = body.get("shard_size")
+            if isinstance(shard_size, int) and shard_size > OPTIMIZER_MAX_TERMS_SIZE * 2:
+                body["shard_size"] = OPTIMIZER_MAX_TERMS_SIZE * 2
+                rewrites.append(f"{agg_path}: {agg_type}.shard_size {shard_size} → {body['shard_size']}")
+            if agg_type == "terms" and use_map_hint and "execution_hint" not in body and "field" in body:
+                body["execution_hint"] = "map"
+                rewrites.append(f"{agg_path}: 短时间窗口下terms使用 execution_hint=map")
+
+        composite = agg.get("composite")
+        if isinstance(composite, dict) and isinstance(composite.get("size"), int) \
+                and composite["size"] > OPTIMIZER_MAX_TERMS_SIZE:
+            rewrites.append(f"{agg_path}: composite.size {composite['size']} → {OPTIMIZER_MAX_TERMS_SIZE}")
+            composite["size"] = OPTIMIZER_MAX_TERMS_SIZE
+
+        top_hits = agg.get("top_hits")
+        if isinstance(top_hits, dict):
+            size = top_hits.get("size", 3)
+            if isinstance(size, int) and size > OPTIMIZER_MAX_TOP_HITS_SIZE:
+                top_hits["size"] = OPTIMIZER_MAX_TOP_HITS_SIZE
+                rewrites.append(f"{agg_path}: top_hits.size {size} → {OPTIMIZER_MAX_TOP_HITS_SIZE}")
+            if "_source" not in top_hits and OPTIMIZER_TOP_HITS_SOURCE:
+                top_hits["_source"] = list(OPTIMIZER_TOP_HITS_SOURCE)
+                rewrites.append(f"{agg_path}: top_hits只返回常用字段")
+
+        for sub_key in ("aggs", "aggregations"):
+            if isinstance(agg.get(sub_key), dict):
+                optimize_aggregations(agg[sub_key], agg_path, use_map_hint, rewrites)
+
+
+def move_to_filter_context(query: Dict[str, Any], path: str, rewrites: List[str]):
+    """不需要评分时，把bool.must子句移到filter，利用filter缓存并跳过评分"""
+    bool_clause = query.get("bool")
+    if not isinstance(bool_clause, dict):
+        return
+    must = bool_clause.pop("must", None)
+    if isinstance(must, dict):
+        must = [must]
+    if must:
+        existing = bool_clause.get("filter", [])
+        bool_clause["filter"] = (existing if isinstance(existing, list) else [existing]) + must
+        rewrites.append(f"{path}: {len(must)}个must子句移到filter上下文")
+
+    for occur in ("filter", "should", "must_not"):
+        clauses = bool_clause.get(occur)
+        for clause in clauses if isinstance(clauses, list) else [clauses]:
+            if isinstance(clause, dict):
+                move_to_filter_context(clause, f"{path}.bool.{occur}", rewrites)
+
+
+def optimize_dsl(dsl: Dict[Any, Any]) -> tuple[Dict[Any, Any], List[str]]:
+    """将DSL改写为开销更低的等价形式，返回 (优化后的DSL, 改写说明)"""
+    optimized = copy.deepcopy(dsl)
+    rewrites: List[str] = []
+    aggs = optimized.get("aggs", optimized.get("aggregations"))
+    agg_only = bool(aggs) and optimized.get("size") in (None, 0)
+
+    # 只需要聚合结果时不返回文档
+    if aggs and "size" not in optimized:
+        optimized["size"] = 0
+        rewrites.append("只有聚合：设置 size=0")
+
+    # 聚合查询不需要总数；返回文档时只统计到上限
+    track_total_hits = optimized.get("track_total_hits")
+    if agg_only and track_total_hits is not False:
+        optimized["track_total_hits"] = False
+        rewrites.append(f"只有聚合：track_total_hits {json.dumps(track_total_hits)} → false")
+    elif track_total_hits is True:
+        optimized["track_total_hits"] = OPTIMIZER_TRACK_TOTAL_HITS
+        rewrites.append(f"track_total_hits true → {OPTIMIZER_TRACK_TOTAL_HITS}")
+
+    # 只要聚合或按非_score字段排序时不需要评分，查询条件全部放入filter上下文
+    query = optimized.get("query")
+    sort = optimized.get("sort")
+    scoring_needed = not agg_only and (sort is None or "_score" in json.dumps(sort))
+    if isinstance(query, dict) and not scoring_needed:
+        clause_type = next(iter(query), None) if len(query) == 1 else None
+        if clause_type in NON_SCORING_CLAUSES:
+            optimized["query"] = {"bool": {"filter": [query]}}
+            rewrites.append(f"query: {clause_type} 包装为 bool.filter")
+        else:
+            move_to_filter_context(query, "query", rewrites)
+
+    if isinstance(aggs, dict):
+        time_range = extract_query_time_range(optimized)
+        use_map_hint = bool(time_range) and None not in time_range and \
+            time_range[1] - time_range[0] <= OPTIMIZER_MAP_HINT_MAX_WINDOW * 1000
+        optimize_aggregations(aggs, "aggs", use_map_hint, rewrites)
+
+    if rewrites:
+        log_event(logging.INFO, "dsl_optimized", rewrites=rewrites)
+    return optimized, rewrites
+
+
+# 查询成本估算与准入控制
+COST_CONTROL_ENABLED = os.getenv("COST_CONTROL_ENABLED", "true").lower() == "true"
+COST_DEFAULT_BUDGET = float(os.getenv("COST_DEFAULT_BUDGET", "50000"))  # 默认成本预算
+COST_BUDGETS = json.loads(os.getenv("COST_BUDGETS", "{}"))  # 按调用方配置预算，如 {"dashboard": 200000}
+COST_HARD_LIMIT_FACTOR = float(os.getenv("COST_HARD_LIMIT_FACTOR", "10"))  # 超过预算该倍数时拒绝
+COST_HEAVY_QUERY_CONCURRENCY = int(os.getenv("COST_HEAVY_QUERY_CONCURRENCY", "2"))  # 超预算查询的并发上限
+COST_DEFAULT_TIME_SPAN = int(os.getenv("COST_DEFAULT_TIME_SPAN", str(7 * 86400)))  # 无时间过滤时假定的时间跨度(秒)
+COST_DOWNGRADE_HISTOGRAM_POINTS = int(os.getenv("COST_DOWNGRADE_HISTOGRAM_POINTS", "120"))  # 降级时直方图最多点数
+COST_DOWNGRADE_TERMS_SIZE = int(os.getenv("COST_DOWNGRADE_TERMS_SIZE", "10"))  # 降级时terms的size
+
+# 各类昂贵操作的附加成本
+COST_PENALTIES = {
+    "regexp": 5000,
+    "leading_wildcard": 5000,
+    "script": 2000,
+    "top_hits_doc": 2,
+    "cardinality": 1,
+    "percentiles": 2,
+}
+
+# 超预算查询单独排队，避免占满普通查询的并发槽位
+heavy_query_semaphore = asyncio.Semaphore(COST_HEAVY_QUERY_CONCURRENCY)
+
+INTERVAL_PATTERN = re.compile(r'^(\d+)(ms|s|m|h|d|w|M|q|y)$')
+INTERVAL_SECONDS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800,
+                    'M': 2592000, 'q': 7776000, 'y': 31536000}
+CALENDAR_INTERVAL_SECONDS = {'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800,
+                             'month': 2592000, 'quarter': 7776000, 'year': 31536000}
+
+
+def parse_interval_seconds(interval: Any) -> Optional[float]:
+    """解析date_histogram间隔为秒"""
+    if not isinstance(interval, str):
+        return None
+    if interval in CALENDAR_INTERVAL_SECONDS:
+        return CALENDAR_INTERVAL_SECONDS[interval]
+    match = INTERVAL_PATTERN.match(interval)
+    if not match:
+        return None
+    return int(match.group(1)) * INTERVAL_SECONDS[match.group(2)]
+
+
+def format_interval(seconds: float) -> str:
+    """将秒数格式化为fixed_interval"""
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size and seconds % size == 0:
+            return f"{int(seconds // size)}{unit}"
+    return f"{max(1, int(seconds))}s"
+
+
+def query_time_span_seconds(dsl: Dict[Any, Any]) -> float:
+    """查询覆盖的时间跨度(秒)"""
+    now_ms = int(time.time() * 1000)
+    time_range = extract_query_time_range(dsl, now_ms)
+    if time_range is None or time_range[0] is None:
+        return COST_DEFAULT_TIME_SPAN
+    start, end = time_range
+    return max(1.0, ((end if end is not None else now_ms) - start) / 1000)
+
+
+def int_param(body: Dict[str, Any], key: str, default: int) -> int:
+    """读取聚合中的size等整数参数；LLM可能生成 "10"、"5.0"、null 或带单位的值，无法解析时按默认值估算"""
+    value = body.get(key, default)
+    if isinstance(value, bool):
+        return default
+    try:
+        return int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return default
+
+
+def estimate_bucket_count(agg_type: str, body: Dict[str, Any], span_seconds: float) -> int:
+    """估算单个分桶聚合产生的桶数"""
+    if agg_type == "date_histogram":
+        interval = parse_interval_seconds(body.get("fixed_interval") or body.get("calendar_interval")
+                                          or body.get("interval"))
+        return max(1, int(span_seconds / interval)) if interval else 100
+    if agg_type == "auto_date_histogram":
+        return int_param(body, "buckets", 10)
+    if agg_type in ("terms", "significant_terms", "rare_terms", "multi_terms", "composite"):
+        return int_param(body, "size", 10)
+    if agg_type in ("range", "date_range", "ip_range"):
+        return len(body.get("ranges", [])) or 1
+    if agg_type == "filters":
+        filters = body.get("filters", {})
+        return len(filters) or 1
+    if agg_type == "histogram":
+        return 100
+    return 1
+
+
+BUCKET_AGG_TYPES = {"date_histogram", "auto_date_histogram", "terms", "significant_terms", "rare_terms",
+                    "multi_terms", "composite", "range", "date_range", "ip_range", "filters", "histogram"}
+
+
+def estimate_aggs_cost(aggs: Dict[str, Any], parent_buckets: int, span_seconds: float,
+                       estimate: Dict[str, Any], path: str):
+    """递归估算聚合树的桶数和成本"""
+    for name, agg in aggs.items():
+        if not isinstance(agg, dict):
+            continue
+        agg_path = f"{path}.{name}"
+        buckets = parent_buckets
+        for agg_type, body in agg.items():
+            if agg_type in ("aggs", "aggregations", "meta") or not isinstance(body, dict):
+                continue
+            if agg_type in BUCKET_AGG_TYPES:
+                count = estimate_bucket_count(agg_type, body, span_seconds)
+                buckets = parent_buckets * count
+                estimate["estimated_buckets"] += buckets
+                if count >= 1000:
+                    estimate["factors"].append(f"{agg_path}: {agg_type} 约{count}个桶")
+            elif agg_type == "top_hits":
+                docs = int_param(body, "size", 3)
+                estimate["cost"] += parent_buckets * docs * COST_PENALTIES["top_hits_doc"]
+                if parent_buckets * docs >= 1000:
+                    estimate["factors"].append(f"{agg_path}: top_hits 约返回{parent_buckets * docs}条文档")
+            elif agg_type in ("cardinality", "percentiles"):
+                estimate["cost"] += parent_buckets * COST_PENALTIES[agg_type]
+            if "script" in body:
+                estimate["cost"] += COST_PENALTIES["script"]
+                estimate["factors"].append(f"{agg_path}: 使用脚本")
+        for sub_key in ("aggs", "aggregations"):
+            if isinstance(agg.get(sub_key), dict):
+                estimate_aggs_cost(agg[sub_key], buckets, span_seconds, estimate, agg_path)
+
+
+def estimate_query_clauses_cost(node: Any, estimate: Dict[str, Any]):
+    """估算查询子句中正则、前导通配符、脚本的成本"""
+    if isinstance(node, list):
+        for item in node:
+            estimate_query_clauses_cost(item, estimate)
+        return
+    if not isinstance(node, dict):
+        return
+    for key, value in node.items():
+        if key == "regexp":
+            estimate["cost"] += COST_PENALTIES["regexp"]
+            estimate["factors"].append("查询使用regexp")
+        elif key == "wildcard" and isinstance(value, dict):
+            for condition in value.values():
+                pattern = condition.get("value", condition.get("wildcard")) if isinstance(condition, dict) else condition
+                if isinstance(pattern, str) and pattern[:1] in ("*", "?"):
+                    estimate["cost"] += COST_PENALTIES["leading_wildcard"]
+                    estimate["factors"].append(f"查询使用前导通配符: {pattern}")
+        elif key in ("script", "script_score"):
+            estimate["cost"] += COST_PENALTIES["script"]
+            estimate["factors"].append("查询使用脚本")
+        else:
+            estimate_query_clauses_cost(value, estimate)
+
+
+def estimate_query_cost(dsl: Dict[Any, Any]) -> Dict[str, Any]:
+    """静态估算DSL执行成本：桶数(时间跨度×间隔×terms大小)加上昂贵操作的附加成本"""
+    span_seconds = query_time_span_seconds(dsl)
+    estimate: Dict[str, Any] = {"estimated_buckets": 0, "cost": 0.0, "time_span_seconds": int(span_seconds),
+                                "factors": []}
+    estimate_query_clauses_cost(dsl.get("query"), estimate)
+    estimate_query_clauses_cost(dsl.get("script_fields"), estimate)
+    aggs = dsl.get("aggs", dsl.get("aggregations"))
+    if isinstance(aggs, dict):
+        estimate_aggs_cost(aggs, 1, span_seconds, estimate, "aggs")
+    size = int_param(dsl, "size", 10)
+    if size > 0:
+        estimate["cost"] += size * COST_PENALTIES["top_hits_doc"]
+    estimate["cost"] = round(estimate["cost"] + estimate["estimated_buckets"], 2)
+    return estimate
+
+
+def downgrade_aggs(aggs: Dict[str, Any], span_seconds: float, changes: List[str], path: str):
+    """降级聚合：放大直方图间隔、缩小terms和top_hits"""
+    for name, agg in aggs.items():
+        if not isinstance(agg, dict):
+            continue
+        agg_path = f"{path}.{name}"
+        histogram = agg.get("date_histogram")
+        if isinstance(histogram, dict):
+            key = next((k for k in ("fixed_interval", "calendar_interval", "interval") if k in histogram), None)
+            interval = parse_interval_seconds(histogram.get(key)) if key else None
+            if interval and span_seconds / interval > COST_DOWNGRADE_HISTOGRAM_POINTS:
+                new_interval = format_interval(-(-span_seconds // COST_DOWNGRADE_HISTOGRAM_POINTS // 60) * 60)
+                histogram.pop(key)
+                histogram["fixed_interval"] = new_interval
+                changes.append(f"{agg_path}: 时间间隔 {format_interval(interval)} → {new_interval}")
+        for agg_type in ("terms", "significant_terms", "multi_terms", "composite"):
+            body = agg.get(agg_type)
+            if isinstance(body, dict) and int_param(body, "size", 10) > COST_DOWNGRADE_TERMS_SIZE:
+                changes.append(f"{agg_path}: {agg_type}.size {body.get('size', 10)} → {COST_DOWNGRADE_TERMS_SIZE}")
+                body["size"] = COST_DOWNGRADE_TERMS_SIZE
+        top_hits = agg.get("top_hits")
+        if isinstance(top_hits, dict) and int_param(top_hits, "size", 3) > 1:
+            changes.append(f"{agg_path}: top_hits.size {top_hits.get('size', 3)} → 1")
+            top_hits["size"] = 1
+        for sub_key in ("aggs", "aggregations"):
+            if isinstance(agg.get(sub_key), dict):
+                downgrade_aggs(agg[sub_key], span_seconds, changes, agg_path)
+
+
+def downgrade_dsl(dsl: Dict[Any, Any]) -> tuple[Dict[Any, Any], List[str]]:
+    """生成降低精度但成本更低的DSL"""
+    downgraded = copy.deepcopy(dsl)
+    changes: List[str] = []
+    aggs = downgraded.get("aggs", downgraded.get("aggregations"))
+    if isinstance(aggs, dict):
+        downgrade_aggs(aggs, query_time_span_seconds(downgraded), changes, "aggs")
+    return downgraded, changes
+
+
+def admit_query(dsl: Dict[Any, Any], caller: Optional[str] = None) -> tuple[Dict[Any, Any], Dict[str, Any]]:
+    """准入控制：预算内直接执行，超预算先尝试降级，仍超预算则排队，超过硬上限拒绝"""
+    estimate = estimate_query_cost(dsl)
+    budget = float(COST_BUDGETS.get(caller or "", COST_DEFAULT_BUDGET))
+    hard_limit = budget * COST_HARD_LIMIT_FACTOR
+    estimate.update({"budget": budget, "hard_limit": hard_limit, "caller": caller, "decision": "accept"})
+    if estimate["cost"] <= budget:
+        return dsl, estimate
+
+    downgraded, changes = downgrade_dsl(dsl)
+    if changes:
+        downgraded_estimate = estimate_query_cost(downgraded)
+        estimate.update({
+            "decision": "downgrade",
+            "original_cost": estimate["cost"],
+            "cost": downgraded_estimate["cost"],
+            "estimated_buckets": downgraded_estimate["estimated_buckets"],
+            "downgrades": changes
+        })
+        dsl = downgraded
+
+    if estimate["cost"] > hard_limit:
+        estimate["decision"] = "reject"
+    elif estimate["cost"] > budget:
+        estimate["decision"] = "queue"
+    log_event(logging.INFO, "query_admission", decision=estimate["decision"], cost=estimate["cost"],
+              budget=budget, caller=caller)
+    return dsl, estimate
+
+
+def es_response_to_dict(response: Any) -> Dict[Any, Any]:
+    """将ES响应转换为可序列化的字典"""
+    if hasattr(response, 'body'):
+        return response.body  # 新版本elasticsearch客户端
+    if hasattr(response, 'to_dict'):
+        return response.to_dict()
+
+    # 手动转换为字典
+    result = {}
+    for key in ['took', 'timed_out', '_shards', 'hits', 'aggregations']:
+        if hasattr(response, key):
+            result[key] = getattr(response, key)
+        elif isinstance(response, dict) and key in response:
+            result[key] = response[key]
+
+    # 如果结果为空，直接返回response
+    if not result and isinstance(response, dict):
+        result = response
+    return result
+
+
+class ESQueryError(Exception):
+    """ES查询失败；保留ES返回的HTTP状态码，用于区分查询被拒绝(4xx)和超时、连接失败等"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def es_error_status(error: Exception) -> Optional[int]:
+    """ES客户端异常(ApiError的meta.status)或ESQueryError中的HTTP状态码"""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "meta", None), "status", None)
+    return status if isinstance(status, int) else None
+
+
+# ES请求录制/回放：record模式把ES请求/响应追加到压缩文件，replay模式不连接集群，直接返回录制的响应
+ES_RECORD_MODE = os.getenv("ES_RECORD_MODE", "off")  # off / record / replay
+ES_RECORD_FILE = os.getenv("ES_RECORD_FILE", "es_recordings.jsonl.gz")
+ES_REPLAY_LATENCY = os.getenv("ES_REPLAY_LATENCY", "false").lower() == "true"  # 回放时按录制的耗时等待
+ES_RECORD_IGNORED_PARAMS = {"request_timeout", "timeout"}  # 不影响结果的参数，不计入指纹
+ES_CLIENT_NAMESPACES = {"indices", "cat", "cluster"}
+ES_RECORDINGS = Counter("text2dsl_es_recordings_total", "ES请求录制/回放次数", ["result"])  # recorded / replayed / miss
+
+
+def logical_index(index: Any, dsl: Any) -> Any:
+    """按时间窗口裁剪出的具体索引列表取决于当前时间和索引目录，还原为DSL对应的索引模式；
+    与DSL对应模式无关的索引(如调试接口查询的 apm-*、*)保持不变"""
+    if not isinstance(index, str) or not isinstance(dsl, dict):
+        return index
+    pattern = determine_index_pattern(dsl)
+    if any(fnmatch.fnmatch(name, pattern) for name in index.split(",")):
+        return pattern
+    return index
+
+
+def es_call_fingerprint(method: str, params: Dict[str, Any]) -> str:
+    """ES调用的指纹：方法名 + 规范化的参数(DSL和逻辑索引模式)，录制后任何时间回放都能命中"""
+    params = {k: v for k, v in params.items() if k not in ES_RECORD_IGNORED_PARAMS}
+    if method == "search" and "index" in params:
+        params["index"] = logical_index(params["index"], params.get("body"))
+    elif method == "msearch" and isinstance(params.get("searches"), list):
+        searches = params["searches"]
+        normalized = []
+        for header, body in zip(searches[::2], searches[1::2]):
+            body = {k: v for k, v in body.items() if k not in ES_RECORD_IGNORED_PARAMS}
+            normalized += [{**header, "index": logical_index(header.get("index"), body)}, body]
+        params["searches"] = normalized
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(f"{method}|{canonical}".encode("utf-8")).hexdigest()[:32]
+
+
+class RecordedResponse:
+    """回放的ES响应，与客户端响应一样通过body访问"""
+
+    def __init__(self, body: Any):
+        self.body = body
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.body.get(key, default) if isinstance(self.body, dict) else default
+
+    def __getitem__(self, key: Any) -> Any:
+        return self.body[key]
+
+
+class ReplayedESError(ESQueryError):
+    """回放录制的ES错误；带status_code以便与真实的ES拒绝同样处理"""
+
+
+class ESRecordStore:
+    """录制文件：每条记录是独立的gzip成员，可以直接追加；加载时按指纹建立索引，同一指纹保留最先录制的一条"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.stats = {"recorded": 0, "replayed": 0, "misses": 0}
+
+    def load(self) -> int:
+        self.entries.clear()
+        if not os.path.exists(self.path):
+            return 0
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries.setdefault(entry["key"], entry)
+        except (OSError, EOFError, ValueError, KeyError) as e:
+            # 录制进程异常退出时最后一条可能不完整，保留已读到的记录
+            log_event(logging.WARNING, "es_recordings_partially_loaded", file=self.path, error=str(e),
+                      entries=len(self.entries))
+        return len(self.entries)
+
+    def append(self, key: str, method: str, params: Dict[str, Any], elapsed: float,
+               response: Any = None, error: Optional[Dict[str, Any]] = None):
+        if key in self.entries:
+            return
+        entry = {"key": key, "method": method, "params": params, "elapsed_ms": round(elapsed * 1000, 1),
+                 "recorded_at": datetime.utcnow().isoformat()}
+        if error is not None:
+            entry["error"] = error
+        else:
+            entry["response"] = response
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+        with open(self.path, "ab") as f:
+            f.write(gzip.compress(line.encode("utf-8")))
+        self.entries[key] = entry
+        self.stats["recorded"] += 1
+        ES_RECORDINGS.labels("recorded").inc()
+
+    async def replay(self, key: str, method: str) -> RecordedResponse:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            ES_RECORDINGS.labels("miss").inc()
+            raise ReplayedESError(f"回放文件中没有该请求的录制: {method} {key}")
+        self.stats["replayed"] += 1
+        ES_RECORDINGS.labels("replayed").inc()
+        if ES_REPLAY_LATENCY and entry.get("elapsed_ms"):
+            await asyncio.sleep(entry["elapsed_ms"] / 1000)
+        if "error" in entry:
+            raise ReplayedESError(entry["error"].get("message", ""), entry["error"].get("status"))
+        return RecordedResponse(entry["response"])
+
+    def describe(self, limit: int = 20) -> Dict[str, Any]:
+        recent = list(self.entries.values())[-limit:]
+        return {
+            "file": self.path,
+            "entries": len(self.entries),
+            **self.stats,
+            "recent": [{"key": e["key"], "method": e["method"], "index": e["params"].get("index"),
+                        "elapsed_ms": e.get("elapsed_ms"), "error": "error" in e,
+                        "recorded_at": e.get("recorded_at")} for e in reversed(recent)]
+        }
+
+
+class RecordingESClient:
+    """包装ES客户端：record模式转发调用并录制，replay模式只读录制文件；方法按属性路径区分(如indices.get_mapping)"""
+
+    def __init__(self, client: Any, store: ESRecordStore, mode: str, path: str = ""):
+        self._client = client
+        self._store = store
+        self._mode = mode
+        self._path = path
+
+    def options(self, **kwargs: Any) -> "RecordingESClient":
+        client = self._client.options(**kwargs) if self._client is not None else None
+        return RecordingESClient(client, self._store, self._mode, self._path)
+
+    def __getattr__(self, name: str) -> Any:
+        path = f"{self._path}.{name}" if self._path else name
+        target = getattr(self._client, name) if self._client is not None else None
+        if not self._path and name in ES_CLIENT_NAMESPACES:
+            return RecordingESClient(target, self._store, self._mode, path)
+
+        async def call(**kwargs: Any) -> Any:
+            key = es_call_fingerprint(path, kwargs)
+            if self._mode == "replay":
+                return await self._store.replay(key, path)
+            start = time.perf_counter()
+            try:
+                response = await target(**kwargs)
+            except Exception as e:
+                status = es_error_status(e)
+                if status is not None:  # 只录制ES返回的错误，连接失败等不录制
+                    self._store.append(key, path, kwargs, time.perf_counter() - start,
+                                       error={"message": str(e), "status": status})
+                raise
+            self._store.append(key, path, kwargs, time.perf_counter() - start, response=es_response_to_dict(response))
+            return response
+        return call
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+
+
+es_record_store = ESRecordStore(ES_RECORD_FILE)
+if ES_RECORD_MODE in ("record", "replay"):
+    es_client = RecordingESClient(None if ES_RECORD_MODE == "replay" else es_client, es_record_store, ES_RECORD_MODE)
+    log_event(logging.INFO, "es_record_mode", mode=ES_RECORD_MODE, file=ES_RECORD_FILE,
+              entries=es_record_store.load())
+
+
+def resolve_query_timeout(timeout: Optional[float]) -> float:
+    """计算单次查询的超时时间，限制在配置的上限内"""
+    if timeout is None or timeout <= 0:
+        return ES_DEFAULT_QUERY_TIMEOUT
+    return min(float(timeout), ES_MAX_QUERY_TIMEOUT)
+
+
+def es_search_timeout(seconds: float) -> str:
+    """ES端搜索超时参数：按毫秒传递，亚秒级超时不会被截断为0s"""
+    return f"{max(1, round(seconds * 1000))}ms"
+
+
+@asynccontextmanager
+async def es_query_slot(heavy: bool = False):
+    """等待并发槽位，超时则直接拒绝，避免请求无限堆积；超预算查询先进入单独的队列"""
+    if heavy:
+        try:
+            await asyncio.wait_for(heavy_query_semaphore.acquire(), timeout=ES_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise Exception(f"高成本查询排队已满({COST_HEAVY_QUERY_CONCURRENCY})，请缩小查询范围或稍后重试")
+    try:
+        try:
+            await asyncio.wait_for(es_query_semaphore.acquire(), timeout=ES_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise Exception(f"ES并发查询已达上限({ES_MAX_CONCURRENT_QUERIES})，请稍后重试")
+        try:
+            yield
+        finally:
+            es_query_semaphore.release()
+    finally:
+        if heavy:
+            heavy_query_semaphore.release()
+
+
+async def execute_es_query(dsl: Dict[Any, Any], timeout: Optional[float] = None,
+                           heavy: bool = False) -> Dict[Any, Any]:
+    """执行Elasticsearch查询（异步，受并发上限和超时控制；heavy查询额外排队）"""
     try:
         # 确定查询的索引
-        index_pattern = determine_index_pattern(dsl)
+        with observe_stage("determine_index_pattern"):
+            index_pattern = resolve_target_indices(dsl)
+        query_timeout = resolve_query_timeout(timeout)
+
+        log_payload("es_query_dsl", dsl, index=index_pattern)
+
+        async with es_query_slot(heavy):
+            es_start = time.perf_counter()
+            # 执行查询：timeout为ES端的搜索超时，request_timeout为客户端等待时间
+            response = await es_client.options(request_timeout=query_timeout + ES_CLIENT_TIMEOUT_MARGIN).search(
+                index=index_pattern,
+                body=dsl,
+                timeout=es_search_timeout(query_timeout),
+                ignore_unavailable=True,  # 忽略不可用的索引
+                allow_no_indices=True  # 允许没有匹配的索引
+            )
+        ES_WALL.observe(time.perf_counter() - es_start)
 
-        print(f"使用索引: {index_pattern}")  # 调试信息
-        print(f"查询DSL: {json.dumps(dsl, indent=2)}")  # 调试信息
+        result = es_response_to_dict(response)
+        if isinstance(result.get("took"), (int, float)):
+            ES_TOOK.observe(result["took"] / 1000)
 
-        # 执行查询
-        response = es_client.search(
+        log_event(
+            logging.INFO, "es_query_done",
             index=index_pattern,
-            body=dsl,
-            timeout='30s',
-            ignore_unavailable=True,  # 忽略不可用的索引
-            allow_no_indices=True  # 允许没有匹配的索引
+            took=result.get("took"),
+            timed_out=result.get("timed_out"),
+            total=(result.get("hits") or {}).get("total"),
+            aggregations=list((result.get("aggregations") or {}).keys())
         )
+        log_payload("es_query_result", result, index=index_pattern)
+        return result
 
-        print(f"ES响应类型: {type(response)}")  # 调试信息
+    except Exception as e:
+        log_event(logging.ERROR, "es_query_failed", error=str(e), error_type=type(e).__name__)
+        raise ESQueryError(f"ES查询执行失败: {str(e)}", es_error_status(e)) from e
 
-        # 将ES响应转换为可序列化的字典
-        if hasattr(response, 'body'):
-            result = response.body  # 新版本elasticsearch客户端
-        elif hasattr(response, 'to_dict'):
-            result = response.to_dict()
-        else:
-            # 手动转换为字典
-            result = {}
-            for key in ['took', 'timed_out', '_shards', 'hits', 'aggregations']:
-                if hasattr(response, key):
-                    result[key] = getattr(response, key)
-                elif isinstance(response, dict) and key in response:
-                    result[key] = response[key]
-
-            # 如果结果为空，直接返回response
-            if not result and isinstance(response, dict):
-                result = response
-
-        print(f"处理后结果: {json.dumps(result, indent=2, default=str)}")  # 调试信息
+
+class LRUCache:
+    """带TTL的进程内LRU缓存"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        self._data[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class CacheBackend(ABC):
+    """共享缓存后端接口，多实例部署时可替换为Redis等实现"""
+
+    name = "base"
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Dict[Any, Any]]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: Dict[Any, Any], ttl: float):
+        ...
+
+    @abstractmethod
+    async def clear(self):
+        ...
+
+
+class MemoryCacheBackend(CacheBackend):
+    """本地内存实现的共享缓存替身，用于开发和测试"""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int = 4096):
+        self._cache = LRUCache(max_entries, RESULT_CACHE_TTL)
+
+    async def get(self, key: str) -> Optional[Dict[Any, Any]]:
+        return self._cache.get(key)
+
+    async def set(self, key: str, value: Dict[Any, Any], ttl: float):
+        self._cache.set(key, value, ttl)
+
+    async def clear(self):
+        self._cache.clear()
+
+
+class RedisCacheBackend(CacheBackend):
+    """基于Redis的共享缓存"""
+
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "text2dsl:result:"):
+        import redis.asyncio as redis_asyncio  # 可选依赖，仅在启用时导入
+
+        self._client = redis_asyncio.from_url(url)
+        self._prefix = prefix
+
+    async def get(self, key: str) -> Optional[Dict[Any, Any]]:
+        raw = await self._client.get(self._prefix + key)
+        return json.loads(raw) if raw else None
+
+    async def set(self, key: str, value: Dict[Any, Any], ttl: float):
+        await self._client.set(self._prefix + key, json.dumps(value, default=str), ex=max(1, int(ttl)))
+
+    async def clear(self):
+        async for key in self._client.scan_iter(match=self._prefix + "*"):
+            await self._client.delete(key)
+
+
+def create_cache_backend(backend: str) -> Optional[CacheBackend]:
+    """根据配置创建共享缓存后端，不可用时退化为仅本地缓存"""
+    backend = (backend or "local").lower()
+    if backend == "memory":
+        return MemoryCacheBackend()
+    if backend == "redis":
+        try:
+            return RedisCacheBackend(RESULT_CACHE_REDIS_URL)
+        except Exception as e:
+            log_event(logging.WARNING, "cache_backend_unavailable", backend="redis", error=str(e))
+    return None
+
+
+def snap_time_value(value: Any, granularity: int) -> Any:
+    """将时间边界向下对齐到指定粒度，date math表达式保持不变"""
+    if granularity <= 0:
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # epoch毫秒
+        step = granularity * 1000
+        return int(value) // step * step
+    if isinstance(value, str) and not value.startswith("now"):
+        try:
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return value
+        epoch = int(dt.timestamp()) // granularity * granularity
+        return datetime.fromtimestamp(epoch, dt.tzinfo).isoformat() if dt.tzinfo else \
+            datetime.utcfromtimestamp(epoch).isoformat()
+    return value
+
+
+def canonicalize_dsl(node: Any, granularity: int = RESULT_CACHE_TIME_GRANULARITY) -> Any:
+    """生成DSL的规范形式：@timestamp范围按粒度对齐，用于计算缓存键"""
+    if isinstance(node, dict):
+        result = {}
+        for key, value in node.items():
+            if key == "range" and isinstance(value, dict) and isinstance(value.get("@timestamp"), dict):
+                bounds = {
+                    k: snap_time_value(v, granularity) if k in ("gte", "gt", "lte", "lt", "from", "to") else v
+                    for k, v in value["@timestamp"].items()
+                }
+                other = {k: canonicalize_dsl(v, granularity) for k, v in value.items() if k != "@timestamp"}
+                result[key] = {"@timestamp": bounds, **other}
+            elif key == "extended_bounds" and isinstance(value, dict):
+                result[key] = {k: snap_time_value(v, granularity) for k, v in value.items()}
+            else:
+                result[key] = canonicalize_dsl(value, granularity)
         return result
+    if isinstance(node, list):
+        return [canonicalize_dsl(item, granularity) for item in node]
+    return node
+
+
+def dsl_cache_key(dsl: Dict[Any, Any], index_pattern: str) -> str:
+    """根据索引和规范化DSL计算缓存键"""
+    canonical = json.dumps(canonicalize_dsl(dsl), sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(f"{index_pattern}|{canonical}".encode("utf-8")).hexdigest()
+
 
+class QueryResultCache:
+    """ES查询结果缓存：本地LRU + 可选共享后端"""
+
+    def __init__(self, max_entries: int, ttl: float, backend: Optional[CacheBackend] = None):
+        self.ttl = ttl
+        self.local = LRUCache(max_entries, ttl)
+        self.backend = backend
+        self.stats = {"hits": 0, "local_hits": 0, "shared_hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "errors": 0}
+
+    async def get(self, key: str) -> Optional[Dict[Any, Any]]:
+        value = self.local.get(key)
+        if value is not None:
+            self.stats["hits"] += 1
+            self.stats["local_hits"] += 1
+            return value
+
+        if self.backend is not None:
+            try:
+                value = await self.backend.get(key)
+            except Exception as e:
+                self.stats["errors"] += 1
+                log_event(logging.WARNING, "cache_backend_get_failed", error=str(e))
+                value = None
+            if value is not None:
+                self.stats["hits"] += 1
+                self.stats["shared_hits"] += 1
+                self.local.set(key, value)
+                return value
+
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: Dict[Any, Any]):
+        self.local.set(key, value)
+        self.stats["stores"] += 1
+        if self.backend is not None:
+            try:
+                await self.backend.set(key, value, self.ttl)
+            except Exception as e:
+                self.stats["errors"] += 1
+                log_event(logging.WARNING, "cache_backend_set_failed", error=str(e))
+
+    async def clear(self):
+        self.local.clear()
+        if self.backend is not None:
+            await self.backend.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+            "entries": len(self.local),
+            "backend": self.backend.name if self.backend is not None else "local",
+            "ttl": self.ttl,
+            "time_granularity": RESULT_CACHE_TIME_GRANULARITY
+        }
+
+
+result_cache = QueryResultCache(
+    RESULT_CACHE_MAX_ENTRIES,
+    RESULT_CACHE_TTL,
+    create_cache_backend(RESULT_CACHE_BACKEND)
+)
+
+
+# 合并进行中的相同查询：突发时大量用户同时问同一个问题，只发一次ES请求
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+ES_COALESCED = Counter("text2dsl_es_coalesced_total", "与进行中的相同查询合并、未单独发送的ES调用数")
+ES_INFLIGHT_UNIQUE = Gauge("text2dsl_es_inflight_unique_queries", "正在执行的不同ES查询数",
+                           multiprocess_mode="livesum")
+
+
+class SingleFlight:
+    """相同键的并发调用共享一次执行；共享的执行放在独立任务中，单个调用方取消不影响其他等待者"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self.stats = {"executed": 0, "coalesced": 0}
+
+    async def do(self, key: str, fn, wait_timeout: Optional[float] = None) -> Any:
+        """wait_timeout只限制跟随者的等待时间；执行方由fn自身的排队和查询超时控制，
+        与未开启合并时的行为一致。跟随者等待超时抛出 asyncio.TimeoutError"""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            self.stats["executed"] += 1
+            ES_INFLIGHT_UNIQUE.inc()
+            task.add_done_callback(lambda t: self._finish(key, t))
+            return await asyncio.shield(task)
+        self.stats["coalesced"] += 1
+        ES_COALESCED.inc()
+        return await asyncio.wait_for(asyncio.shield(task), wait_timeout)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        ES_INFLIGHT_UNIQUE.dec()
+        if not task.cancelled():
+            task.exception()  # 所有等待者都已离开时避免“异常未被获取”的警告
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "in_flight": len(self._calls)}
+
+
+es_singleflight = SingleFlight()
+
+
+async def execute_es_query_cached(dsl: Dict[Any, Any], timeout: Optional[float] = None,
+                                  bypass_cache: bool = False, heavy: bool = False) -> tuple[Dict[Any, Any], bool]:
+    """带结果缓存和并发合并的ES查询，返回 (结果, 是否命中缓存)"""
+    use_cache = RESULT_CACHE_ENABLED and not bypass_cache
+    cache_key = dsl_cache_key(dsl, determine_index_pattern(dsl))
+    if not use_cache:
+        result_cache.stats["bypassed"] += 1
+    else:
+        cached = await result_cache.get(cache_key)
+        if cached is not None:
+            return cached, True
+
+    async def run() -> Dict[Any, Any]:
+        result = await execute_es_query(dsl, timeout, heavy)
+        if use_cache and is_cacheable_result(result):
+            await result_cache.set(cache_key, result)
+        return result
+
+    if not SINGLEFLIGHT_ENABLED:
+        return await run(), False
+    # 跟随者的等待上限与自己单独执行时相同：排队时间(heavy查询排两次队) + 查询超时 + 客户端余量
+    wait_timeout = (resolve_query_timeout(timeout) + ES_CLIENT_TIMEOUT_MARGIN
+                    + ES_QUEUE_TIMEOUT * (2 if heavy else 1))
+    try:
+        return await es_singleflight.do(cache_key, run, wait_timeout), False
+    except asyncio.TimeoutError:
+        log_event(logging.WARNING, "es_singleflight_wait_timeout", wait_timeout=round(wait_timeout, 3))
+        raise ESQueryError(f"ES查询执行失败: 等待进行中的相同查询超时({wait_timeout:g}秒)")
+
+
+def is_cacheable_result(result: Dict[Any, Any]) -> bool:
+    """超时或分片失败的结果不完整，不写入缓存"""
+    return not result.get("timed_out") and not result.get("_shards", {}).get("failed")
+
+
+async def execute_es_msearch(dsls: List[Dict[Any, Any]], timeout: Optional[float] = None,
+                             heavy: bool = False,
+                             item_timeouts: Optional[List[Optional[float]]] = None) -> List[Any]:
+    """通过一次_msearch执行多个DSL，按顺序返回每个结果；单项失败时对应位置为Exception。
+    item_timeouts为各项自己的超时(为空的项使用timeout)，客户端按其中最长的等待"""
+    query_timeouts = [resolve_query_timeout(item_timeout if item_timeout is not None else timeout)
+                      for item_timeout in (item_timeouts or [None] * len(dsls))]
+    query_timeout = max(query_timeouts, default=resolve_query_timeout(timeout))
+    searches = []
+    index_patterns = []
+    for dsl, item_timeout in zip(dsls, query_timeouts):
+        with observe_stage("determine_index_pattern"):
+            index_pattern = resolve_target_indices(dsl)
+        index_patterns.append(index_pattern)
+        searches.append({"index": index_pattern, "ignore_unavailable": True, "allow_no_indices": True})
+        searches.append({"timeout": es_search_timeout(item_timeout), **dsl})
+
+    log_payload("es_msearch_dsl", dsls, indices=index_patterns)
+
+    try:
+        async with es_query_slot(heavy):
+            es_start = time.perf_counter()
+            response = await es_client.options(request_timeout=query_timeout + ES_CLIENT_TIMEOUT_MARGIN).msearch(searches=searches)
+        ES_WALL.observe(time.perf_counter() - es_start)
     except Exception as e:
-        print(f"ES查询详细错误: {str(e)}")  # 调试信息
-        print(f"错误类型: {type(e)}")  # 调试信息
-        raise Exception(f"ES查询执行失败: {str(e)}")
+        log_event(logging.ERROR, "es_msearch_failed", error=str(e), error_type=type(e).__name__, items=len(dsls))
+        raise ESQueryError(f"ES批量查询执行失败: {str(e)}", es_error_status(e)) from e
+
+    responses = es_response_to_dict(response).get("responses", [])
+    results: List[Any] = []
+    for i in range(len(dsls)):
+        item = responses[i] if i < len(responses) else {"error": "ES未返回该查询的结果"}
+        if "error" in item:
+            error = item["error"]
+            reason = error.get("reason", error) if isinstance(error, dict) else error
+            status = item.get("status")
+            results.append(ESQueryError(f"ES查询执行失败: {reason}", status if isinstance(status, int) else None))
+            continue
+        item.pop("status", None)
+        if isinstance(item.get("took"), (int, float)):
+            ES_TOOK.observe(item["took"] / 1000)
+        results.append(item)
+
+    log_event(
+        logging.INFO, "es_msearch_done",
+        items=len(dsls),
+        failed=sum(1 for r in results if isinstance(r, Exception)),
+        indices=index_patterns
+    )
+    return results
+
+
+async def execute_es_queries_cached(dsls: List[Dict[Any, Any]], timeout: Optional[float] = None,
+                                    bypass_cache: bool = False, heavy: bool = False,
+                                    item_timeouts: Optional[List[Optional[float]]] = None,
+                                    item_bypass_cache: Optional[List[bool]] = None) -> List[tuple]:
+    """批量执行DSL：先查缓存，未命中的合并为一次_msearch，返回 [(结果或Exception, 是否命中缓存)]；
+    item_timeouts/item_bypass_cache为各项自己的超时和跳过缓存设置"""
+    item_bypass_cache = item_bypass_cache or [False] * len(dsls)
+    outcomes: List[Any] = [None] * len(dsls)
+    pending: List[int] = []
+    cache_keys: Dict[int, str] = {}
+    use_cache: Dict[int, bool] = {}
+
+    for i, dsl in enumerate(dsls):
+        use_cache[i] = RESULT_CACHE_ENABLED and not bypass_cache and not item_bypass_cache[i]
+        if not use_cache[i]:
+            result_cache.stats["bypassed"] += 1
+            pending.append(i)
+            continue
+        cache_keys[i] = dsl_cache_key(dsl, determine_index_pattern(dsl))
+        cached = await result_cache.get(cache_keys[i])
+        if cached is not None:
+            outcomes[i] = (cached, True)
+        else:
+            pending.append(i)
+
+    if pending:
+        try:
+            results = await execute_es_msearch([dsls[i] for i in pending], timeout, heavy,
+                                               [item_timeouts[i] for i in pending] if item_timeouts else None)
+        except Exception as e:
+            results = [e] * len(pending)
+        for i, result in zip(pending, results):
+            if use_cache[i] and not isinstance(result, Exception) and is_cacheable_result(result):
+                await result_cache.set(cache_keys[i], result)
+            outcomes[i] = (result, False)
+    return outcomes
+
+
+# APM事件类型，顺序即多个类型都可能匹配时的优先级
+APM_EVENT_TYPES = ("transaction", "error", "span", "metric")
+FIELD_INDEX_MAP_REFRESH_INTERVAL = int(os.getenv("FIELD_INDEX_MAP_REFRESH_INTERVAL", "600"))  # 0表示不从ES加载映射
+
+# 未加载ES映射时的默认字段归属：精确字段优先，其次按前缀匹配；未列出的字段视为所有类型通用
+DEFAULT_FIELD_TYPES = {
+    "transaction.id": {"transaction", "error", "span"},
+    "transaction.name": {"transaction", "error"},
+    "transaction.type": {"transaction", "error"},
+    "transaction.sampled": {"transaction", "error", "span"},
+    "trace.id": {"transaction", "error", "span"},
+    "parent.id": {"transaction", "error", "span"},
+    "event.outcome": {"transaction", "span", "error"},
+}
+DEFAULT_FIELD_PREFIX_TYPES = {
+    "transaction.": {"transaction"},
+    "error.": {"error"},
+    "span.": {"span"},
+    "metricset.": {"metric"},
+    "system.": {"metric"},
+    "jvm.": {"metric"},
+    "golang.": {"metric"},
+    "nodejs.": {"metric"},
+    "clr.": {"metric"},
+    "ruby.": {"metric"},
+}
+
+# 查询子句中，内层key为字段名的子句
+QUERY_FIELD_CLAUSES = {"term", "terms", "match", "match_phrase", "match_phrase_prefix", "match_bool_prefix",
+                       "range", "wildcard", "regexp", "prefix", "fuzzy", "terms_set"}
+# 子句参数名（非字段名）
+CLAUSE_PARAM_KEYS = {"boost", "_name", "case_insensitive", "rewrite", "flags", "max_determinized_states",
+                     "minimum_should_match", "format", "time_zone", "relation", "value_type"}
+
+
+def index_name_event_type(index_name: str) -> Optional[str]:
+    """从具体索引名(含data stream后备索引)识别APM事件类型"""
+    name = index_name.lower()
+    for event_type in APM_EVENT_TYPES:
+        if f"-{event_type}-" in name or f"apm.{event_type}" in name or name.endswith(f"-{event_type}"):
+            return event_type
+    if name.startswith(("traces-apm", ".ds-traces-apm")):
+        return "transaction"
+    if name.startswith(("metrics-apm", ".ds-metrics-apm")):
+        return "metric"
+    return None
+
+
+def flatten_mapping_properties(properties: Dict[str, Any], prefix: str = "") -> Dict[str, str]:
+    """展开mapping的properties为 {字段全名: 类型}，包含multi-fields"""
+    fields: Dict[str, str] = {}
+    for name, spec in (properties or {}).items():
+        full_name = f"{prefix}{name}"
+        if not isinstance(spec, dict):
+            continue
+        if "properties" in spec:
+            fields.update(flatten_mapping_properties(spec["properties"], f"{full_name}."))
+        else:
+            fields[full_name] = spec.get("type", "object")
+        for sub_name, sub_spec in (spec.get("fields") or {}).items():
+            if isinstance(sub_spec, dict):
+                fields[f"{full_name}.{sub_name}"] = sub_spec.get("type", "object")
+    return fields
+
+
+class FieldIndexMap:
+    """字段 → 包含该字段的APM事件类型，默认使用内置规则，可从ES映射刷新"""
+
+    def __init__(self):
+        self.exact: Dict[str, frozenset] = {k: frozenset(v) for k, v in DEFAULT_FIELD_TYPES.items()}
+        self.prefixes: Dict[str, frozenset] = {k: frozenset(v) for k, v in DEFAULT_FIELD_PREFIX_TYPES.items()}
+        self.source = "default"
+        self.loaded_at: Optional[str] = None
+        self._lookup_cache: Dict[str, Optional[frozenset]] = {}
+        self.data_types: Dict[str, frozenset] = {}  # 字段 → ES映射类型(keyword/text/long...)，只在加载映射后可用
+        self.object_paths: frozenset = frozenset()  # 映射中的对象路径，如 labels、transaction.duration
+
+    def types_for(self, field: str) -> Optional[frozenset]:
+        """返回包含该字段的事件类型，None表示不限制（通用字段或未知字段）"""
+        if field in self._lookup_cache:
+            return self._lookup_cache[field]
+        types = self.exact.get(field)
+        if types is None and self.source == "default":
+            for prefix, prefix_types in self.prefixes.items():
+                if field.startswith(prefix):
+                    types = prefix_types
+                    break
+        if types is not None and len(types) >= len(APM_EVENT_TYPES):
+            types = None
+        if len(self._lookup_cache) < 10000:
+            self._lookup_cache[field] = types
+        return types
+
+    @property
+    def has_mappings(self) -> bool:
+        return self.source == "mappings"
+
+    def data_types_for(self, field: str) -> Optional[frozenset]:
+        """返回字段的映射类型，None表示映射中没有该字段"""
+        return self.data_types.get(field)
+
+    def has_field(self, field: str) -> bool:
+        """字段或对象路径是否存在于映射中"""
+        return field in self.data_types or field in self.object_paths
+
+    def describe(self, prefix: str = "") -> Dict[str, Any]:
+        """扁平化的字段映射 {字段: {types, event_types}}，供调试接口和提示词使用"""
+        return {
+            "source": self.source,
+            "loaded_at": self.loaded_at,
+            "field_count": len(self.data_types),
+            "fields": {
+                field: {"types": sorted(types), "event_types": sorted(self.exact.get(field, ()))}
+                for field, types in sorted(self.data_types.items()) if field.startswith(prefix)
+            }
+        }
+
+    def load_from_mappings(self, mappings: Dict[str, Any]):
+        """根据get_mapping的结果重建字段归属和字段类型"""
+        field_types: Dict[str, set] = {}
+        data_types: Dict[str, set] = {}
+        for index_name, index_mapping in mappings.items():
+            event_type = index_name_event_type(index_name)
+            if event_type is None or not isinstance(index_mapping, dict):
+                continue
+            properties = index_mapping.get("mappings", {}).get("properties", {})
+            for field, data_type in flatten_mapping_properties(properties).items():
+                field_types.setdefault(field, set()).add(event_type)
+                data_types.setdefault(field, set()).add(data_type)
+        if not field_types:
+            return
+        self.exact = {field: frozenset(types) for field, types in field_types.items()}
+        self.data_types = {field: frozenset(types) for field, types in data_types.items()}
+        self.object_paths = frozenset(
+            field.rsplit(".", i)[0] for field in data_types for i in range(1, field.count(".") + 1)
+        )
+        self.source = "mappings"
+        self.loaded_at = datetime.utcnow().isoformat()
+        self._lookup_cache = {}
+
+
+field_index_map = FieldIndexMap()
+
+
+async def refresh_field_index_map():
+    """从ES加载APM索引映射，刷新字段归属"""
+    try:
+        response = await es_client.indices.get_mapping(index="apm-*", ignore_unavailable=True, allow_no_indices=True)
+        field_index_map.load_from_mappings(es_response_to_dict(response))
+        log_event(logging.INFO, "field_index_map_refreshed", source=field_index_map.source,
+                  fields=len(field_index_map.exact))
+    except Exception as e:
+        log_event(logging.WARNING, "field_index_map_refresh_failed", error=str(e))
+
+
+class DSLAnalysis:
+    """一次遍历DSL得到的结构信息"""
+
+    def __init__(self):
+        self.fields: set = set()  # 查询、聚合、排序中引用的字段
+        self.event_types: set = set()  # processor.event 显式指定的事件类型
+        self.time_ranges: List[Dict[str, Any]] = []  # @timestamp 上的range条件
+        self.agg_types: set = set()  # 使用到的聚合类型
+
+
+def collect_dsl_fields(node: Any, analysis: DSLAnalysis):
+    """递归收集DSL中引用的字段"""
+    if isinstance(node, list):
+        for item in node:
+            collect_dsl_fields(item, analysis)
+        return
+    if not isinstance(node, dict):
+        return
+
+    for key, value in node.items():
+        if key in ("aggs", "aggregations") and isinstance(value, dict):
+            for agg_body in value.values():
+                if isinstance(agg_body, dict):
+                    analysis.agg_types.update(k for k in agg_body if k not in ("aggs", "aggregations", "meta"))
+                    collect_dsl_fields(agg_body, analysis)
+        elif key in QUERY_FIELD_CLAUSES and isinstance(value, dict) and "field" not in value and "script" not in value:
+            # 查询子句：{"term": {"service.name": "x"}}
+            for field, condition in value.items():
+                if field in CLAUSE_PARAM_KEYS:
+                    continue
+                analysis.fields.add(field)
+                if field == "@timestamp" and key == "range" and isinstance(condition, dict):
+                    analysis.time_ranges.append(condition)
+                elif field == "processor.event":
+                    values = condition if isinstance(condition, list) else [condition]
+                    for item in values:
+                        item = item.get("value", item.get("query")) if isinstance(item, dict) else item
+                        if isinstance(item, str) and item in APM_EVENT_TYPES:
+                            analysis.event_types.add(item)
+        elif key == "field" and isinstance(value, str):
+            analysis.fields.add(value)
+        elif key == "fields" and isinstance(value, list):
+            analysis.fields.update(f.split("^")[0] for f in value if isinstance(f, str))
+        elif key == "sort":
+            for item in value if isinstance(value, list) else [value]:
+                if isinstance(item, str) and not item.startswith("_"):
+                    analysis.fields.add(item)
+                elif isinstance(item, dict):
+                    analysis.fields.update(f for f in item if not f.startswith("_"))
+        elif key == "_source":
+            continue
+        else:
+            collect_dsl_fields(value, analysis)
+
+
+def analyze_dsl(dsl: Dict[Any, Any]) -> DSLAnalysis:
+    """分析DSL结构：引用字段、事件类型、时间范围、聚合类型"""
+    analysis = DSLAnalysis()
+    collect_dsl_fields(dsl, analysis)
+    return analysis
+
+
+# DSL模式校验：基于ES映射在进程内检查字段和常见的LLM错误，避免无效查询走一次ES往返
+SCHEMA_VALIDATION_MODE = os.getenv("SCHEMA_VALIDATION_MODE", "strict")  # strict: 错误阻止执行 / warn: 只报告 / off
+TEXT_FIELD_TYPES = frozenset({"text", "match_only_text"})
+NUMERIC_FIELD_TYPES = frozenset({"long", "integer", "short", "byte", "double", "float", "half_float", "scaled_float",
+                                 "unsigned_long", "date", "date_nanos", "aggregate_metric_double", "histogram"})
+# 需要数值字段的指标聚合
+NUMERIC_METRIC_AGGS = {"avg", "sum", "min", "max", "stats", "extended_stats", "percentiles", "percentile_ranks",
+                       "median_absolute_deviation", "boxplot"}
+# 多值指标聚合：排序时必须指定具体值，如 p.99、s.avg
+MULTI_VALUE_METRIC_AGGS = {"percentiles", "percentile_ranks", "stats", "extended_stats", "boxplot", "string_stats",
+                           "matrix_stats", "top_hits", "top_metrics", "geo_bounds"}
+# 精确匹配子句，作用在text字段上通常匹配不到结果
+EXACT_MATCH_CLAUSES = {"term", "terms", "prefix", "wildcard", "regexp", "fuzzy", "terms_set"}
+CALENDAR_INTERVALS = {"minute", "1m", "hour", "1h", "day", "1d", "week", "1w", "month", "1M",
+                      "quarter", "1q", "year", "1y"}
+VALID_TOP_LEVEL_KEYS = {"query", "aggs", "aggregations", "size", "from", "sort", "_source", "track_total_hits",
+                        "timeout", "highlight", "script_fields", "post_filter", "search_after", "collapse",
+                        "min_score", "track_scores", "fields", "docvalue_fields", "stored_fields", "explain",
+                        "version", "seq_no_primary_term", "terminate_after", "runtime_mappings", "indices_boost",
+                        "profile", "suggest", "rescore", "pit", "stats", "ext", "knn"}
+META_FIELDS = {"_id", "_index", "_score", "_doc", "_count", "_key", "_term", "_time", "_source", "_seq_no",
+               "_routing", "_shard_doc"}
+MAX_RESULT_WINDOW = int(os.getenv("MAX_RESULT_WINDOW", "10000"))
+
+
+def add_schema_issue(issues: List[Dict[str, Any]], code: str, path: str, message: str, **extra: Any):
+    issues.append({"level": "error", "code": code, "path": path, "message": message,
+                   **{k: v for k, v in extra.items() if v is not None}})
+
+
+def keyword_suggestion(field: str) -> Optional[str]:
+    """text字段对应的keyword子字段"""
+    candidate = f"{field}.keyword"
+    return candidate if field_index_map.data_types_for(candidate) else None
+
+
+def check_schema_field(field: Any, path: str, issues: List[Dict[str, Any]]) -> Optional[frozenset]:
+    """检查字段是否存在，返回字段的映射类型；未加载映射、通配符和元字段返回None"""
+    if not isinstance(field, str) or not field_index_map.has_mappings:
+        return None
+    if "*" in field or field in META_FIELDS:
+        return None
+    types = field_index_map.data_types_for(field)
+    if types is None and not field_index_map.has_field(field):
+        suggestions = difflib.get_close_matches(field, list(field_index_map.data_types), n=3, cutoff=0.75)
+        add_schema_issue(issues, "unknown_field", path, f"字段 {field} 不存在于索引映射中",
+                         field=field, suggestion=f"可能是: {', '.join(suggestions)}" if suggestions else None)
+    return types
+
+
+def validate_query_node(node: Any, path: str, issues: List[Dict[str, Any]]):
+    """递归检查查询子句中的字段"""
+    if isinstance(node, list):
+        for i, item in enumerate(node):
+            validate_query_node(item, f"{path}[{i}]", issues)
+        return
+    if not isinstance(node, dict):
+        return
+
+    for key, value in node.items():
+        key_path = f"{path}.{key}"
+        if key in ("aggs", "aggregations"):
+            add_schema_issue(issues, "misplaced_aggs", key_path, "聚合不能放在查询子句中",
+                             suggestion="把aggs移到DSL顶层")
+        elif key in QUERY_FIELD_CLAUSES and isinstance(value, dict) and "field" not in value and "script" not in value:
+            for field, _ in value.items():
+                if field in CLAUSE_PARAM_KEYS:
+                    continue
+                types = check_schema_field(field, f"{key_path}.{field}", issues)
+                if key in EXACT_MATCH_CLAUSES and types and types <= TEXT_FIELD_TYPES:
+                    keyword_field = keyword_suggestion(field)
+                    add_schema_issue(issues, "term_on_text_field", f"{key_path}.{field}",
+                                     f"{key} 作用在text字段 {field} 上，经过分词后通常匹配不到结果", field=field,
+                                     suggestion=f"改用 {keyword_field}" if keyword_field else "改用 match 查询")
+        elif key == "exists" and isinstance(value, dict):
+            check_schema_field(value.get("field"), f"{key_path}.field", issues)
+        elif key in ("multi_match", "query_string", "simple_query_string") and isinstance(value, dict):
+            for i, field in enumerate(value.get("fields") or []):
+                if isinstance(field, str):
+                    check_schema_field(field.split("^")[0], f"{key_path}.fields[{i}]", issues)
+        elif isinstance(value, (dict, list)):
+            validate_query_node(value, key_path, issues)
+
+
+def validate_agg_order(order: Any, sub_aggs: Dict[str, Any], path: str, issues: List[Dict[str, Any]]):
+    """检查 terms/histogram 的 order 是否引用了存在的单值子聚合"""
+    for item in order if isinstance(order, list) else [order]:
+        if not isinstance(item, dict):
+            continue
+        for key in item:
+            if key in META_FIELDS:
+                continue
+            steps = key.split(">")
+            current = sub_aggs
+            for index, step in enumerate(steps):
+                name, _, metric = step.split("[")[0].partition(".")
+                target = current.get(name) if isinstance(current, dict) else None
+                if not isinstance(target, dict):
+                    add_schema_issue(issues, "unknown_order_target", f"{path}.order",
+                                     f"排序引用的子聚合 {name} 不存在", order_key=key,
+                                     suggestion=f"可用的子聚合: {', '.join(current)}" if current else "先定义子聚合")
+                    break
+                target_type = next((k for k in target if k not in ("aggs", "aggregations", "meta")), None)
+                if target_type in BUCKET_AGG_TYPES:
+                    add_schema_issue(issues, "order_by_multi_bucket_agg", f"{path}.order",
+                                     f"不能按多桶聚合 {name}({target_type}) 排序", order_key=key)
+                    break
+                if index == len(steps) - 1 and target_type in MULTI_VALUE_METRIC_AGGS and not metric:
+                    example = f"{name}.99" if target_type.startswith("percentile") else f"{name}.avg"
+                    add_schema_issue(issues, "order_by_multi_value_agg", f"{path}.order",
+                                     f"不能直接按多值聚合 {name}({target_type}) 排序", order_key=key,
+                                     suggestion=f"指定具体值如 {example}，或改用 avg/max 等单值聚合")
+                current = target.get("aggs") or target.get("aggregations") or {}
+
+
+def validate_aggs_node(aggs: Any, path: str, issues: List[Dict[str, Any]]):
+    """递归检查聚合树"""
+    if not isinstance(aggs, dict):
+        add_schema_issue(issues, "invalid_aggs", path, "aggs必须是对象")
+        return
+    for name, agg in aggs.items():
+        agg_path = f"{path}.{name}"
+        if not isinstance(agg, dict):
+            add_schema_issue(issues, "invalid_aggs", agg_path, f"聚合 {name} 必须是对象")
+            continue
+        agg_types = [k for k in agg if k not in ("aggs", "aggregations", "meta")]
+        if len(agg_types) != 1:
+            add_schema_issue(issues, "missing_aggregation_type" if not agg_types else "multiple_aggregation_types",
+                             agg_path, f"聚合 {name} 必须且只能指定一种聚合类型，当前: {agg_types}",
+                             suggestion="多个聚合应拆分为同级的不同名称，或放入子aggs")
+        sub_aggs = agg.get("aggs") or agg.get("aggregations") or {}
+        for agg_type in agg_types:
+            body = agg[agg_type]
+            type_path = f"{agg_path}.{agg_type}"
+            if not isinstance(body, dict):
+                continue
+            fields = [body.get("field")]
+            if agg_type == "multi_terms":
+                fields += [t.get("field") for t in body.get("terms", []) if isinstance(t, dict)]
+            for field in fields:
+                types = check_schema_field(field, f"{type_path}.field", issues)
+                if not types:
+                    continue
+                if types <= TEXT_FIELD_TYPES and agg_type != "significant_text":
+                    keyword_field = keyword_suggestion(field)
+                    add_schema_issue(issues, "agg_on_text_field", f"{type_path}.field",
+                                     f"text字段 {field} 不能用于 {agg_type} 聚合", field=field,
+                                     suggestion=f"改用 {keyword_field}" if keyword_field else None)
+                elif agg_type in NUMERIC_METRIC_AGGS and not types & NUMERIC_FIELD_TYPES:
+                    add_schema_issue(issues, "metric_on_non_numeric_field", f"{type_path}.field",
+                                     f"{agg_type} 聚合需要数值字段，{field} 的类型是 {'/'.join(sorted(types))}",
+                                     field=field)
+            if agg_type == "date_histogram":
+                if "interval" in body:
+                    add_schema_issue(issues, "deprecated_interval", f"{type_path}.interval",
+                                     "date_histogram 的 interval 参数已移除",
+                                     suggestion=f"改用 fixed_interval: {body['interval']} 或 calendar_interval")
+                calendar_interval = body.get("calendar_interval")
+                if calendar_interval is not None and calendar_interval not in CALENDAR_INTERVALS:
+                    add_schema_issue(issues, "invalid_calendar_interval", f"{type_path}.calendar_interval",
+                                     f"calendar_interval 只支持单个日历单位，不支持 {calendar_interval}",
+                                     suggestion=f"改用 fixed_interval: {calendar_interval}")
+            if "order" in body and agg_type in ("terms", "histogram", "date_histogram", "rare_terms",
+                                                 "multi_terms"):
+                validate_agg_order(body["order"], sub_aggs, type_path, issues)
+            if agg_type == "filter":
+                validate_query_node(body, type_path, issues)
+            elif agg_type == "filters":
+                validate_query_node(body.get("filters"), f"{type_path}.filters", issues)
+        if sub_aggs:
+            validate_aggs_node(sub_aggs, f"{agg_path}.aggs", issues)
+
+
+def validate_dsl_schema(dsl: Dict[Any, Any]) -> List[Dict[str, Any]]:
+    """对照字段映射检查DSL，返回机器可读的问题列表 [{level, code, path, message, field?, suggestion?}]"""
+    issues: List[Dict[str, Any]] = []
+    for key in dsl:
+        if key not in VALID_TOP_LEVEL_KEYS:
+            suggestions = difflib.get_close_matches(key, VALID_TOP_LEVEL_KEYS, n=1)
+            add_schema_issue(issues, "unknown_top_level_key", key, f"未知的顶层字段 {key}",
+                             suggestion=f"可能是: {suggestions[0]}" if suggestions else None)
+    validate_query_node(dsl.get("query"), "query", issues)
+    validate_query_node(dsl.get("post_filter"), "post_filter", issues)
+    for aggs_key in ("aggs", "aggregations"):
+        if aggs_key in dsl:
+            validate_aggs_node(dsl[aggs_key], aggs_key, issues)
+
+    sort = dsl.get("sort")
+    for i, item in enumerate(sort if isinstance(sort, list) else [sort] if sort else []):
+        for field in [item] if isinstance(item, str) else item if isinstance(item, dict) else []:
+            types = check_schema_field(field, f"sort[{i}]", issues)
+            if types and types <= TEXT_FIELD_TYPES:
+                keyword_field = keyword_suggestion(field)
+                add_schema_issue(issues, "sort_on_text_field", f"sort[{i}]", f"text字段 {field} 不能用于排序",
+                                 field=field, suggestion=f"改用 {keyword_field}" if keyword_field else None)
+
+    size, offset = dsl.get("size", 10), dsl.get("from", 0)
+    if isinstance(size, int) and isinstance(offset, int) and size + offset > MAX_RESULT_WINDOW:
+        add_schema_issue(issues, "result_window_too_large", "size", f"from + size 超过 {MAX_RESULT_WINDOW}",
+                         suggestion="减小size，统计类需求改用聚合")
+
+    if SCHEMA_VALIDATION_MODE == "warn":
+        for issue in issues:
+            issue["level"] = "warning"
+    return issues
+
+
+def format_validation_issues(issues: List[Dict[str, Any]]) -> str:
+    """把问题列表格式化为一行文本"""
+    return "；".join(
+        f"{issue['path']}: {issue['message']}" + (f"（{issue['suggestion']}）" if issue.get("suggestion") else "")
+        for issue in issues
+    )
+
+
+def get_schema_info() -> Dict[str, Any]:
+    """索引和字段说明：内置的APM_SCHEMA，加载到索引目录和字段映射后附带实际发现的概要"""
+    if not field_index_map.has_mappings and index_catalog.refreshed_at is None:
+        return APM_SCHEMA
+    return {
+        **APM_SCHEMA,
+        "discovered": {
+            "field_count": len(field_index_map.data_types),
+            "mappings_loaded_at": field_index_map.loaded_at,
+            **index_catalog.summary()
+        }
+    }
+
+
+def determine_event_types(analysis: DSLAnalysis) -> List[str]:
+    """根据引用字段求出能满足查询的事件类型，按优先级排序"""
+    if analysis.event_types:
+        return [t for t in APM_EVENT_TYPES if t in analysis.event_types]
+
+    # 最具体的字段(所属类型最少)优先决定候选，同样具体时按字段名，保证结果与集合遍历顺序无关
+    field_types = [(types, field) for field in analysis.fields
+                   if (types := field_index_map.types_for(field)) is not None]
+    candidates = set(APM_EVENT_TYPES)
+    for types, _ in sorted(field_types, key=lambda item: (len(item[0]), item[1])):
+        narrowed = candidates & types
+        if not narrowed:
+            # 字段来自互不相容的类型，保留更具体字段已确定的候选
+            continue
+        candidates = narrowed
+    return [t for t in APM_EVENT_TYPES if t in candidates]
 
 
 def determine_index_pattern(dsl: Dict[Any, Any]) -> str:
-    """根据DSL内容确定索引模式"""
-    dsl_str = json.dumps(dsl).lower()
+    """根据DSL引用的字段选择最窄的索引模式"""
+    event_types = determine_event_types(analyze_dsl(dsl))
+    # 多个类型都可能时取优先级最高的（默认transaction），避免跨类型重复计数
+    event_type = event_types[0] if event_types else "transaction"
+    return APM_SCHEMA[f"{event_type}_index"]
+
+
+INDEX_CATALOG_REFRESH_INTERVAL = int(os.getenv("INDEX_CATALOG_REFRESH_INTERVAL", "300"))  # 0表示不做索引裁剪
+INDEX_PRUNING_MAX_INDICES = int(os.getenv("INDEX_PRUNING_MAX_INDICES", "50"))  # 裁剪后索引过多时退回通配模式
+DATA_STREAM_PATTERN = os.getenv("DATA_STREAM_PATTERN", "*apm*")  # 索引目录中收录的data stream
+
+
+class IndexCatalog:
+    """APM具体索引及其@timestamp范围、别名和data stream，用于按时间窗口裁剪索引和调试接口"""
+
+    def __init__(self):
+        # {事件类型: [(索引名, 最小时间毫秒, 最大时间毫秒)]}，范围未知时为None
+        self.indices: Dict[str, List[tuple]] = {}
+        # {索引名: (health, status, 文档数, 存储字节数)}
+        self.index_stats: Dict[str, tuple] = {}
+        self.aliases: Dict[str, List[str]] = {}  # {别名: [索引名]}
+        self.data_streams: Dict[str, Dict[str, Any]] = {}  # {data stream: {status, template, indices}}
+        self.refreshed_at: Optional[float] = None
+
+    def load(self, index_names: List[str], ranges: Dict[str, tuple], index_stats: Optional[Dict[str, tuple]] = None,
+             aliases: Optional[Dict[str, List[str]]] = None, data_streams: Optional[Dict[str, Dict[str, Any]]] = None):
+        """根据索引列表和各索引的时间范围重建目录"""
+        self.index_stats = index_stats or {}
+        self.aliases = aliases or {}
+        self.data_streams = data_streams or {}
+        catalog: Dict[str, List[tuple]] = {}
+        for name in index_names:
+            event_type = index_name_event_type(name)
+            if event_type is None:
+                continue
+            min_ts, max_ts = ranges.get(name, (None, None))
+            catalog.setdefault(event_type, []).append((name, min_ts, max_ts))
+
+        for entries in catalog.values():
+            entries.sort(key=lambda e: (e[1] is None, e[1] or 0))
+            # 每个类型最新的（有数据的）索引仍在写入，上界视为开放
+            known = [i for i, entry in enumerate(entries) if entry[1] is not None]
+            if known:
+                name, min_ts, _ = entries[known[-1]]
+                entries[known[-1]] = (name, min_ts, None)
+        self.indices = catalog
+        self.refreshed_at = time.time()
+
+    def is_fresh(self) -> bool:
+        return self.refreshed_at is not None and \
+            time.time() - self.refreshed_at < max(INDEX_CATALOG_REFRESH_INTERVAL, 1) * 3
+
+    def overlapping(self, event_type: str, start: Optional[int], end: Optional[int]) -> Optional[List[str]]:
+        """返回与时间窗口重叠的具体索引；目录不可用时返回None"""
+        entries = self.indices.get(event_type)
+        if not entries or not self.is_fresh():
+            return None
+        selected = []
+        for name, min_ts, max_ts in entries:
+            if min_ts is None:
+                selected.append(name)  # 空索引或范围未知，保守保留
+                continue
+            if end is not None and min_ts > end:
+                continue
+            if start is not None and max_ts is not None and max_ts < start:
+                continue
+            selected.append(name)
+        if end is None or end >= self.refreshed_at * 1000:
+            # 窗口延伸到上次刷新之后：期间可能发生了滚动，新索引不在目录中
+            latest = next((name for name, min_ts, max_ts in entries if min_ts is not None and max_ts is None),
+                          entries[-1][0])
+            selected.extend(self.rollover_targets(event_type, latest))
+        return selected
+
+    def rollover_targets(self, event_type: str, latest_index: str) -> List[str]:
+        """覆盖滚动后新索引的目标：指向最新索引的别名(写别名随滚动切换)或其data stream，都没有时使用该类型的通配模式"""
+        targets = [name for name, info in self.data_streams.items() if latest_index in (info.get("indices") or [])]
+        targets += [alias for alias, names in self.aliases.items() if latest_index in names]
+        return sorted(set(targets)) or [APM_SCHEMA[f"{event_type}_index"]]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "refreshed_at": datetime.utcfromtimestamp(self.refreshed_at).isoformat() if self.refreshed_at else None,
+            "indices": {t: len(entries) for t, entries in self.indices.items()},
+            "aliases": len(self.aliases),
+            "data_streams": len(self.data_streams)
+        }
+
+    def describe(self) -> Dict[str, Any]:
+        """完整目录内容，供调试接口使用"""
+        indices = []
+        for event_type, entries in self.indices.items():
+            for name, min_ts, max_ts in entries:
+                health, status, docs_count, store_bytes = self.index_stats.get(name, (None, None, None, None))
+                indices.append({
+                    "index": name,
+                    "event_type": event_type,
+                    "health": health,
+                    "status": status,
+                    "docs_count": docs_count,
+                    "store_bytes": store_bytes,
+                    "min_timestamp": datetime.utcfromtimestamp(min_ts / 1000).isoformat() if min_ts else None,
+                    "max_timestamp": datetime.utcfromtimestamp(max_ts / 1000).isoformat() if max_ts else None
+                })
+        return {
+            **self.summary(),
+            "fresh": self.is_fresh(),
+            "apm_indices": sorted(indices, key=lambda item: item["index"]),
+            "aliases": self.aliases,
+            "data_streams": self.data_streams
+        }
+
+
+index_catalog = IndexCatalog()
+
+
+def parse_int(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+async def fetch_index_aliases() -> Dict[str, List[str]]:
+    """获取APM索引上的别名 {别名: [索引名]}"""
+    response = es_response_to_dict(await es_client.indices.get_alias(index="apm-*", ignore_unavailable=True,
+                                                                     allow_no_indices=True))
+    aliases: Dict[str, List[str]] = {}
+    for index_name, item in response.items():
+        for alias in (item or {}).get("aliases", {}):
+            aliases.setdefault(alias, []).append(index_name)
+    return aliases
+
+
+async def fetch_data_streams() -> Dict[str, Dict[str, Any]]:
+    """获取APM相关的data stream及其后备索引"""
+    response = es_response_to_dict(await es_client.indices.get_data_stream(name=DATA_STREAM_PATTERN))
+    return {
+        stream["name"]: {
+            "status": stream.get("status"),
+            "template": stream.get("template"),
+            "indices": [item.get("index_name") for item in stream.get("indices", [])]
+        }
+        for stream in response.get("data_streams", [])
+    }
+
+
+async def refresh_index_catalog():
+    """从ES获取APM具体索引列表及各索引的@timestamp最小/最大值、别名和data stream"""
+    try:
+        indices = await es_client.cat.indices(index="apm-*", format="json", bytes="b",
+                                              h="index,health,status,docs.count,store.size")
+        index_stats = {
+            item["index"]: (item.get("health"), item.get("status"), parse_int(item.get("docs.count")),
+                            parse_int(item.get("store.size")))
+            for item in es_response_to_dict(indices) if item.get("index")
+        }
+        index_names = list(index_stats)
+        response = await es_client.search(
+            index="apm-*",
+            size=0,
+            aggs={
+                "by_index": {
+                    "terms": {"field": "_index", "size": max(len(index_names), 1)},
+                    "aggs": {
+                        "min_ts": {"min": {"field": "@timestamp"}},
+                        "max_ts": {"max": {"field": "@timestamp"}}
+                    }
+                }
+            },
+            ignore_unavailable=True,
+            allow_no_indices=True
+        )
+        ranges = {}
+        for bucket in es_response_to_dict(response).get("aggregations", {}).get("by_index", {}).get("buckets", []):
+            min_ts, max_ts = bucket["min_ts"].get("value"), bucket["max_ts"].get("value")
+            if min_ts is not None and max_ts is not None:
+                ranges[bucket["key"]] = (int(min_ts), int(max_ts))
+        # 别名和data stream只用于展示，获取失败不影响索引裁剪
+        aliases, data_streams = await asyncio.gather(fetch_index_aliases(), fetch_data_streams(),
+                                                     return_exceptions=True)
+        for name, result in (("aliases", aliases), ("data_streams", data_streams)):
+            if isinstance(result, Exception):
+                log_event(logging.WARNING, "index_catalog_partial_refresh_failed", part=name, error=str(result))
+        index_catalog.load(
+            index_names, ranges, index_stats,
+            aliases=None if isinstance(aliases, Exception) else aliases,
+            data_streams=None if isinstance(data_streams, Exception) else data_streams
+        )
+        log_event(logging.INFO, "index_catalog_refreshed", **index_catalog.summary())
+    except Exception as e:
+        log_event(logging.WARNING, "index_catalog_refresh_failed", error=str(e))
+
+
+# 提示词中注入的实际字段取值：定期对最近数据做terms采样
+TOP_VALUES_REFRESH_INTERVAL = int(os.getenv("TOP_VALUES_REFRESH_INTERVAL", "600"))  # 0表示不采样
+TOP_VALUES_FIELDS = [f.strip() for f in os.getenv(
+    "TOP_VALUES_FIELDS", "service.name,transaction.name,service.environment,host.name,error.exception.type"
+).split(",") if f.strip()]
+TOP_VALUES_SIZE = int(os.getenv("TOP_VALUES_SIZE", "20"))  # 每个字段保留的取值数
+TOP_VALUES_WINDOW = os.getenv("TOP_VALUES_WINDOW", "now-24h")  # 采样的时间窗口
+TOP_VALUES_MAX_LABEL_FIELDS = int(os.getenv("TOP_VALUES_MAX_LABEL_FIELDS", "10"))  # 额外采样的labels.*字段数
+PROMPT_SCHEMA_MAX_BYTES = int(os.getenv("PROMPT_SCHEMA_MAX_BYTES", "3000"))  # 注入提示词的字段取值字节预算
+QUERY_TOKEN_PATTERN = re.compile(r'[A-Za-z0-9_.\-/:]{3,}')
+
+
+def top_values_fields() -> List[str]:
+    """要采样的字段：配置的字段 + 映射中发现的keyword类型labels.*字段"""
+    fields = list(TOP_VALUES_FIELDS)
+    if field_index_map.has_mappings:
+        fields = [f for f in fields if field_index_map.data_types_for(f)]
+        labels = sorted(f for f, types in field_index_map.data_types.items()
+                        if f.startswith("labels.") and "keyword" in types)
+        fields += labels[:TOP_VALUES_MAX_LABEL_FIELDS]
+    return fields
+
+
+class TopValuesCache:
+    """各字段最近出现最多的取值，用于提示词中的数据参考"""
+
+    def __init__(self):
+        self.values: Dict[str, List[tuple]] = {}  # {字段: [(取值, 文档数)]}，按文档数降序
+        self.refreshed_at: Optional[float] = None
+
+    def load(self, aggregations: Dict[str, Any]):
+        values = {}
+        for field, agg in aggregations.items():
+            buckets = [(str(b.get("key")), b.get("doc_count", 0)) for b in agg.get("buckets", [])]
+            if buckets:
+                values[field] = buckets
+        self.values = values
+        self.refreshed_at = time.time()
+
+    def build_prompt_context(self, query: str, max_bytes: int = PROMPT_SCHEMA_MAX_BYTES) -> str:
+        """选出与查询相关的字段和取值，在字节预算内生成提示词片段；没有采样数据时返回空串"""
+        if not self.values or max_bytes <= 0:
+            return ""
+        query_lower = query.lower()
+        tokens = {t.lower() for t in QUERY_TOKEN_PATTERN.findall(query)}
+
+        # 查询中提到的取值（完整出现，或查询中的词是取值的一部分）
+        mentioned = []
+        for field, buckets in self.values.items():
+            matches = [value for value, _ in buckets
+                       if value.lower() in query_lower or any(token in value.lower() for token in tokens)]
+            # 查询中的词过于宽泛(匹配大量取值)时只保留文档数最多的几个
+            mentioned.extend(f"{field}: {json.dumps(value, ensure_ascii=False)}" for value in matches[:5])
+
+        # 字段的常见取值，字段名出现在查询中的优先
+        def relevance(field: str) -> tuple:
+            name = field.rsplit(".", 1)[-1].lower()
+            return (name not in query_lower and field.lower() not in query_lower,
+                    TOP_VALUES_FIELDS.index(field) if field in TOP_VALUES_FIELDS else len(TOP_VALUES_FIELDS))
+
+        common = [f"{field}: {', '.join(value for value, _ in self.values[field])}"
+                  for field in sorted(self.values, key=relevance)]
+
+        header = "\n=== 实际数据参考（最近数据采样） ===\n"
+        footer = "请只使用以上存在的字段和取值，不要臆造服务名、接口名或标签；用户描述与取值不完全一致时选最接近的取值。\n"
+        lines: List[str] = []
+        budget = max_bytes - len(header.encode()) - len(footer.encode())
+        for title, items in (("查询中提到的取值:", mentioned), ("常见取值（按文档数降序）:", common)):
+            section = [title]
+            for item in items:
+                section.append(item)
+                size = len("\n".join(lines + section).encode())
+                if size > budget:
+                    section.pop()
+                    # 截断过长的取值列表，至少保留字段名和前几个取值
+                    room = budget - len("\n".join(lines + section).encode()) - 1
+                    if room > 40:
+                        section.append(item.encode()[:room - 3].decode(errors="ignore") + "...")
+                    break
+            if len(section) > 1:
+                lines.extend(section)
+        if not lines:
+            return ""
+        return header + "\n".join(lines) + "\n" + footer
+
+
+top_values_cache = TopValuesCache()
+
+
+async def refresh_top_values():
+    """对最近数据做一次terms采样，刷新各字段的常见取值"""
+    fields = top_values_fields()
+    if not fields:
+        return
+    try:
+        response = await es_client.search(
+            index="apm-*",
+            size=0,
+            query={"range": {"@timestamp": {"gte": TOP_VALUES_WINDOW}}},
+            aggs={field: {"terms": {"field": field, "size": TOP_VALUES_SIZE}} for field in fields},
+            timeout=f"{int(ES_DEFAULT_QUERY_TIMEOUT)}s",
+            ignore_unavailable=True,
+            allow_no_indices=True
+        )
+        top_values_cache.load(es_response_to_dict(response).get("aggregations", {}))
+        log_event(logging.INFO, "top_values_refreshed", fields=len(top_values_cache.values))
+    except Exception as e:
+        log_event(logging.WARNING, "top_values_refresh_failed", error=str(e))
 
-    if 'error' in dsl_str:
-        return APM_SCHEMA["error_index"]
-    elif 'transaction' in dsl_str or 'duration' in dsl_str:
-        return APM_SCHEMA["transaction_index"]
-    else:
-        return APM_SCHEMA["transaction_index"]  # 默认使用transaction索引
+
+def resolve_target_indices(dsl: Dict[Any, Any]) -> str:
+    """确定实际要查询的索引：先按字段选出索引模式，再按时间窗口裁剪到具体索引"""
+    index_pattern = determine_index_pattern(dsl)
+    if INDEX_CATALOG_REFRESH_INTERVAL <= 0:
+        return index_pattern
+
+    time_range = extract_query_time_range(dsl)
+    if time_range is None:
+        return index_pattern
+
+    event_type = next(t for t in APM_EVENT_TYPES if APM_SCHEMA[f"{t}_index"] == index_pattern)
+    selected = index_catalog.overlapping(event_type, *time_range)
+    if not selected or len(selected) > INDEX_PRUNING_MAX_INDICES:
+        return index_pattern
+    return ",".join(selected)
 
 
 def process_aggregation_results(aggs: Dict[Any, Any], query_type: str) -> str:
@@ -667,28 +3185,29 @@ def process_aggregation_results(aggs: Dict[Any, Any], query_type: str) -> str:
         return f"聚合结果处理失败: {str(e)}"
 
 
-def generate_analysis_prompt(original_query: str, es_results: Dict[Any, Any], query_type: str) -> str:
-    """生成结果分析提示词给LLM"""
+# 分析提示词的结果裁剪配置
+ANALYSIS_MAX_BUCKETS = int(os.getenv("ANALYSIS_MAX_BUCKETS", "20"))  # terms等分桶聚合保留的前N个桶
+ANALYSIS_MAX_HISTOGRAM_POINTS = int(os.getenv("ANALYSIS_MAX_HISTOGRAM_POINTS", "60"))  # 直方图最多保留的点数
+ANALYSIS_MAX_HITS = int(os.getenv("ANALYSIS_MAX_HITS", "5"))  # 原始文档/top_hits最多保留条数
+ANALYSIS_PROMPT_MAX_BYTES = int(os.getenv("ANALYSIS_PROMPT_MAX_BYTES", "32000"))  # 分析提示词最大字节数
 
-    # 提取关键信息
-    hits = es_results.get('hits', {})
-    total = hits.get('total', {}).get('value', 0)
-    aggregations = es_results.get('aggregations', {})
-    took = es_results.get('took', 0)
+# 结果中对分析没有帮助的元数据字段
+RESULT_METADATA_KEYS = {'_shards', 'meta', 'doc_count_error_upper_bound', '_index', '_id', '_score',
+                        '_ignored', '_routing', '_version', '_seq_no', '_primary_term', 'sort'}
 
-    prompt = f"""
+ANALYSIS_PROMPT_TEMPLATE_V1 = """
 你是一个APM数据分析专家。用户询问了关于系统性能的问题，我已经执行了Elasticsearch查询并获得了结果。请根据查询结果给出专业的分析和建议。
 
-用户原始问题: {original_query}
+用户原始问题: ${original_query}
 
 查询结果概述:
-- 查询耗时: {took}ms
-- 总记录数: {total}
-- 查询类型: {query_type}
+- 查询耗时: ${took}ms
+- 总记录数: ${total}
+- 查询类型: ${query_type}
 
 详细查询结果:
-{json.dumps(es_results, ensure_ascii=False, indent=2)}
-
+${results}
+${truncation_note}
 请根据以上结果提供:
 1. 直接回答用户的问题
 2. 关键数据的解读和分析
@@ -697,39 +3216,361 @@ def generate_analysis_prompt(original_query: str, es_results: Dict[Any, Any], qu
 
 分析回复:
 """
-    return prompt
 
+register_prompt_template("analysis", "v1", ANALYSIS_PROMPT_TEMPLATE_V1)
+
+
+def is_histogram_buckets(buckets: List[Dict[Any, Any]]) -> bool:
+    """判断是否为(date_)histogram的桶：数值key严格递增，且带key_as_string(日期直方图)或间隔规则(数值直方图)；
+    数值字段上的terms桶(如HTTP状态码)按doc_count排序、间隔不规则，不能合并"""
+    keys = [b.get('key') for b in buckets]
+    if not all(isinstance(k, (int, float)) and not isinstance(k, bool) for k in keys):
+        return False
+    if any(b >= a for a, b in zip(keys[1:], keys)):
+        return False
+    if len(keys) < 2 or all('key_as_string' in b for b in buckets):
+        return True
+    # min_doc_count>0时直方图会缺少空桶，间隔是最小间隔的整数倍
+    gaps = [b - a for a, b in zip(keys, keys[1:])]
+    step = min(gaps)
+    return all(abs(gap / step - round(gap / step)) < 1e-9 for gap in gaps)
+
+
+def merge_histogram_buckets(group: List[Dict[Any, Any]]) -> Dict[Any, Any]:
+    """合并相邻的直方图桶：doc_count求和，单值指标按doc_count加权平均"""
+    total_docs = sum(b.get('doc_count', 0) for b in group)
+    merged = {k: group[0][k] for k in ('key', 'key_as_string') if k in group[0]}
+    merged['doc_count'] = total_docs
+    merged['merged_buckets'] = len(group)
+
+    for name, value in group[0].items():
+        if not isinstance(value, dict) or name in merged:
+            continue
+        if 'value' in value:
+            weighted = [(b[name].get('value'), b.get('doc_count', 0)) for b in group
+                        if isinstance(b.get(name), dict) and isinstance(b[name].get('value'), (int, float))]
+            weight = sum(w for _, w in weighted)
+            if weighted:
+                avg = sum(v * w for v, w in weighted) / weight if weight else sum(v for v, _ in weighted) / len(weighted)
+                merged[name] = {'value': round(avg, 4)}
+            else:
+                merged[name] = {'value': None}
+        elif 'doc_count' in value and 'buckets' not in value:
+            merged[name] = {'doc_count': sum(b.get(name, {}).get('doc_count', 0) for b in group)}
+        else:
+            # 其他嵌套结构取样本最多的桶作为代表
+            peak = max(group, key=lambda b: b.get('doc_count', 0))
+            merged[name] = peak.get(name, value)
+    return merged
+
+
+def reduce_hits(hits: Dict[Any, Any], max_hits: int, path: str, report: Dict[str, Any]) -> Dict[Any, Any]:
+    """只保留前N条文档的_source"""
+    docs = hits.get('hits', []) or []
+    reduced = {'total': hits.get('total')} if 'total' in hits else {}
+    if docs:
+        reduced['hits'] = [d.get('_source', d) for d in docs[:max_hits]]
+        if len(docs) > max_hits:
+            report['truncated'].append(f"{path}: 文档 {len(docs)} → {max_hits}")
+    return reduced
+
+
+def reduce_aggregation(node: Any, path: str, limits: Dict[str, int], report: Dict[str, Any]) -> Any:
+    """递归裁剪聚合结果：保留前N个桶、对直方图降采样、去掉元数据"""
+    if isinstance(node, list):
+        return [reduce_aggregation(item, path, limits, report) for item in node]
+    if not isinstance(node, dict):
+        return node
+
+    result = {}
+    for key, value in node.items():
+        if key in RESULT_METADATA_KEYS:
+            continue
+        child_path = f"{path}.{key}" if path else key
+
+        if key == 'buckets' and isinstance(value, list) and value:
+            buckets = value
+            if is_histogram_buckets(buckets) and len(buckets) > limits['points']:
+                step = -(-len(buckets) // limits['points'])
+                buckets = [merge_histogram_buckets(buckets[i:i + step]) for i in range(0, len(buckets), step)]
+                report['truncated'].append(f"{child_path}: 直方图 {len(value)} 个点 → {len(buckets)} 个(每{step}个合并)")
+            elif not is_histogram_buckets(buckets) and len(buckets) > limits['buckets']:
+                dropped = buckets[limits['buckets']:]
+                buckets = buckets[:limits['buckets']]
+                result['sum_other_doc_count'] = node.get('sum_other_doc_count', 0) + \
+                    sum(b.get('doc_count', 0) for b in dropped)
+                report['truncated'].append(f"{child_path}: 桶 {len(value)} → {len(buckets)}")
+            result[key] = [reduce_aggregation(b, child_path, limits, report) for b in buckets]
+        elif key == 'buckets' and isinstance(value, dict):
+            # filters等keyed桶
+            result[key] = {k: reduce_aggregation(v, f"{child_path}.{k}", limits, report) for k, v in value.items()}
+        elif key == 'hits' and isinstance(value, dict):
+            result[key] = reduce_hits(value, limits['hits'], child_path, report)
+        elif key == 'sum_other_doc_count' and 'sum_other_doc_count' in result:
+            continue
+        else:
+            result[key] = reduce_aggregation(value, child_path, limits, report)
+    return result
+
+
+def reduce_es_results(es_results: Dict[Any, Any], max_buckets: int = ANALYSIS_MAX_BUCKETS,
+                      max_points: int = ANALYSIS_MAX_HISTOGRAM_POINTS,
+                      max_hits: int = ANALYSIS_MAX_HITS) -> tuple[Dict[Any, Any], Dict[str, Any]]:
+    """将ES响应裁剪为适合放入提示词的摘要，返回 (摘要, 裁剪报告)"""
+    limits = {'buckets': max(1, max_buckets), 'points': max(1, max_points), 'hits': max(0, max_hits)}
+    report: Dict[str, Any] = {'truncated': [], 'limits': limits}
+
+    reduced: Dict[Any, Any] = {}
+    for key in ('took', 'timed_out'):
+        if key in es_results:
+            reduced[key] = es_results[key]
+    if isinstance(es_results.get('hits'), dict):
+        reduced['hits'] = reduce_hits(es_results['hits'], limits['hits'], 'hits', report)
+    if es_results.get('aggregations'):
+        reduced['aggregations'] = reduce_aggregation(es_results['aggregations'], 'aggregations', limits, report)
+
+    # 嵌套在桶内的同类裁剪只保留一条记录并计数
+    counts = OrderedDict()
+    for note in report['truncated']:
+        counts[note] = counts.get(note, 0) + 1
+    report['truncated'] = [note if n == 1 else f"{note} (共{n}处)" for note, n in counts.items()]
+    return reduced, report
+
+
+def build_analysis_results_text(es_results: Dict[Any, Any], max_bytes: int) -> tuple[str, Dict[str, Any]]:
+    """在字节预算内生成结果文本：逐步收紧桶数/点数，仍超出时截断"""
+    max_buckets, max_points, max_hits = ANALYSIS_MAX_BUCKETS, ANALYSIS_MAX_HISTOGRAM_POINTS, ANALYSIS_MAX_HITS
+    while True:
+        reduced, report = reduce_es_results(es_results, max_buckets, max_points, max_hits)
+        text = json.dumps(reduced, ensure_ascii=False, separators=(',', ':'), default=str)
+        size = len(text.encode('utf-8'))
+        if size <= max_bytes or (max_buckets <= 1 and max_points <= 1 and max_hits <= 0):
+            break
+        max_buckets, max_points, max_hits = max(1, max_buckets // 2), max(1, max_points // 2), max_hits // 2
+
+    if size > max_bytes:
+        marker = '...(已截断)'
+        room = max_bytes - len(marker.encode('utf-8'))
+        if room > 0:
+            text = text.encode('utf-8')[:room].decode('utf-8', errors='ignore') + marker
+            report['truncated'].append(f"结果文本超过预算，已截断到 {max_bytes} 字节")
+        else:
+            text = ''
+            report['truncated'].append("字节预算不足以容纳结果，已省略结果")
+    report['result_bytes'] = len(text.encode('utf-8'))
+    return text, report
 
-def extract_json_from_markdown(content: str) -> Dict[Any, Any]:
-    """从Markdown格式中提取JSON"""
-    import json
-
-    # 去除可能的markdown代码块
-    content = content.strip()
-
-    # 处理 ```json 格式
-    if '```json' in content:
-        json_part = content.split('```json')[1].split('```')[0].strip()
-    # 处理 ``` 格式
-    elif '```' in content:
-        json_part = content.split('```')[1].split('```')[0].strip()
-    # 处理纯JSON
-    else:
-        json_part = content.strip()
 
-    # 尝试解析JSON
-    try:
-        return json.loads(json_part)
-    except json.JSONDecodeError as e:
-        # 尝试修复常见的JSON问题
-        json_part = json_part.replace('，', ',').replace('：', ':')  # 中文标点
-        json_part = re.sub(r',\s*}', '}', json_part)  # 移除末尾逗号
-        json_part = re.sub(r',\s*]', ']', json_part)  # 移除末尾逗号
+ANALYSIS_TRUNCATION_NOTE = "\n注意：为控制长度，以上结果已做摘要（保留前若干个分桶、时间序列已合并降采样），请基于摘要进行分析。\n"
+
+
+def generate_analysis_prompt(original_query: str, es_results: Dict[Any, Any], query_type: str,
+                             max_bytes: Optional[int] = None,
+                             version: Optional[str] = None) -> tuple[str, Dict[str, Any]]:
+    """生成结果分析提示词给LLM，返回 (提示词, 裁剪报告)"""
+
+    # 提取关键信息
+    hits = es_results.get('hits', {})
+    # track_total_hits=false时ES不返回总数
+    total = hits['total'].get('value', 0) if isinstance(hits.get('total'), dict) else "未统计"
+    took = es_results.get('took', 0)
 
+    template = get_prompt_template("analysis", version)
+    budget = max_bytes or ANALYSIS_PROMPT_MAX_BYTES
+    # 预留模板静态部分、概述字段和裁剪说明的空间，其余留给结果文本
+    reserved = len(template.render(original_query=original_query, took=took, total=total, query_type=query_type,
+                                   results='', truncation_note=ANALYSIS_TRUNCATION_NOTE).encode('utf-8'))
+    results_text, report = build_analysis_results_text(es_results, max(0, budget - reserved))
+    if reserved > budget:
+        report['truncated'].append(f"字节预算 {budget} 小于提示词模板和查询本身({reserved} 字节)")
+
+    truncation_note = ANALYSIS_TRUNCATION_NOTE if report['truncated'] else ""
+
+    prompt = template.render(
+        original_query=original_query,
+        took=took,
+        total=total,
+        query_type=query_type,
+        results=results_text,
+        truncation_note=truncation_note
+    )
+    report['prompt_bytes'] = len(prompt.encode('utf-8'))
+    return prompt, report
+
+
+# 字符串外的全角标点
+FULLWIDTH_PUNCTUATION = {'，': ',', '：': ':', '｛': '{', '｝': '}', '［': '[', '］': ']'}
+# 字符串起始引号 → 可以结束该字符串的引号
+STRING_QUOTES = {'"': '"', "'": "'", '“': '”"', '‘': '’\''}
+JSON_CLOSERS = {'{': '}', '[': ']'}
+PYTHON_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+JSON_REPAIR_NAMES = {
+    "quote": "单引号/全角引号字符串改为双引号",
+    "control_char": "转义字符串中的换行等控制字符",
+    "comment": "移除注释",
+    "fullwidth": "字符串外的全角标点改为半角",
+    "trailing_comma": "移除末尾逗号",
+    "mismatched_bracket": "修正不匹配的括号",
+    "python_literal": "True/False/None 改为 true/false/null",
+    "truncated": "补全被截断的JSON",
+}
+
+
+def _last_token_index(tokens: List[str]) -> int:
+    """最后一个非空白token的位置，没有时返回-1"""
+    for i in range(len(tokens) - 1, -1, -1):
+        if not tokens[i].isspace():
+            return i
+    return -1
+
+
+def _drop_trailing_comma(tokens: List[str], repairs: List[str]):
+    index = _last_token_index(tokens)
+    if index >= 0 and tokens[index] == ',':
+        del tokens[index:]
+        repairs.append("trailing_comma")
+
+
+def scan_json_object(text: str, start: int) -> tuple:
+    """从start处的左括号开始单遍扫描一个JSON值，只在字符串外做修复；
+    返回 (结束位置, 修复后的文本, 修复项列表, 是否完整闭合)"""
+    tokens: List[str] = []
+    repairs: List[str] = []
+    stack: List[str] = []
+    i, n = start, len(text)
+    while i < n:
+        ch = text[i]
+        if ch in STRING_QUOTES:
+            closers = STRING_QUOTES[ch]
+            if ch != '"':
+                repairs.append("quote")
+            chars = ['"']
+            j = i + 1
+            while j < n and text[j] not in closers:
+                c = text[j]
+                if c == '\\' and j + 1 < n:
+                    # 单引号字符串中的 \' 在JSON中不需要转义
+                    chars.append(text[j + 1] if text[j + 1] == "'" and ch != '"' else text[j:j + 2])
+                    j += 2
+                    continue
+                if c == '"':
+                    chars.append('\\"')
+                elif c < ' ':
+                    chars.append(json.dumps(c)[1:-1])
+                    repairs.append("control_char")
+                else:
+                    chars.append(c)
+                j += 1
+            if j >= n:
+                break  # 字符串被截断，不完整的值丢弃
+            chars.append('"')
+            tokens.append(''.join(chars))
+            i = j + 1
+            continue
+        if ch == '/' and text.startswith('//', i):
+            end = text.find('\n', i)
+            i = n if end < 0 else end
+            repairs.append("comment")
+            continue
+        if ch == '/' and text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+            repairs.append("comment")
+            continue
+        if ch == '`':
+            break  # 字符串外出现代码块围栏，说明对象在代码块内被截断
+        if ch in FULLWIDTH_PUNCTUATION:
+            ch = FULLWIDTH_PUNCTUATION[ch]
+            repairs.append("fullwidth")
+        if ch in JSON_CLOSERS:
+            stack.append(ch)
+            tokens.append(ch)
+        elif ch in '}]':
+            _drop_trailing_comma(tokens, repairs)
+            if not stack:
+                break
+            opener = stack.pop()
+            if JSON_CLOSERS[opener] != ch:
+                repairs.append("mismatched_bracket")
+            tokens.append(JSON_CLOSERS[opener])
+            if not stack:
+                return i + 1, ''.join(tokens), repairs, True
+        elif ch.isalpha():
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == '_'):
+                j += 1
+            word = text[i:j]
+            if word in PYTHON_LITERALS:
+                word = PYTHON_LITERALS[word]
+                repairs.append("python_literal")
+            tokens.append(word)
+            i = j
+            continue
+        else:
+            tokens.append(ch)
+        i += 1
+
+    # 输出被截断：丢弃不完整的末尾键值，补齐括号
+    repairs.append("truncated")
+    _drop_trailing_comma(tokens, repairs)
+    index = _last_token_index(tokens)
+    if index >= 0 and tokens[index] == ':':
+        index = _last_token_index(tokens[:index])  # 没有值的键
+    elif not (index >= 0 and tokens[index].startswith('"') and stack and stack[-1] == '{'):
+        index = -1
+    if index >= 0:
+        previous = _last_token_index(tokens[:index])
+        if previous >= 0 and tokens[previous] in ('{', ','):
+            del tokens[index:]
+            _drop_trailing_comma(tokens, repairs)
+    tokens.extend(JSON_CLOSERS[opener] for opener in reversed(stack))
+    return n, ''.join(tokens), repairs, False
+
+
+def extract_json_with_repairs(content: str) -> tuple[Dict[Any, Any], List[str]]:
+    """从LLM输出中提取JSON对象：在任意文本(Markdown代码块、多段输出、截断输出)中找到最大的JSON对象，
+    返回 (对象, 修复说明列表)"""
+    text = content.strip()
+    try:
+        result = json.loads(text)
+        if isinstance(result, dict):
+            return result, []
+    except json.JSONDecodeError:
+        pass
+
+    # 逐个扫描顶层的左括号，已扫描过的对象内部不再作为候选起点
+    candidates = []
+    i = 0
+    while True:
+        starts = [pos for pos in (text.find('{', i), text.find('｛', i)) if pos >= 0]
+        if not starts:
+            break
+        start = min(starts)
+        end, repaired, repairs, complete = scan_json_object(text, start)
+        candidates.append((complete, len(repaired), repaired, repairs))
+        i = max(end, start + 1)
+
+    first_error = None
+    for complete, _, repaired, repairs in sorted(candidates, key=lambda c: (c[0], c[1]), reverse=True):
         try:
-            return json.loads(json_part)
-        except json.JSONDecodeError:
-            raise ValueError(f"无法解析JSON: {str(e)}")
+            result = json.loads(repaired)
+        except json.JSONDecodeError as e:
+            first_error = first_error or str(e)
+            continue
+        if not isinstance(result, dict):
+            continue
+        names = list(dict.fromkeys(repairs))
+        for name in names:
+            JSON_REPAIRS.labels(name).inc()
+        if names:
+            log_event(logging.INFO, "json_repaired", repairs=names)
+        return result, [JSON_REPAIR_NAMES[name] for name in names]
+    raise ValueError(f"无法解析JSON: {first_error or '未找到JSON对象'}")
+
+
+def extract_json_from_markdown(content: str) -> Dict[Any, Any]:
+    """从Markdown格式中提取JSON"""
+    return extract_json_with_repairs(content)[0]
 
 
 def determine_query_type(query: str) -> str:
@@ -747,24 +3588,403 @@ def determine_query_type(query: str) -> str:
 
 
 def determine_query_type_from_dsl(dsl: Dict[Any, Any]) -> str:
-    """从DSL确定查询类型"""
-    dsl_str = json.dumps(dsl).lower()
+    """从DSL引用的字段确定查询类型"""
+    analysis = analyze_dsl(dsl)
 
-    if 'duration' in dsl_str:
+    if any(field.endswith(('.duration.us', '.duration.sum.us')) for field in analysis.fields):
         return "performance"
-    elif 'error' in dsl_str:
+    elif 'error' in analysis.event_types or any(field.startswith('error.') for field in analysis.fields):
         return "error"
     else:
         return "general"
 
 
+def parse_time_analysis_result(content: str) -> Dict[str, Any]:
+    """解析并验证LLM返回的时间分析结果"""
+    # 从Markdown中提取JSON
+    with observe_stage("extract_json"):
+        analysis_result, repairs = extract_json_with_repairs(content)
+
+    # 验证必需字段
+    required_fields = ['time_range', 'reasoning', 'confidence']
+    for field in required_fields:
+        if field not in analysis_result:
+            raise ValueError(f"LLM返回结果缺少必需字段: {field}")
+
+    # 验证时间格式
+    time_range = analysis_result['time_range']
+    if not re.match(r'^\d+[mhdw]$', time_range) and time_range not in CALENDAR_TIME_RANGES:
+        raise ValueError(f"时间格式不正确: {time_range}")
+    if repairs:
+        analysis_result['repairs'] = repairs
+    return analysis_result
+
+
+def substitute_time_bounds(dsl: Dict[Any, Any], start_time: str, end_time: str) -> tuple[Dict[Any, Any], int]:
+    """把DSL中@timestamp范围和直方图边界的绝对时间替换为新的时间窗口，返回 (新DSL, 替换数)"""
+    result = copy.deepcopy(dsl)
+    replaced = 0
+
+    def is_absolute(value: Any) -> bool:
+        return not (isinstance(value, str) and value.startswith("now"))
+
+    def walk(node: Any):
+        nonlocal replaced
+        if isinstance(node, list):
+            for item in node:
+                walk(item)
+            return
+        if not isinstance(node, dict):
+            return
+        range_clause = node.get("range")
+        if isinstance(range_clause, dict) and isinstance(range_clause.get("@timestamp"), dict):
+            bounds = range_clause["@timestamp"]
+            for key, value in list(bounds.items()):
+                if key in ("gte", "gt", "from") and is_absolute(value):
+                    bounds[key] = start_time
+                    replaced += 1
+                elif key in ("lte", "lt", "to") and is_absolute(value):
+                    bounds[key] = end_time
+                    replaced += 1
+        for bounds_key in ("extended_bounds", "hard_bounds"):
+            bounds = node.get(bounds_key)
+            if isinstance(bounds, dict):
+                if "min" in bounds and is_absolute(bounds["min"]):
+                    bounds["min"] = start_time
+                    replaced += 1
+                if "max" in bounds and is_absolute(bounds["max"]):
+                    bounds["max"] = end_time
+                    replaced += 1
+        for value in node.values():
+            walk(value)
+
+    walk(result)
+    return result, replaced
+
+
+# 自然语言查询 → DSL 缓存：相同问题复用已验证的DSL，只替换时间边界，跳过LLM生成
+DSL_CACHE_ENABLED = os.getenv("DSL_CACHE_ENABLED", "true").lower() == "true"
+DSL_CACHE_MAX_ENTRIES = int(os.getenv("DSL_CACHE_MAX_ENTRIES", "1024"))
+DSL_CACHE_TTL = float(os.getenv("DSL_CACHE_TTL", "86400"))  # 条目有效期(秒)，字段映射变化后旧DSL自然过期
+DSL_CACHE_PROMOTE_AFTER = int(os.getenv("DSL_CACHE_PROMOTE_AFTER", "1"))  # 成功执行几次(结果非空)后才复用
+DSL_CACHE_EVENTS = Counter("text2dsl_dsl_cache_events_total", "查询→DSL缓存事件", ["event"])
+
+# 归一化时统一的同义词和去掉的虚词（英文词按完整单词匹配）
+EN_WORD = r'(?<![a-z])(?:{})(?![a-z])'
+QUERY_SYNONYMS = [
+    (re.compile(EN_WORD.format(r'slowest|slow|latency') + r'|响应时间|耗时|延迟|最慢|慢'), "慢"),
+    (re.compile(EN_WORD.format(r'errors?|exceptions?|failures?|failed') + r'|报错|异常|失败|错误'), "错误"),
+    (re.compile(EN_WORD.format(r'services?') + r'|应用|服务'), "服务"),
+    (re.compile(EN_WORD.format(r'endpoints?|apis?|interfaces?|transactions?') + r'|接口'), "接口"),
+    (re.compile(EN_WORD.format(r'requests?|calls?|traffic') + r'|调用|请求|流量'), "请求"),
+    (re.compile(EN_WORD.format(r'most|top') + r'|最多|排行|排名'), "最多"),
+    (re.compile(EN_WORD.format(r'which|what') + r'|哪个|哪些|什么'), "哪"),
+]
+QUERY_FILLER_PATTERN = re.compile(EN_WORD.format(r'show|list|the|of|in|is|are|me|a|an|has|have|with') +
+                                  r'|请|帮我|帮忙|查一下|查询|看看|看一下|一下|告诉我|吗|呢|吧|了|的|得|有')
+QUERY_FOLD_PATTERN = re.compile(r'[\W_]+')
+TIME_SPAN_CLASSES = [(3600, "1h"), (86400, "1d"), (7 * 86400, "7d"), (31 * 86400, "31d")]
+
+
+def normalize_query_text(query: str) -> str:
+    """归一化查询文本：全角转半角、小写、去掉时间表达、统一同义词、去掉标点空白和虚词"""
+    text = unicodedata.normalize("NFKC", query).lower()
+    for regex in [ABSOLUTE_RANGE_REGEX, SINGLE_UNIT_REGEX] + [r for r, _ in CALENDAR_REGEXES] + \
+            [r for r, _ in RELATIVE_REGEXES] + [r for r, _, _ in VAGUE_TIME_REGEXES] + \
+            [r for r, _ in BARE_RELATIVE_REGEXES]:
+        text = regex.sub(" ", text)
+    text = re.sub(EN_WORD.format(r'recent(?:ly)?|now|current(?:ly)?') + r'|最近|近期|过去|现在|当前', " ", text)
+    for regex, replacement in QUERY_SYNONYMS:
+        text = regex.sub(replacement, text)
+    text = QUERY_FILLER_PATTERN.sub(" ", text)
+    return QUERY_FOLD_PATTERN.sub("", text)
+
+
+def time_span_class(seconds: Optional[float]) -> str:
+    """时间跨度分档：跨度差别大时DSL的直方图间隔等也不同，不能复用"""
+    if seconds is None:
+        return "unknown"
+    for limit, name in TIME_SPAN_CLASSES:
+        if seconds <= limit * 1.01:
+            return name
+    return "long"
+
+
+def dsl_shape_hash(dsl: Dict[Any, Any]) -> str:
+    """去掉时间边界后的DSL结构指纹"""
+    shape, _ = substitute_time_bounds(dsl, "${start}", "${end}")
+    return hashlib.sha256(json.dumps(shape, sort_keys=True, ensure_ascii=False).encode()).hexdigest()[:16]
+
+
+class DSLMemoStore:
+    """查询指纹 → 已验证DSL，LRU淘汰；执行成功且结果非空才晋升为可复用，执行失败即失效"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.entries = LRUCache(max_entries, ttl)
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "promotions": 0, "invalidations": 0}
+
+    @staticmethod
+    def fingerprint(query: str, span_seconds: Optional[float], compare: Optional[str] = None) -> Optional[str]:
+        normalized = normalize_query_text(query)
+        if not normalized:
+            return None
+        parts = [determine_query_type(query), normalized, time_span_class(span_seconds), compare or ""]
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()[:32]
+
+    @staticmethod
+    def dsl_span_seconds(dsl: Dict[Any, Any]) -> Optional[float]:
+        if not isinstance(dsl, dict):
+            return None
+        time_range = extract_query_time_range(dsl)
+        if time_range is None or None in time_range:
+            return None
+        return (time_range[1] - time_range[0]) / 1000
+
+    def lookup(self, query: str, time_context: TimeContext) -> Optional[Dict[Any, Any]]:
+        """命中时返回替换为当前时间窗口的DSL副本"""
+        span = (time_context.end - time_context.start).total_seconds()
+        key = self.fingerprint(query, span, time_context.compare)
+        entry = self.entries.get(key) if key else None
+        if entry is None or entry["successes"] < DSL_CACHE_PROMOTE_AFTER:
+            self.stats["misses"] += 1
+            DSL_CACHE_EVENTS.labels("miss").inc()
+            return None
+        dsl, replaced = substitute_time_bounds(entry["dsl"], time_context.start.isoformat(),
+                                               time_context.end.isoformat())
+        if not replaced:
+            self.stats["misses"] += 1
+            DSL_CACHE_EVENTS.labels("miss").inc()
+            return None
+        entry["hits"] += 1
+        self.stats["hits"] += 1
+        DSL_CACHE_EVENTS.labels("hit").inc()
+        return dsl
+
+    def record_success(self, query: str, dsl: Dict[Any, Any], compare: Optional[str] = None):
+        """DSL执行成功且结果非空：新DSL入库，已有的同结构DSL累计成功次数"""
+        span = self.dsl_span_seconds(dsl)
+        key = self.fingerprint(query, span, compare) if span is not None else None
+        if key is None:
+            return
+        shape = dsl_shape_hash(dsl)
+        entry = self.entries.get(key)
+        if entry is not None and entry["shape"] == shape:
+            entry["successes"] += 1
+            if entry["successes"] == DSL_CACHE_PROMOTE_AFTER:
+                self.stats["promotions"] += 1
+                DSL_CACHE_EVENTS.labels("promote").inc()
+            return
+        self.entries.set(key, {"dsl": copy.deepcopy(dsl), "shape": shape, "successes": 1, "hits": 0,
+                               "stored_at": datetime.utcnow().isoformat()})
+        self.stats["stores"] += 1
+        DSL_CACHE_EVENTS.labels("store").inc()
+        if DSL_CACHE_PROMOTE_AFTER <= 1:
+            self.stats["promotions"] += 1
+            DSL_CACHE_EVENTS.labels("promote").inc()
+
+    def record_failure(self, query: str, dsl: Dict[Any, Any], compare: Optional[str] = None):
+        """同结构的DSL执行失败：删除缓存条目"""
+        span = self.dsl_span_seconds(dsl)
+        key = self.fingerprint(query, span, compare) if span is not None else None
+        entry = self.entries.get(key) if key else None
+        if entry is not None and entry["shape"] == dsl_shape_hash(dsl):
+            self.entries.delete(key)
+            self.stats["invalidations"] += 1
+            DSL_CACHE_EVENTS.labels("invalidate").inc()
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {**self.stats, "entries": len(self.entries),
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0}
+
+
+dsl_memo = DSLMemoStore(DSL_CACHE_MAX_ENTRIES, DSL_CACHE_TTL)
+
+
+def is_query_rejected_error(error: Exception) -> bool:
+    """ES因查询本身有误而拒绝(4xx)；超时、连接失败等与DSL无关的错误返回False"""
+    status = es_error_status(error)
+    return status is not None and 400 <= status < 500
+
+
+def has_nonempty_result(es_response: Dict[Any, Any]) -> bool:
+    """结果中有命中文档或非空的聚合桶"""
+    total = es_response.get("hits", {}).get("total")
+    if ((total.get("value") if isinstance(total, dict) else total) or 0) > 0:
+        return True
+    if es_response.get("hits", {}).get("hits"):
+        return True
+
+    def has_buckets(node: Any) -> bool:
+        if isinstance(node, dict):
+            buckets = node.get("buckets")
+            if buckets and any(b.get("doc_count", 1) > 0 for b in
+                               (buckets.values() if isinstance(buckets, dict) else buckets)):
+                return True
+            return any(has_buckets(v) for v in node.values() if isinstance(v, dict))
+        return False
+
+    return has_buckets(es_response.get("aggregations", {}))
+
+
+# LLM客户端配置
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "stub")  # stub / openai
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "")  # OpenAI兼容接口地址，如 http://llm:8000/v1
+LLM_API_KEY = os.getenv("LLM_API_KEY", "")
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+PIPELINE_MAX_DSL_ATTEMPTS = int(os.getenv("PIPELINE_MAX_DSL_ATTEMPTS", "2"))  # DSL生成失败时的最大尝试次数
+
+
+class LLMClient(ABC):
+    """LLM客户端接口：purpose 为 time_context / dsl / analysis，context 为生成提示词时使用的结构化变量"""
+
+    name = "base"
+
+    @abstractmethod
+    async def complete(self, prompt: str, purpose: str, context: Optional[Dict[str, Any]] = None) -> str:
+        ...
+
+    async def close(self):
+        pass
+
+
+class OpenAICompatibleLLMClient(LLMClient):
+    """调用OpenAI兼容的 /chat/completions 接口"""
+
+    name = "openai"
+
+    def __init__(self, base_url: str, api_key: str, model: str, timeout: float):
+        import httpx  # 仅在使用真实LLM时导入
+
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self._client = httpx.AsyncClient(base_url=base_url.rstrip("/"), headers=headers, timeout=timeout)
+        self.model = model
+
+    async def complete(self, prompt: str, purpose: str, context: Optional[Dict[str, Any]] = None) -> str:
+        response = await self._client.post("/chat/completions", json={
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0
+        })
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class StubLLMClient(LLMClient):
+    """离线LLM替身：根据查询类型返回固定的时间分析和DSL，用于测试和基准"""
+
+    name = "stub"
+
+    async def complete(self, prompt: str, purpose: str, context: Optional[Dict[str, Any]] = None) -> str:
+        context = context or {}
+        if purpose == "time_context":
+            time_range = {"error": "1h", "traffic": "1h"}.get(determine_query_type(context.get("query", "")), "15m")
+            return "```json\n" + json.dumps({
+                "time_range": time_range,
+                "reasoning": "离线替身根据查询类型给出的默认时间范围",
+                "confidence": "medium"
+            }, ensure_ascii=False) + "\n```"
+        if purpose == "dsl":
+            return "```json\n" + json.dumps(self.build_dsl(context), ensure_ascii=False) + "\n```"
+        return "离线替身：未调用真实LLM，以上为查询结果的分析提示词。"
+
+    @staticmethod
+    def build_dsl(context: Dict[str, Any]) -> Dict[str, Any]:
+        time_filter = {"range": {"@timestamp": {"gte": context.get("start_time", "now-15m"),
+                                                "lte": context.get("end_time", "now"),
+                                                "format": "strict_date_optional_time"}}}
+        query_type = determine_query_type(context.get("query", ""))
+        if query_type == "error":
+            return {
+                "size": 0,
+                "query": {"bool": {"filter": [time_filter]}},
+                "aggs": {"error_types": {"terms": {"field": "error.exception.type", "size": 10},
+                                         "aggs": {"affected_services": {"cardinality": {"field": "service.name"}}}}}
+            }
+        if query_type == "traffic":
+            return {
+                "size": 0,
+                "query": {"bool": {"filter": [time_filter]}},
+                "aggs": {"services": {"terms": {"field": "service.name", "size": 10},
+                                      "aggs": {"request_count": {"value_count": {"field": "@timestamp"}}}}}
+            }
+        return {
+            "size": 0,
+            "query": {"bool": {"filter": [time_filter]}},
+            "aggs": {"services": {"terms": {"field": "service.name", "size": 10, "order": {"avg_duration": "desc"}},
+                                  "aggs": {"avg_duration": {"avg": {"field": "transaction.duration.us"}}}}}
+        }
+
+
+_llm_client: Optional[LLMClient] = None
+
+
+def get_llm_client() -> LLMClient:
+    """按配置懒加载LLM客户端"""
+    global _llm_client
+    if _llm_client is None:
+        if LLM_PROVIDER == "openai" and LLM_BASE_URL:
+            _llm_client = OpenAICompatibleLLMClient(LLM_BASE_URL, LLM_API_KEY, LLM_MODEL, LLM_TIMEOUT)
+        else:
+            _llm_client = StubLLMClient()
+    return _llm_client
+
+
+async def request_context_middleware(request: Request, call_next):
+    """为每个请求设置关联ID和payload采样标记，并记录访问日志"""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+    sampled = request.headers.get("X-Debug-Payload") == "1" or random.random() < LOG_PAYLOAD_SAMPLE_RATE
+    id_token = request_id_var.set(request_id)
+    sampled_token = payload_sampled_var.set(sampled)
+    endpoint = endpoint_label(request.url.path)
+    in_flight = HTTP_IN_FLIGHT.labels(endpoint)
+    in_flight.inc()
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+        duration = time.perf_counter() - start
+        response.headers["X-Request-ID"] = request_id
+        HTTP_REQUEST_DURATION.labels(endpoint, request.method, str(response.status_code)).observe(duration)
+        content_length = response.headers.get("content-length")
+        if content_length is not None:
+            HTTP_RESPONSE_SIZE.labels(endpoint).observe(int(content_length))
+        log_event(
+            logging.INFO, "request_done",
+            method=request.method,
+            path=request.url.path,
+            status=response.status_code,
+            duration_ms=round(duration * 1000, 2)
+        )
+        return response
+    except Exception as e:
+        ERRORS.labels("internal").inc()
+        HTTP_REQUEST_DURATION.labels(endpoint, request.method, "500").observe(time.perf_counter() - start)
+        log_event(logging.ERROR, "request_failed", method=request.method, path=request.url.path, error=str(e))
+        raise
+    finally:
+        in_flight.dec()
+        request_id_var.reset(id_token)
+        payload_sampled_var.reset(sampled_token)
+
+
 # API 端点
-@app.post("/analyze-time-context", response_model=TimeContextResponse)
+@router.post("/analyze-time-context", response_model=TimeContextResponse)
 async def analyze_time_context(request: TimeContextRequest):
     """API: LLM上下文感知时间范围分析"""
     try:
+        # 先用规则提取，明确的时间表达不需要再经过LLM
+        with observe_stage("extract_time_range"):
+            extracted = extract_time_range(request.query, request.timezone)
+
         # 生成时间分析提示词
-        prompt = generate_time_context_prompt(request.query, request.timezone)
+        prompt = generate_time_context_prompt(request.query, request.timezone, request.prompt_version)
 
         # 确定查询类型
         query_type = determine_query_type(request.query)
@@ -772,78 +3992,234 @@ async def analyze_time_context(request: TimeContextRequest):
         return TimeContextResponse(
             prompt=prompt,
             query_type=query_type,
-            original_query=request.query
+            original_query=request.query,
+            detected_time_range=extracted["time_range"],
+            confidence=extracted["confidence"],
+            reasoning=extracted["reasoning"],
+            needs_llm=extracted["confidence"] != "high"
         )
 
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"时间上下文分析失败: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"时间上下文分析失败: {str(e)}")
 
 
-@app.post("/process-time-analysis", response_model=TimeAnalysisResponse)
+@router.post("/extract-time-range", response_model=TimeAnalysisResponse)
+async def extract_time_range_api(request: TimeContextRequest):
+    """API: 规则提取时间范围，返回格式与 /process-time-analysis 相同；置信度低时time_range为默认值15m"""
+    with observe_stage("extract_time_range"):
+        extracted = extract_time_range(request.query, request.timezone)
+    return TimeAnalysisResponse(
+        time_range=extracted["time_range"] or "15m",
+        reasoning=extracted["reasoning"],
+        confidence=extracted["confidence"],
+        original_query=request.query
+    )
+
+
+@router.post("/process-time-analysis", response_model=TimeAnalysisResponse)
 async def process_time_analysis(request: MarkdownRequest):
     """API: 处理LLM返回的时间分析结果"""
     try:
-        # 从Markdown中提取JSON
-        analysis_result = extract_json_from_markdown(request.content)
-
-        # 验证必需字段
-        required_fields = ['time_range', 'reasoning', 'confidence']
-        for field in required_fields:
-            if field not in analysis_result:
-                raise ValueError(f"LLM返回结果缺少必需字段: {field}")
-
-        # 验证时间格式
-        time_range = analysis_result['time_range']
-        if not re.match(r'^\d+[mhd]$', time_range):
-            raise ValueError(f"时间格式不正确: {time_range}")
+        analysis_result = parse_time_analysis_result(request.content)
 
         return TimeAnalysisResponse(
             time_range=analysis_result['time_range'],
             reasoning=analysis_result['reasoning'],
             confidence=analysis_result['confidence'],
-            original_query=analysis_result.get('original_query', '')
+            original_query=analysis_result.get('original_query', ''),
+            repairs=analysis_result.get('repairs', [])
         )
 
     except Exception as e:
+        ERRORS.labels("parse").inc()
         raise HTTPException(status_code=400, detail=f"时间分析结果处理失败: {str(e)}")
 
 
-@app.post("/generate-dsl", response_model=PromptResponse)
+@router.post("/generate-dsl", response_model=PromptResponse)
 async def generate_dsl(request: QueryRequest):
     """API 1: 根据用户查询生成提示词返回给Dify"""
     try:
-        # 使用传入的时间范围（可能来自LLM分析）
-        time_range = request.time_range
+        # 时间上下文每个请求只计算一次，提示词和时间信息共用
+        time_context = TimeContext(
+            request.time_range, request.timezone, request.start_time, request.end_time, request.compare
+        )
 
         # 生成提示词
-        prompt = generate_dsl_prompt(request.query, time_range, request.timezone)
+        with observe_stage("generate_dsl_prompt"):
+            prompt = generate_dsl_prompt(
+                request.query,
+                time_context.time_range,
+                time_context.timezone,
+                start_time=time_context.start,
+                end_time=time_context.end,
+                version=request.prompt_version,
+                comparison=time_context.comparison
+            )
 
         # 确定查询类型
         query_type = determine_query_type(request.query)
 
-        # 生成时间范围信息
-        start_time, end_time = parse_time_range(time_range, request.timezone)
-        time_info = f"{start_time.strftime('%Y-%m-%d %H:%M')} 到 {end_time.strftime('%Y-%m-%d %H:%M')} ({request.timezone})"
+        cached_dsl = None
+        if DSL_CACHE_ENABLED:
+            with observe_stage("dsl_cache_lookup"):
+                cached_dsl = dsl_memo.lookup(request.query, time_context)
+
+        comparison_info = None
+        if time_context.comparison is not None:
+            comparison_info = f"对比时间范围: {request.compare} ({time_context.describe_comparison()})"
 
         return PromptResponse(
             prompt=prompt,
             query_type=query_type,
-            time_range_info=f"时间范围: {time_range} ({time_info})",
-            schema_info=APM_SCHEMA
+            time_range_info=f"时间范围: {time_context.time_range} ({time_context.describe()})",
+            schema_info=get_schema_info(),
+            comparison_time_range_info=comparison_info,
+            cached_dsl=cached_dsl
         )
 
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"提示词生成失败: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"提示词生成失败: {str(e)}")
 
 
-@app.post("/execute-query", response_model=ExecuteResponse)
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
+
+
+def format_stream_event(event: str, data: Dict[str, Any], stream_format: str) -> str:
+    """将单个事件序列化为NDJSON行或SSE消息"""
+    payload = json.dumps({"event": event, **data}, ensure_ascii=False, default=str)
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {payload}\n\n"
+    return payload + "\n"
+
+
+async def stream_execute_query(request: DSLRequest) -> AsyncIterator[str]:
+    """流式执行查询：ES返回后立即输出元数据和聚合桶，结果发完后再生成并返回分析提示词"""
+    stream_format = request.stream
+    yield format_stream_event("start", {"original_query": request.original_query,
+                                        "request_id": request_id_var.get()}, stream_format)
+
+    try:
+        executed = await execute_query_stage(request)
+    except Exception as e:
+        # 响应头和start事件已发出，不能再改HTTP状态码，以error事件告知客户端
+        yield stream_error_event(e, stream_format)
+        yield format_stream_event("end", {"execution_success": False}, stream_format)
+        return
+    if isinstance(executed, ExecuteResponse):
+        # 执行前失败(解析、验证、成本拒绝、ES错误)，没有结果可输出
+        yield format_stream_event("metadata", {
+            "execution_success": False,
+            "error_message": executed.error_message,
+            "query_executed_at": executed.query_executed_at,
+            "optimizations": executed.optimizations,
+            "cost_estimate": executed.cost_estimate,
+            "validation_issues": executed.validation_issues
+        }, stream_format)
+        yield format_stream_event("end", {"execution_success": False}, stream_format)
+        return
+
+    es_results = executed.es_response
+    hits = es_results.get("hits") or {}
+    yield format_stream_event("metadata", {
+        "execution_success": True,
+        "error_message": None,
+        "query_executed_at": executed.executed_at,
+        "cache_hit": executed.cache_hit,
+        "took": es_results.get("took"),
+        "timed_out": es_results.get("timed_out"),
+        "total": hits.get("total"),
+        "optimizations": executed.optimizations,
+        "cost_estimate": executed.cost_estimate,
+        "validation_issues": executed.validation_issues or None
+    }, stream_format)
+
+    # 聚合结果按桶逐条输出，避免整体序列化
+    for name, agg in (es_results.get("aggregations") or {}).items():
+        buckets = agg.get("buckets") if isinstance(agg, dict) else None
+        if isinstance(buckets, list):
+            yield format_stream_event("aggregation", {
+                "name": name,
+                "bucket_count": len(buckets),
+                "meta": {k: v for k, v in agg.items() if k != "buckets"}
+            }, stream_format)
+            for index, bucket in enumerate(buckets):
+                yield format_stream_event("bucket", {"aggregation": name, "index": index, "bucket": bucket},
+                                          stream_format)
+        else:
+            yield format_stream_event("aggregation", {"name": name, "value": agg}, stream_format)
+
+    for index, hit in enumerate(hits.get("hits") or []):
+        yield format_stream_event("hit", {"index": index, "hit": hit}, stream_format)
+
+    try:
+        analysis_prompt, truncation_report = build_execution_prompt(request, es_results)
+    except Exception as e:
+        ERRORS.labels("analysis").inc()
+        yield stream_error_event(e, stream_format)
+        yield format_stream_event("end", {"execution_success": False}, stream_format)
+        return
+    yield format_stream_event("analysis_prompt", {"analysis_prompt": analysis_prompt,
+                                                  "truncation_report": truncation_report}, stream_format)
+    yield format_stream_event("end", {"execution_success": True}, stream_format)
+
+
+def stream_error_event(error: Exception, stream_format: str) -> str:
+    """流已开始后发生的异常转换为error事件"""
+    status_code = error.status_code if isinstance(error, HTTPException) else 500
+    message = error.detail if isinstance(error, HTTPException) else str(error)
+    log_event(logging.ERROR, "stream_execute_failed", status_code=status_code, error=str(message))
+    return format_stream_event("error", {"status_code": status_code, "error_message": message}, stream_format)
+
+
+@router.post("/execute-query", response_model=ExecuteResponse)
 async def execute_query(request: DSLRequest):
-    """API 2: 执行DSL查询并生成分析提示词返回给Dify"""
+    """API 2: 执行DSL查询并生成分析提示词返回给Dify（stream=ndjson/sse时流式返回）"""
+    if request.stream:
+        if request.stream not in STREAM_MEDIA_TYPES:
+            raise HTTPException(status_code=400, detail=f"不支持的流式格式: {request.stream}，可选: ndjson, sse")
+        return StreamingResponse(
+            stream_execute_query(request),
+            media_type=STREAM_MEDIA_TYPES[request.stream],
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    return await run_execute_query(request)
+
+
+class ExecutedQuery:
+    """已取得ES结果、尚未生成分析提示词的查询；流式返回时先输出结果，最后再生成提示词"""
+
+    def __init__(self, es_response: Dict[Any, Any], cache_hit: bool, optimizations: Optional[List[Dict[str, Any]]],
+                 cost_estimate: Optional[Dict[str, Any]], validation_issues: List[Dict[str, Any]]):
+        self.es_response = es_response
+        self.cache_hit = cache_hit
+        self.optimizations = optimizations
+        self.cost_estimate = cost_estimate
+        self.validation_issues = validation_issues
+        self.executed_at = datetime.utcnow().isoformat()
+
+
+async def run_execute_query(request: DSLRequest) -> ExecuteResponse:
+    """执行DSL查询的完整流程：解析、验证、优化、准入、执行、生成分析提示词"""
+    executed = await execute_query_stage(request)
+    if isinstance(executed, ExecuteResponse):
+        return executed
+    return complete_execute_response(request, executed)
+
+
+async def execute_query_stage(request: DSLRequest) -> Any:
+    """执行到取得ES结果为止：解析、验证、优化、准入、执行；返回ExecutedQuery，
+    在此之前失败时返回失败的ExecuteResponse"""
     try:
         # 获取查询体（支持dsl或query字段）
         try:
-            query_body = request.get_query_body()
+            with observe_stage("extract_query_body"):
+                query_body = request.get_query_body()
         except ValueError as e:
+            ERRORS.labels("parse").inc()
             return ExecuteResponse(
                 raw_results={},
                 analysis_prompt="",
@@ -852,6 +4228,7 @@ async def execute_query(request: DSLRequest):
                 error_message=f"输入格式错误: {str(e)}"
             )
         except Exception as e:
+            ERRORS.labels("parse").inc()
             return ExecuteResponse(
                 raw_results={},
                 analysis_prompt="",
@@ -861,89 +4238,510 @@ async def execute_query(request: DSLRequest):
             )
 
         # 验证DSL
-        is_valid, validation_msg = validate_dsl(query_body)
-        if not is_valid:
+        with observe_stage("validate_dsl"):
+            validation_issues = validate_dsl_detailed(query_body)
+        validation_errors = [issue for issue in validation_issues if issue["level"] == "error"]
+        if validation_errors:
+            ERRORS.labels("validation").inc()
+            if DSL_CACHE_ENABLED:
+                dsl_memo.record_failure(request.original_query, query_body, request.compare)
             return ExecuteResponse(
                 raw_results={},
                 analysis_prompt="",
                 query_executed_at=datetime.utcnow().isoformat(),
                 execution_success=False,
-                error_message=f"DSL验证失败: {validation_msg}"
+                error_message=f"DSL验证失败: {format_validation_issues(validation_errors)}",
+                validation_issues=validation_issues
             )
+        # 优化和降级前的DSL，用于查询→DSL缓存
+        validated_body = query_body
+
+        # 优化DSL
+        optimizations = None
+        if OPTIMIZER_ENABLED and request.optimize is not False:
+            with observe_stage("optimize_dsl"):
+                query_body, optimizations = optimize_dsl(query_body)
+
+        # 成本估算与准入控制
+        cost_estimate = None
+        if COST_CONTROL_ENABLED:
+            with observe_stage("estimate_cost"):
+                query_body, cost_estimate = admit_query(query_body, request.caller)
+            if cost_estimate["decision"] == "reject":
+                ERRORS.labels("cost").inc()
+                return ExecuteResponse(
+                    raw_results={},
+                    analysis_prompt="",
+                    query_executed_at=datetime.utcnow().isoformat(),
+                    execution_success=False,
+                    error_message=f"查询成本过高(估算{cost_estimate['cost']}，上限{cost_estimate['hard_limit']})，"
+                                  f"请缩小时间范围、增大时间间隔或减少分组数量",
+                    optimizations=optimizations,
+                    cost_estimate=cost_estimate
+                )
 
         # 执行ES查询
         try:
-            es_response = execute_es_query(query_body)
-
-            # 生成分析提示词
-            query_type = determine_query_type(request.original_query)
-            analysis_prompt = generate_analysis_prompt(
-                request.original_query,
-                es_response,
-                query_type
-            )
-
-            return ExecuteResponse(
-                raw_results=es_response,
-                analysis_prompt=analysis_prompt,
-                query_executed_at=datetime.utcnow().isoformat(),
-                execution_success=True
-            )
-
+            with observe_stage("es_query"):
+                es_response, cache_hit = await execute_es_query_cached(
+                    query_body,
+                    request.timeout,
+                    bypass_cache=bool(request.bypass_cache),
+                    heavy=bool(cost_estimate) and cost_estimate["decision"] == "queue"
+                )
         except Exception as e:
+            ERRORS.labels("es").inc()
+            if DSL_CACHE_ENABLED and is_query_rejected_error(e):
+                dsl_memo.record_failure(request.original_query, validated_body, request.compare)
             return ExecuteResponse(
                 raw_results={},
                 analysis_prompt="",
                 query_executed_at=datetime.utcnow().isoformat(),
                 execution_success=False,
-                error_message=str(e)  # 直接返回异常信息
+                error_message=str(e),  # 直接返回异常信息
+                optimizations=optimizations,
+                cost_estimate=cost_estimate
             )
 
+        if DSL_CACHE_ENABLED and has_nonempty_result(es_response):
+            dsl_memo.record_success(request.original_query, validated_body, request.compare)
+        return ExecutedQuery(es_response, cache_hit, optimizations, cost_estimate, validation_issues)
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查询处理失败: {str(e)}")
 
 
-@app.post("/clean-dsl", response_model=CleanResponse)
+def build_execution_prompt(request: DSLRequest, es_response: Dict[Any, Any]) -> tuple:
+    """为ES结果生成分析提示词，返回 (提示词, 截断报告)"""
+    query_type = determine_query_type(request.original_query)
+    with observe_stage("generate_analysis_prompt"):
+        return generate_analysis_prompt(
+            request.original_query,
+            es_response,
+            query_type,
+            max_bytes=request.analysis_max_bytes
+        )
+
+
+def complete_execute_response(request: DSLRequest, executed: ExecutedQuery) -> ExecuteResponse:
+    """生成分析提示词并组装成功响应；生成失败时返回失败响应"""
+    try:
+        analysis_prompt, truncation_report = build_execution_prompt(request, executed.es_response)
+        return ExecuteResponse(
+            raw_results=executed.es_response,
+            analysis_prompt=analysis_prompt,
+            query_executed_at=executed.executed_at,
+            execution_success=True,
+            cache_hit=executed.cache_hit,
+            truncation_report=truncation_report,
+            optimizations=executed.optimizations,
+            cost_estimate=executed.cost_estimate,
+            validation_issues=executed.validation_issues or None
+        )
+
+    except Exception as e:
+        ERRORS.labels("analysis").inc()
+        return ExecuteResponse(
+            raw_results={},
+            analysis_prompt="",
+            query_executed_at=datetime.utcnow().isoformat(),
+            execution_success=False,
+            error_message=str(e)  # 直接返回异常信息
+        )
+
+
+@router.post("/execute-queries", response_model=BatchExecuteResponse)
+async def execute_queries(request: BatchDSLRequest):
+    """API: 批量执行多个DSL查询（一次_msearch），每个查询独立返回结果和分析提示词"""
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="queries不能为空")
+    if len(request.queries) > ES_MSEARCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"单次批量查询最多{ES_MSEARCH_MAX_ITEMS}个DSL")
+
+    try:
+        results: List[Optional[ExecuteResponse]] = [None] * len(request.queries)
+        runnable: List[int] = []
+        bodies: List[Dict[Any, Any]] = []
+        validated_bodies: Dict[int, Dict[Any, Any]] = {}  # 优化和降级前的DSL，用于查询→DSL缓存
+        optimizations: Dict[int, List[str]] = {}
+        cost_estimates: Dict[int, Dict[str, Any]] = {}
+        warnings: Dict[int, List[Dict[str, Any]]] = {}  # 未阻止执行的校验问题，随结果返回
+
+        # 逐项解析和验证，失败项不影响其他查询
+        for i, item in enumerate(request.queries):
+            try:
+                with observe_stage("extract_query_body"):
+                    query_body = item.get_query_body()
+            except Exception as e:
+                ERRORS.labels("parse").inc()
+                results[i] = ExecuteResponse(
+                    raw_results={},
+                    analysis_prompt="",
+                    query_executed_at=datetime.utcnow().isoformat(),
+                    execution_success=False,
+                    error_message=f"输入格式错误: {str(e)}"
+                )
+                continue
+
+            with observe_stage("validate_dsl"):
+                validation_issues = validate_dsl_detailed(query_body)
+            validation_errors = [issue for issue in validation_issues if issue["level"] == "error"]
+            if validation_errors:
+                ERRORS.labels("validation").inc()
+                if DSL_CACHE_ENABLED:
+                    dsl_memo.record_failure(item.original_query, query_body, item.compare)
+                results[i] = ExecuteResponse(
+                    raw_results={},
+                    analysis_prompt="",
+                    query_executed_at=datetime.utcnow().isoformat(),
+                    execution_success=False,
+                    error_message=f"DSL验证失败: {format_validation_issues(validation_errors)}",
+                    validation_issues=validation_issues
+                )
+                continue
+            if validation_issues:
+                warnings[i] = validation_issues
+            validated_bodies[i] = query_body
+
+            if OPTIMIZER_ENABLED and item.optimize is not False:
+                with observe_stage("optimize_dsl"):
+                    query_body, optimizations[i] = optimize_dsl(query_body)
+
+            if COST_CONTROL_ENABLED:
+                with observe_stage("estimate_cost"):
+                    query_body, cost_estimates[i] = admit_query(query_body, item.caller)
+                if cost_estimates[i]["decision"] == "reject":
+                    ERRORS.labels("cost").inc()
+                    results[i] = ExecuteResponse(
+                        raw_results={},
+                        analysis_prompt="",
+                        query_executed_at=datetime.utcnow().isoformat(),
+                        execution_success=False,
+                        error_message=f"查询成本过高(估算{cost_estimates[i]['cost']}，"
+                                      f"上限{cost_estimates[i]['hard_limit']})",
+                        optimizations=optimizations.get(i),
+                        cost_estimate=cost_estimates[i]
+                    )
+                    continue
+
+            runnable.append(i)
+            bodies.append(query_body)
+
+        if bodies:
+            # 批量中任一查询超预算时，整个_msearch进入高成本队列
+            heavy = any(cost_estimates.get(i, {}).get("decision") == "queue" for i in runnable)
+            with observe_stage("es_msearch"):
+                outcomes = await execute_es_queries_cached(
+                    bodies, request.timeout, bool(request.bypass_cache), heavy,
+                    item_timeouts=[request.queries[i].timeout for i in runnable],
+                    item_bypass_cache=[bool(request.queries[i].bypass_cache) for i in runnable]
+                )
+
+            for i, (es_response, cache_hit) in zip(runnable, outcomes):
+                item = request.queries[i]
+                if isinstance(es_response, Exception):
+                    ERRORS.labels("es").inc()
+                    if DSL_CACHE_ENABLED and is_query_rejected_error(es_response):
+                        dsl_memo.record_failure(item.original_query, validated_bodies[i], item.compare)
+                    results[i] = ExecuteResponse(
+                        raw_results={},
+                        analysis_prompt="",
+                        query_executed_at=datetime.utcnow().isoformat(),
+                        execution_success=False,
+                        error_message=str(es_response),
+                        optimizations=optimizations.get(i),
+                        cost_estimate=cost_estimates.get(i)
+                    )
+                    continue
+
+                if DSL_CACHE_ENABLED and has_nonempty_result(es_response):
+                    dsl_memo.record_success(item.original_query, validated_bodies[i], item.compare)
+                query_type = determine_query_type(item.original_query)
+                with observe_stage("generate_analysis_prompt"):
+                    analysis_prompt, truncation_report = generate_analysis_prompt(
+                        item.original_query,
+                        es_response,
+                        query_type,
+                        max_bytes=item.analysis_max_bytes
+                    )
+                results[i] = ExecuteResponse(
+                    raw_results=es_response,
+                    analysis_prompt=analysis_prompt,
+                    query_executed_at=datetime.utcnow().isoformat(),
+                    execution_success=True,
+                    cache_hit=cache_hit,
+                    truncation_report=truncation_report,
+                    optimizations=optimizations.get(i),
+                    cost_estimate=cost_estimates.get(i),
+                    validation_issues=warnings.get(i)
+                )
+
+        succeeded = sum(1 for r in results if r.execution_success)
+        return BatchExecuteResponse(
+            results=results,
+            total=len(results),
+            succeeded=succeeded,
+            failed=len(results) - succeeded,
+            query_executed_at=datetime.utcnow().isoformat()
+        )
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"批量查询处理失败: {str(e)}")
+
+
+async def generate_pipeline_dsl(llm: LLMClient, request: PipelineRequest,
+                                time_context: TimeContext) -> Dict[str, Any]:
+    """让LLM生成DSL，解析或验证失败时带上错误信息重试"""
+    prompt = generate_dsl_prompt(request.query, time_context.time_range, time_context.timezone,
+                                 start_time=time_context.start, end_time=time_context.end,
+                                 version=request.prompt_version)
+    context = {"query": request.query, "timezone": time_context.timezone, "time_range": time_context.time_range,
+               "start_time": time_context.start.isoformat(), "end_time": time_context.end.isoformat()}
+    last_error = ""
+    for attempt in range(max(1, PIPELINE_MAX_DSL_ATTEMPTS)):
+        content = await llm.complete(
+            prompt if not last_error else f"{prompt}\n上一次生成的DSL有误：{last_error}\n请修正后只返回JSON：",
+            "dsl", context
+        )
+        try:
+            with observe_stage("extract_json"):
+                dsl = extract_json_from_markdown(content)
+            validation_errors = [issue for issue in validate_dsl_detailed(dsl) if issue["level"] == "error"]
+            if not validation_errors:
+                return dsl
+            # 机器可读的错误列表直接交给LLM修正
+            last_error = json.dumps(validation_errors, ensure_ascii=False)
+        except ValueError as e:
+            last_error = str(e)
+        log_event(logging.WARNING, "pipeline_dsl_retry", attempt=attempt + 1, error=last_error)
+    raise ValueError(f"LLM生成的DSL无效: {last_error}")
+
+
+async def run_pipeline(request: PipelineRequest, llm: LLMClient) -> PipelineResponse:
+    """服务端完成 时间分析 → DSL生成 → 执行 → 分析提示词 的完整流程"""
+    timings: Dict[str, float] = {}
+
+    def mark(stage: str, started: float):
+        timings[stage] = round((time.perf_counter() - started) * 1000, 2)
+        STAGE_DURATION.labels(f"pipeline_{stage}").observe(timings[stage] / 1000)
+
+    query_type = determine_query_type(request.query)
+    time_analysis = None
+    # 整个流程共用同一个“当前时间”，推测DSL和最终时间窗口对齐
+    now = current_time(resolve_timezone(request.timezone))
+
+    # 规则能明确识别时间表达时，跳过LLM时间分析
+    if not request.time_range:
+        started = time.perf_counter()
+        extracted = extract_time_range(request.query, request.timezone, now)
+        mark("extract_time_range", started)
+        if extracted["confidence"] == "high":
+            time_analysis = {k: extracted[k] for k in ("time_range", "reasoning", "confidence")}
+            time_analysis["source"] = "rules"
+
+    dsl_cache_hit = False
+
+    def lookup_cached_dsl(context: TimeContext) -> Optional[Dict[str, Any]]:
+        if not DSL_CACHE_ENABLED:
+            return None
+        started = time.perf_counter()
+        cached = dsl_memo.lookup(request.query, context)
+        mark("dsl_cache_lookup", started)
+        return cached
+
+    if request.time_range or time_analysis:
+        time_context = TimeContext(request.time_range or time_analysis["time_range"], request.timezone, now=now)
+        dsl = lookup_cached_dsl(time_context)
+        dsl_cache_hit = dsl is not None
+        if dsl is None:
+            started = time.perf_counter()
+            dsl = await generate_pipeline_dsl(llm, request, time_context)
+            mark("generate_dsl", started)
+    else:
+        # 时间分析和DSL生成互不依赖：先按默认时间范围并行生成DSL，时间分析返回后再替换时间边界
+        speculative = TimeContext("15m", request.timezone, now=now)
+        cached_dsl = lookup_cached_dsl(speculative)
+        started = time.perf_counter()
+
+        async def analyze_time() -> Dict[str, Any]:
+            content = await llm.complete(
+                generate_time_context_prompt(request.query, request.timezone, request.prompt_version),
+                "time_context", {"query": request.query, "timezone": request.timezone}
+            )
+            return parse_time_analysis_result(content)
+
+        if cached_dsl is not None:
+            # 缓存命中时只需要时间分析
+            time_result = (await asyncio.gather(analyze_time(), return_exceptions=True))[0]
+            dsl_result = cached_dsl
+        else:
+            time_result, dsl_result = await asyncio.gather(
+                analyze_time(),
+                generate_pipeline_dsl(llm, request, speculative),
+                return_exceptions=True
+            )
+        mark("time_analysis_and_dsl", started)
+        if isinstance(time_result, Exception):
+            log_event(logging.WARNING, "pipeline_time_analysis_failed", error=str(time_result))
+            time_context = speculative
+        else:
+            time_analysis = {**time_result, "source": "llm"}
+            time_context = speculative.with_range(time_result["time_range"])
+
+        dsl = None if isinstance(dsl_result, Exception) else dsl_result
+        if cached_dsl is not None and time_context is not speculative:
+            # 时间跨度变化可能落入另一档缓存，按最终时间窗口重新查找
+            dsl = lookup_cached_dsl(time_context)
+        elif dsl is not None and time_context is not speculative:
+            dsl, replaced = substitute_time_bounds(dsl, time_context.start.isoformat(), time_context.end.isoformat())
+            if not replaced:
+                dsl = None  # DSL中没有可替换的时间边界，按正确时间重新生成
+        dsl_cache_hit = dsl is not None and cached_dsl is not None
+        if dsl is None:
+            started = time.perf_counter()
+            dsl = await generate_pipeline_dsl(llm, request, time_context)
+            mark("generate_dsl", started)
+
+    # 直接传入已解析的DSL对象，不再经过JSON文本
+    started = time.perf_counter()
+    execution = await run_execute_query(DSLRequest(
+        dsl=dsl,
+        original_query=request.query,
+        timeout=request.timeout,
+        bypass_cache=request.bypass_cache,
+        caller=request.caller
+    ))
+    mark("execute", started)
+
+    answer = None
+    if request.analyze and execution.execution_success and execution.analysis_prompt:
+        started = time.perf_counter()
+        answer = await llm.complete(execution.analysis_prompt, "analysis", {"query": request.query})
+        mark("analysis", started)
+
+    return PipelineResponse(
+        original_query=request.query,
+        query_type=query_type,
+        time_range=time_context.time_range,
+        time_range_info=f"时间范围: {time_context.time_range} ({time_context.describe()})",
+        time_analysis=time_analysis,
+        dsl=dsl,
+        dsl_cache_hit=dsl_cache_hit,
+        execution=execution,
+        answer=answer,
+        stage_timings=timings
+    )
+
+
+@router.post("/pipeline", response_model=PipelineResponse)
+async def pipeline(request: PipelineRequest):
+    """API: 一次调用完成时间分析、DSL生成、查询执行和分析提示词生成"""
+    try:
+        return await run_pipeline(request, get_llm_client())
+    except ValueError as e:
+        ERRORS.labels("pipeline").inc()
+        raise HTTPException(status_code=422, detail=f"流水线执行失败: {str(e)}")
+    except Exception as e:
+        ERRORS.labels("pipeline").inc()
+        raise HTTPException(status_code=500, detail=f"流水线执行失败: {str(e)}")
+
+
+@router.post("/clean-dsl", response_model=CleanResponse)
 async def clean_dsl(request: MarkdownRequest):
     """API 3: 清理LLM返回的Markdown格式，提取纯JSON"""
     try:
-        cleaned_dsl = extract_json_from_markdown(request.content)
+        with observe_stage("extract_json"):
+            cleaned_dsl, repairs = extract_json_with_repairs(request.content)
 
         return CleanResponse(
             cleaned_dsl=cleaned_dsl,
-            original_content=request.content
+            original_content=request.content,
+            repairs=repairs
         )
 
     except Exception as e:
+        ERRORS.labels("parse").inc()
         raise HTTPException(status_code=400, detail=f"JSON提取失败: {str(e)}")
 
 
-@app.get("/health")
+@router.get("/health")
 async def health_check():
     """健康检查"""
     try:
         # 检查ES连接
-        es_info = es_client.info()
+        es_info = await es_client.info()
         return {
             "status": "healthy",
             "elasticsearch": "connected",
             "es_version": es_info.get("version", {}).get("number", "unknown"),
-            "cluster_name": es_info.get("cluster_name", "unknown")
+            "cluster_name": es_info.get("cluster_name", "unknown"),
+            "startup": startup_timings
         }
     except Exception as e:
         return {
             "status": "unhealthy",
             "elasticsearch": "disconnected",
-            "error": str(e)
+            "error": str(e),
+            "startup": startup_timings
         }
 
 
-@app.get("/debug/indices")
-async def debug_indices():
-    """调试：查看可用的索引"""
+@router.get("/metrics")
+async def metrics():
+    """Prometheus指标；设置了PROMETHEUS_MULTIPROC_DIR时汇总所有worker进程的指标"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@router.get("/prompt-templates")
+async def list_prompt_templates():
+    """查看已加载的提示词模板及版本"""
+    return {
+        "default_version": DEFAULT_PROMPT_VERSION,
+        "templates": {
+            name: {
+                version: {"variables": sorted(set(t.variables)), "static_size": t.static_size}
+                for version, t in versions.items()
+            }
+            for name, versions in PROMPT_TEMPLATES.items()
+        }
+    }
+
+
+@router.get("/cache/stats")
+async def cache_stats():
+    """查询结果缓存统计"""
+    return {
+        "enabled": RESULT_CACHE_ENABLED,
+        **result_cache.get_stats(),
+        "dsl_cache": {"enabled": DSL_CACHE_ENABLED, **dsl_memo.get_stats()},
+        "singleflight": {"enabled": SINGLEFLIGHT_ENABLED, **es_singleflight.get_stats()},
+        "time_cache": {
+            "timezones": resolve_timezone.cache_info()._asdict(),
+            "time_expressions": parse_time_expression.cache_info()._asdict()
+        }
+    }
+
+
+@router.delete("/cache")
+async def clear_cache():
+    """清空查询结果缓存和查询→DSL缓存"""
+    await result_cache.clear()
+    dsl_memo.clear()
+    return {"status": "cleared"}
+
+
+@router.get("/debug/indices")
+async def debug_indices(live: bool = False):
+    """调试：查看可用的索引（默认读取后台刷新的索引目录，live=true或目录未加载时直接查询ES）"""
+    if not live and index_catalog.refreshed_at is not None:
+        return index_catalog.describe()
     try:
         # 获取所有索引
-        indices = es_client.cat.indices(format="json")
+        indices = (await es_client.cat.indices(format="json")).body
 
         # 过滤APM相关索引
         apm_indices = [idx for idx in indices if 'apm' in idx.get('index', '').lower()]
@@ -957,9 +4755,11 @@ async def debug_indices():
         return {"error": f"获取索引失败: {str(e)}"}
 
 
-@app.get("/debug/mappings")
-async def debug_mappings():
-    """调试：查看APM索引的字段映射"""
+@router.get("/debug/mappings")
+async def debug_mappings(live: bool = False, prefix: str = ""):
+    """调试：查看APM索引的字段映射（默认返回后台刷新的扁平化字段表，可按前缀过滤；live=true或未加载时直接查询ES）"""
+    if not live and field_index_map.has_mappings:
+        return field_index_map.describe(prefix)
     try:
         # 尝试获取APM索引的映射
         patterns = ["apm-*-transaction-*", "apm-*-error-*", "apm-*"]
@@ -967,8 +4767,8 @@ async def debug_mappings():
 
         for pattern in patterns:
             try:
-                mapping = es_client.indices.get_mapping(index=pattern, ignore_unavailable=True)
-                results[pattern] = mapping
+                mapping = await es_client.indices.get_mapping(index=pattern, ignore_unavailable=True)
+                results[pattern] = es_response_to_dict(mapping)
             except Exception as e:
                 results[pattern] = f"错误: {str(e)}"
 
@@ -977,7 +4777,25 @@ async def debug_mappings():
         return {"error": f"获取映射失败: {str(e)}"}
 
 
-@app.post("/debug/simple-query")
+@router.get("/debug/top-values")
+async def debug_top_values(query: str = ""):
+    """调试：查看字段常见取值采样，传入query时返回将注入提示词的片段"""
+    return {
+        "refreshed_at": datetime.utcfromtimestamp(top_values_cache.refreshed_at).isoformat()
+        if top_values_cache.refreshed_at else None,
+        "values": {field: [{"value": v, "doc_count": c} for v, c in buckets]
+                   for field, buckets in top_values_cache.values.items()},
+        "prompt_context": top_values_cache.build_prompt_context(query) if query else None
+    }
+
+
+@router.get("/debug/es-recordings")
+async def debug_es_recordings():
+    """调试：查看ES录制/回放状态和最近的录制"""
+    return {"mode": ES_RECORD_MODE, "replay_latency": ES_REPLAY_LATENCY, **es_record_store.describe()}
+
+
+@router.post("/debug/simple-query")
 async def debug_simple_query():
     """调试：执行最简单的查询"""
     try:
@@ -992,19 +4810,14 @@ async def debug_simple_query():
 
         for pattern in patterns:
             try:
-                response = es_client.search(
+                response = await es_client.search(
                     index=pattern,
                     body=simple_query,
                     ignore_unavailable=True,
                     allow_no_indices=True
                 )
 
-                if hasattr(response, 'body'):
-                    results[pattern] = response.body
-                elif hasattr(response, 'to_dict'):
-                    results[pattern] = response.to_dict()
-                else:
-                    results[pattern] = dict(response) if isinstance(response, dict) else str(response)
+                results[pattern] = es_response_to_dict(response)
 
             except Exception as e:
                 results[pattern] = f"错误: {str(e)}"
@@ -1014,7 +4827,77 @@ async def debug_simple_query():
         return {"error": f"简单查询失败: {str(e)}"}
 
 
+# 启动耗时：模块导入、应用启动，以及各缓存首次加载(预热)的耗时
+STARTUP_SECONDS = Gauge("text2dsl_startup_seconds", "启动各阶段耗时", ["phase"], multiprocess_mode="max")
+startup_timings: Dict[str, float] = {}
+
+
+def record_startup_phase(phase: str, seconds: float):
+    startup_timings[phase] = round(seconds, 4)
+    STARTUP_SECONDS.labels(phase).set(seconds)
+
+
+async def cache_refresh_loop(name: str, refresh, interval: int):
+    """后台定期刷新缓存；第一次刷新即预热，记录预热耗时"""
+    start = time.perf_counter()
+    await refresh()
+    record_startup_phase(f"warm_{name}", time.perf_counter() - start)
+    while True:
+        await asyncio.sleep(interval)
+        await refresh()
+
+
+def start_background_refresh() -> List[asyncio.Task]:
+    """后台加载字段归属、索引目录和字段取值采样，不阻塞启动"""
+    loops = (
+        ("field_index_map", refresh_field_index_map, FIELD_INDEX_MAP_REFRESH_INTERVAL),
+        ("index_catalog", refresh_index_catalog, INDEX_CATALOG_REFRESH_INTERVAL),
+        ("top_values", refresh_top_values, TOP_VALUES_REFRESH_INTERVAL),
+    )
+    return [asyncio.create_task(cache_refresh_loop(name, refresh, interval))
+            for name, refresh, interval in loops if interval > 0]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动时加载模板目录并在后台预热缓存，关闭时停止后台任务、关闭LLM和ES连接"""
+    start = time.perf_counter()
+    # 内置模板注册完成后再加载目录中的模板，允许覆盖内置版本；在服务请求前完成，保证模板版本一致
+    await asyncio.to_thread(load_prompt_templates_from_dir, PROMPT_TEMPLATE_DIR)
+    tasks = start_background_refresh()
+    record_startup_phase("startup", time.perf_counter() - start)
+    log_event(logging.INFO, "app_started", pid=os.getpid(), **startup_timings)
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if _llm_client is not None:
+            await _llm_client.close()
+        await es_client.close()
+
+
+def create_app() -> FastAPI:
+    """应用工厂：`uvicorn --factory main:create_app` 或 `gunicorn "main:create_app()"` 在每个worker中创建应用"""
+    app = FastAPI(title="APM Text2DSL API", version="1.0.0", lifespan=lifespan)
+    app.middleware("http")(request_context_middleware)
+    app.include_router(router)
+    return app
+
+
+def __getattr__(name: str) -> Any:
+    """兼容 `uvicorn main:app`：首次访问main.app时才创建应用"""
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+record_startup_phase("import", time.perf_counter() - IMPORT_STARTED)
+
+
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(create_app(), host="0.0.0.0", port=8000)
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# 测试不连接ES/LLM，也不启动后台刷新；必须在导入main之前设置
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("LLM_PROVIDER", "stub")
+os.environ.setdefault("ES_HOST", "http://127.0.0.1:9")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,16 @@
+import main
+
+
+def test_create_app_does_not_create_pooled_clients():
+    # gunicorn --preload 在fork前调用create_app()，此时不能创建ES/LLM连接池
+    app = main.create_app()
+    assert not main.es_client.created
+    assert main._llm_client is None
+    assert any(getattr(route, "path", None) == "/execute-query" for route in app.routes)
+
+
+def test_es_client_is_created_on_first_use():
+    client = main.LazyESClient(lambda: object())
+    assert not client.created
+    client.get()
+    assert client.created
@@ -0,0 +1,86 @@
+import asyncio
+
+import main
+
+
+class MsearchES:
+    def options(self, **_):
+        return self
+
+    async def msearch(self, searches, **_):
+        return {"responses": [{"took": 1, "hits": {"total": {"value": 1}, "hits": []}, "status": 200}
+                              for _ in searches[1::2]]}
+
+
+def test_batch_results_include_validation_warnings(monkeypatch):
+    monkeypatch.setattr(main, "es_client", MsearchES())
+    monkeypatch.setattr(main, "SCHEMA_VALIDATION_MODE", "warn")
+    dsl = {"size": 20000, "query": {"range": {"@timestamp": {"gte": "now-15m", "lte": "now"}}}}
+    request = main.BatchDSLRequest(queries=[main.DSLRequest(dsl=dsl, original_query="最近的请求")], bypass_cache=True)
+
+    response = asyncio.run(main.execute_queries(request))
+
+    result = response.results[0]
+    assert result.execution_success
+    assert [issue["code"] for issue in result.validation_issues] == ["result_window_too_large"]
+    assert result.validation_issues[0]["level"] == "warning"
+
+
+class CapturingMsearchES:
+    """记录每次_msearch的请求；original_query含“拒绝”的项返回400"""
+
+    def __init__(self):
+        self.calls = []
+
+    def options(self, **_):
+        return self
+
+    async def msearch(self, searches, **_):
+        self.calls.append(searches)
+        return {"responses": [
+            {"status": 400, "error": {"type": "parsing_exception", "reason": "bad query"}} if body.get("size") == 7
+            else {"took": 1, "hits": {"total": {"value": 3}, "hits": [{"_id": "1"}]}, "status": 200}
+            for body in searches[1::2]
+        ]}
+
+
+def batch_item(query, size=0, **options):
+    dsl = {"size": size, "query": {"range": {"@timestamp": {"gte": "2025-06-16T03:00:00+00:00",
+                                                            "lte": "2025-06-16T04:00:00+00:00"}}},
+           "aggs": {"services": {"terms": {"field": "service.name", "size": 5}}}}
+    return main.DSLRequest(dsl=dsl, original_query=query, **options)
+
+
+def test_batch_honours_per_item_timeout_and_bypass_cache(monkeypatch):
+    es = CapturingMsearchES()
+    monkeypatch.setattr(main, "es_client", es)
+    monkeypatch.setattr(main, "RESULT_CACHE_ENABLED", True)
+    asyncio.run(main.result_cache.clear())
+    first = [batch_item("每个服务的请求数"), batch_item("每个服务的错误数", size=1)]
+    asyncio.run(main.execute_queries(main.BatchDSLRequest(queries=first, timeout=2)))
+
+    second = [batch_item("每个服务的请求数", timeout=0.5, bypass_cache=True), batch_item("每个服务的错误数", size=1)]
+    response = asyncio.run(main.execute_queries(main.BatchDSLRequest(queries=second, timeout=2)))
+
+    assert [item["timeout"] for item in es.calls[0][1::2]] == ["2000ms", "2000ms"]
+    # 第二次只有设置了bypass_cache的项发往ES，并使用自己的超时
+    assert len(es.calls) == 2
+    assert [item["timeout"] for item in es.calls[1][1::2]] == ["500ms"]
+    assert [r.cache_hit for r in response.results] == [False, True]
+
+
+def test_batch_keeps_dsl_memo_in_sync(monkeypatch):
+    monkeypatch.setattr(main, "es_client", CapturingMsearchES())
+    monkeypatch.setattr(main, "DSL_CACHE_ENABLED", True)
+    main.dsl_memo.clear()
+    rejected = batch_item("被拒绝的查询", size=7, bypass_cache=True)
+    main.dsl_memo.record_success(rejected.original_query, rejected.dsl)
+    context = main.TimeContext("1h", "UTC", now=main.parse_iso_time("2025-06-16T04:00:00+00:00"))
+    assert main.dsl_memo.lookup("被拒绝的查询", context) is not None
+    request = main.BatchDSLRequest(queries=[batch_item("每个服务的请求数", bypass_cache=True), rejected])
+
+    response = asyncio.run(main.execute_queries(request))
+
+    assert [r.execution_success for r in response.results] == [True, False]
+    assert main.dsl_memo.lookup("每个服务的请求数", context) is not None
+    assert main.dsl_memo.lookup("被拒绝的查询", context) is None
@@ -0,0 +1,13 @@
+import pytest
+
+import main
+
+
+def test_cache_backend_requires_all_methods():
+    class GetOnlyBackend(main.CacheBackend):
+        async def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnlyBackend()
+    assert isinstance(main.MemoryCacheBackend(), main.CacheBackend)
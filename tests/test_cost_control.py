@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+import main
+
+WEEK = {"range": {"@timestamp": {"gte": "2025-06-10T00:00:00Z", "lte": "2025-06-17T00:00:00Z"}}}
+HOUR = {"range": {"@timestamp": {"gte": "2025-06-16T03:00:00Z", "lte": "2025-06-16T04:00:00Z"}}}
+
+
+def timeline_dsl(time_filter, interval, terms_size):
+    return {
+        "size": 0,
+        "query": {"bool": {"filter": [time_filter]}},
+        "aggs": {"timeline": {"date_histogram": {"field": "@timestamp", "fixed_interval": interval},
+                              "aggs": {"services": {"terms": {"field": "service.name", "size": terms_size}}}}}
+    }
+
+
+def test_estimate_multiplies_nested_bucket_counts():
+    estimate = main.estimate_query_cost(timeline_dsl(HOUR, "1m", 10))
+    assert estimate["time_span_seconds"] == 3600
+    assert estimate["estimated_buckets"] == 60 + 60 * 10
+    assert estimate["cost"] == 660
+
+
+def test_expensive_clauses_add_penalties():
+    dsl = {"size": 0, "query": {"bool": {"filter": [HOUR, {"wildcard": {"url.path": "*login"}}]}}}
+    estimate = main.estimate_query_cost(dsl)
+    assert estimate["cost"] == main.COST_PENALTIES["leading_wildcard"]
+    assert estimate["factors"] == ["查询使用前导通配符: *login"]
+
+
+def test_cheap_query_is_accepted_unchanged():
+    dsl = timeline_dsl(HOUR, "1m", 10)
+    admitted, estimate = main.admit_query(dsl)
+    assert admitted is dsl
+    assert estimate["decision"] == "accept"
+
+
+def test_expensive_query_is_downgraded():
+    dsl = timeline_dsl(WEEK, "1m", 100)
+    admitted, estimate = main.admit_query(dsl)
+    assert estimate["decision"] == "downgrade"
+    assert estimate["original_cost"] > estimate["hard_limit"]
+    assert estimate["cost"] <= estimate["budget"]
+    timeline = admitted["aggs"]["timeline"]
+    assert timeline["date_histogram"]["fixed_interval"] == "84m"
+    assert timeline["aggs"]["services"]["terms"]["size"] == main.COST_DOWNGRADE_TERMS_SIZE
+    # 原DSL不被修改
+    assert dsl["aggs"]["timeline"]["date_histogram"]["fixed_interval"] == "1m"
+
+
+@pytest.mark.parametrize("budget, decision", [(100, "queue"), (10, "reject")])
+def test_over_budget_query_is_queued_or_rejected(monkeypatch, budget, decision):
+    monkeypatch.setattr(main, "COST_DEFAULT_BUDGET", budget)
+    _, estimate = main.admit_query(timeline_dsl(HOUR, "1m", 10))
+    assert estimate["decision"] == decision
+    assert "downgrades" not in estimate
+
+
+def test_caller_budget_overrides_default(monkeypatch):
+    monkeypatch.setattr(main, "COST_DEFAULT_BUDGET", 10)
+    monkeypatch.setattr(main, "COST_BUDGETS", {"dashboard": 1000})
+    _, estimate = main.admit_query(timeline_dsl(HOUR, "1m", 10), caller="dashboard")
+    assert (estimate["decision"], estimate["budget"]) == ("accept", 1000)
+
+
+@pytest.mark.parametrize("size, buckets", [("20", 20), ("5.0", 5), (None, 10), ("10 buckets", 10)])
+def test_non_integer_sizes_do_not_break_estimation(size, buckets):
+    dsl = timeline_dsl(HOUR, "1m", size)
+    admitted, estimate = main.admit_query(dsl)
+    assert estimate["estimated_buckets"] == 60 + 60 * buckets
+    assert admitted["aggs"]["timeline"]["aggs"]["services"]["terms"]["size"] == size
+
+
+def test_rejected_query_with_string_size_fails_cleanly(monkeypatch):
+    monkeypatch.setattr(main, "COST_DEFAULT_BUDGET", 10)
+    response = asyncio.run(main.run_execute_query(main.DSLRequest(dsl=timeline_dsl(HOUR, "1m", "10 buckets"),
+                                                                  original_query="每分钟各服务请求数")))
+    assert response.execution_success is False
+    assert response.cost_estimate["decision"] == "reject"
+    assert response.error_message.startswith("查询成本过高")
@@ -0,0 +1,59 @@
+import asyncio
+
+from elastic_transport import ApiResponseMeta, HttpHeaders, NodeConfig
+from elasticsearch import BadRequestError
+
+import main
+
+QUERY = "最近一小时哪个服务最慢"
+DSL = {
+    "size": 0,
+    "query": {"bool": {"filter": [{"range": {"@timestamp": {"gte": "2025-06-16T03:00:00+00:00",
+                                                            "lte": "2025-06-16T04:00:00+00:00"}}}]}},
+    "aggs": {"services": {"terms": {"field": "service.name", "size": 10}}}
+}
+
+
+class RejectingES:
+    """search总是返回400的ES替身"""
+
+    def options(self, **_):
+        return self
+
+    async def search(self, **_):
+        meta = ApiResponseMeta(status=400, http_version="1.1", headers=HttpHeaders(), duration=0.0,
+                               node=NodeConfig("http", "localhost", 9200))
+        raise BadRequestError("search_phase_execution_exception", meta, {"error": {"type": "parsing_exception"}})
+
+
+def test_es_rejection_invalidates_memoized_dsl(monkeypatch):
+    main.dsl_memo.clear()
+    main.dsl_memo.record_success(QUERY, DSL)
+    invalidations = main.dsl_memo.stats["invalidations"]
+    monkeypatch.setattr(main, "es_client", RejectingES())
+
+    response = asyncio.run(main.run_execute_query(main.DSLRequest(dsl=DSL, original_query=QUERY, bypass_cache=True)))
+
+    assert response.execution_success is False
+    assert response.error_message.startswith("ES查询执行失败")
+    assert main.dsl_memo.stats["invalidations"] == invalidations + 1
+    assert len(main.dsl_memo.entries) == 0
+
+
+def test_execute_es_query_keeps_status_code(monkeypatch):
+    monkeypatch.setattr(main, "es_client", RejectingES())
+    try:
+        asyncio.run(main.execute_es_query(DSL))
+    except main.ESQueryError as e:
+        assert e.status_code == 400
+        assert main.is_query_rejected_error(e)
+    else:
+        raise AssertionError("应抛出ESQueryError")
+
+
+def test_compare_is_part_of_recorded_key():
+    main.dsl_memo.clear()
+    main.dsl_memo.record_success(QUERY, DSL, compare="day_ago")
+    context = main.TimeContext("1h", "UTC", compare="day_ago", now=main.parse_iso_time("2025-06-16T04:00:00+00:00"))
+    assert main.dsl_memo.lookup(QUERY, context) is not None
+    assert main.dsl_memo.lookup(QUERY, main.TimeContext("1h", "UTC", now=context.now)) is None
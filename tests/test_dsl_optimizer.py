@@ -0,0 +1,150 @@
+import copy
+import itertools
+
+import main
+
+DOCS = [
+    {"service.name": service, "event.outcome": outcome, "http.response.status_code": status,
+     "transaction.duration.us": duration, **({"error.id": "e"} if outcome == "failure" else {})}
+    for service, outcome, status, duration in itertools.product(
+        ["order", "user", "payment"], ["success", "failure"], [200, 404, 500], [1000, 500000, 3000000])
+]
+
+
+def matches(query, doc):
+    """在内存中按ES语义求值查询的匹配结果(只覆盖测试用到的子句)"""
+    if not query:
+        return True
+    (clause_type, body), = query.items()
+    if clause_type == "match_all":
+        return True
+    if clause_type == "term":
+        (field, value), = body.items()
+        value = value["value"] if isinstance(value, dict) else value
+        return doc.get(field) == value
+    if clause_type == "terms":
+        (field, values), = body.items()
+        return doc.get(field) in values
+    if clause_type == "exists":
+        return doc.get(body["field"]) is not None
+    if clause_type == "range":
+        (field, bounds), = body.items()
+        value = doc.get(field)
+        return value is not None and all(
+            {"gte": value >= bound, "gt": value > bound, "lte": value <= bound, "lt": value < bound}[op]
+            for op, bound in bounds.items())
+    if clause_type == "bool":
+        def clauses(occur):
+            value = body.get(occur, [])
+            return value if isinstance(value, list) else [value]
+        required = clauses("must") + clauses("filter")
+        should = clauses("should")
+        minimum = body.get("minimum_should_match", 0 if required else min(1, len(should)))
+        return (all(matches(c, doc) for c in required)
+                and not any(matches(c, doc) for c in clauses("must_not"))
+                and sum(matches(c, doc) for c in should) >= minimum)
+    raise AssertionError(f"测试求值器不支持 {clause_type}")
+
+
+def matched_docs(dsl):
+    return [i for i, doc in enumerate(DOCS) if matches(dsl.get("query"), doc)]
+
+
+def assert_same_matches(dsl):
+    optimized, rewrites = main.optimize_dsl(dsl)
+    assert matched_docs(optimized) == matched_docs(dsl)
+    assert matched_docs(dsl), "查询应至少匹配一条文档"
+    return optimized, rewrites
+
+
+SERVICES_AGG = {"services": {"terms": {"field": "service.name", "size": 10}}}
+
+
+def test_must_clauses_move_to_filter_for_aggregations():
+    dsl = {"size": 0, "aggs": SERVICES_AGG, "query": {"bool": {
+        "must": [{"term": {"service.name": "order"}}, {"range": {"transaction.duration.us": {"gte": 500000}}}],
+        "must_not": {"term": {"http.response.status_code": 404}}}}}
+    optimized, rewrites = assert_same_matches(dsl)
+    bool_clause = optimized["query"]["bool"]
+    assert "must" not in bool_clause
+    assert bool_clause["filter"] == dsl["query"]["bool"]["must"]
+    assert bool_clause["must_not"] == dsl["query"]["bool"]["must_not"]
+    assert "query: 2个must子句移到filter上下文" in rewrites
+
+
+def test_should_semantics_kept_when_must_moves():
+    # 有must时should是可选的，移到filter后同样可选
+    dsl = {"size": 0, "aggs": SERVICES_AGG, "query": {"bool": {
+        "must": {"term": {"event.outcome": "failure"}},
+        "should": [{"term": {"service.name": "order"}}, {"term": {"service.name": "user"}}]}}}
+    assert_same_matches(dsl)
+    # 只有should时至少匹配一个；嵌套bool的must也移到filter
+    nested = {"size": 0, "aggs": SERVICES_AGG, "query": {"bool": {"should": [
+        {"bool": {"must": [{"term": {"service.name": "order"}}, {"exists": {"field": "error.id"}}]}},
+        {"bool": {"must": {"term": {"http.response.status_code": 500}}, "should": {"term": {"service.name": "user"}}}}
+    ]}}}
+    optimized, _ = assert_same_matches(nested)
+    assert all("must" not in clause["bool"] for clause in optimized["query"]["bool"]["should"])
+
+    explicit = {"size": 0, "aggs": SERVICES_AGG, "query": {"bool": {
+        "must": {"term": {"event.outcome": "success"}}, "minimum_should_match": 1,
+        "should": [{"term": {"service.name": "payment"}}, {"range": {"http.response.status_code": {"gte": 500}}}]}}}
+    assert_same_matches(explicit)
+
+
+def test_single_non_scoring_clause_is_wrapped_in_filter():
+    dsl = {"size": 5, "sort": [{"transaction.duration.us": "desc"}],
+           "query": {"terms": {"http.response.status_code": [404, 500]}}}
+    optimized, rewrites = assert_same_matches(dsl)
+    assert optimized["query"] == {"bool": {"filter": [dsl["query"]]}}
+    assert optimized["sort"] == dsl["sort"]
+    assert rewrites == ["query: terms 包装为 bool.filter"]
+
+
+def test_aggregation_only_sets_size_and_disables_total():
+    dsl = {"aggs": SERVICES_AGG, "query": {"term": {"service.name": "order"}}, "track_total_hits": True}
+    optimized, rewrites = assert_same_matches(dsl)
+    assert optimized["size"] == 0
+    assert optimized["track_total_hits"] is False
+    assert optimized["aggs"] == SERVICES_AGG
+    assert rewrites[:2] == ["只有聚合：设置 size=0", "只有聚合：track_total_hits true → false"]
+
+
+def test_document_query_caps_total_hits():
+    dsl = {"size": 20, "track_total_hits": True, "sort": [{"@timestamp": "desc"}],
+           "query": {"bool": {"filter": [{"term": {"event.outcome": "failure"}}]}}}
+    optimized, rewrites = assert_same_matches(dsl)
+    assert optimized["track_total_hits"] == main.OPTIMIZER_TRACK_TOTAL_HITS
+    assert optimized["size"] == 20
+    assert optimized["query"] == dsl["query"]
+    assert rewrites == [f"track_total_hits true → {main.OPTIMIZER_TRACK_TOTAL_HITS}"]
+
+
+def test_scoring_query_is_left_alone():
+    dsl = {"size": 10, "query": {"bool": {"must": [{"term": {"service.name": "order"}}],
+                                          "should": [{"term": {"event.outcome": "failure"}}]}}}
+    original = copy.deepcopy(dsl)
+    optimized, rewrites = main.optimize_dsl(dsl)
+    assert optimized == original
+    assert rewrites == []
+    assert dsl == original  # 不修改传入的DSL
+
+
+def test_already_optimal_aggregation_is_unchanged():
+    dsl = {"size": 0, "track_total_hits": False, "aggs": SERVICES_AGG,
+           "query": {"bool": {"filter": [{"term": {"service.name": "order"}}]}}}
+    optimized, rewrites = main.optimize_dsl(dsl)
+    assert optimized == dsl
+    assert rewrites == []
+
+
+def test_aggregation_sizes_are_capped():
+    dsl = {"size": 0, "track_total_hits": False, "aggs": {"services": {
+        "terms": {"field": "service.name", "size": 5000, "shard_size": 10000},
+        "aggs": {"latest": {"top_hits": {"size": 50}}}}}}
+    optimized, _ = main.optimize_dsl(dsl)
+    services = optimized["aggs"]["services"]
+    assert services["terms"]["size"] == main.OPTIMIZER_MAX_TERMS_SIZE
+    assert services["terms"]["shard_size"] == main.OPTIMIZER_MAX_TERMS_SIZE * 2
+    assert services["aggs"]["latest"]["top_hits"]["size"] == main.OPTIMIZER_MAX_TOP_HITS_SIZE
+    assert services["aggs"]["latest"]["top_hits"]["_source"] == main.OPTIMIZER_TOP_HITS_SOURCE
@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+import main
+
+HOUR_MS = 3600 * 1000
+DSL = {
+    "size": 0,
+    "query": {"bool": {"filter": [{"range": {"@timestamp": {"gte": "now-15m", "lte": "now"}}}]}},
+    "aggs": {"services": {"terms": {"field": "transaction.duration.us", "size": 10}}}
+}
+
+
+class FakeES:
+    def options(self, **_):
+        return self
+
+    async def search(self, **_):
+        return {"took": 3, "timed_out": False, "hits": {"total": {"value": 7}, "hits": []}}
+
+    async def msearch(self, searches):
+        return {"responses": [{"took": 3, "status": 200, "hits": {"total": {"value": 7}, "hits": []}}
+                              for _ in searches[::2]]}
+
+
+def load_catalog(indices):
+    now_ms = int(time.time() * 1000)
+    catalog = main.IndexCatalog()
+    catalog.load(indices, {name: (now_ms - (i + 1) * HOUR_MS, now_ms - 60 * 1000)
+                           for i, name in enumerate(reversed(indices))})
+    return catalog
+
+
+def test_recorded_query_replays_after_index_rollover(monkeypatch, tmp_path):
+    store = main.ESRecordStore(str(tmp_path / "recordings.jsonl.gz"))
+    monkeypatch.setattr(main, "es_client", main.RecordingESClient(FakeES(), store, "record"))
+    monkeypatch.setattr(main, "index_catalog", load_catalog(["apm-7.17.0-transaction-000001"]))
+    recorded = asyncio.run(main.execute_es_query(DSL))
+    recorded_batch = asyncio.run(main.execute_es_msearch([DSL], timeout=5))
+    recorded_index = list(store.entries.values())[0]["params"]["index"]
+
+    # 录制之后发生滚动，目录刷新，裁剪出的具体索引不同
+    catalog = load_catalog(["apm-7.17.0-transaction-000001", "apm-7.17.0-transaction-000002"])
+    monkeypatch.setattr(main, "index_catalog", catalog)
+    assert main.resolve_target_indices(DSL) != recorded_index
+
+    replay_store = main.ESRecordStore(store.path)
+    assert replay_store.load() == 2
+    monkeypatch.setattr(main, "es_client", main.RecordingESClient(None, replay_store, "replay"))
+    assert asyncio.run(main.execute_es_query(DSL)) == recorded
+    assert asyncio.run(main.execute_es_msearch([DSL], timeout=9)) == recorded_batch
+    assert replay_store.stats == {"recorded": 0, "replayed": 2, "misses": 0}
+
+
+def test_unrelated_index_patterns_keep_separate_keys():
+    body = {"size": 1, "query": {"match_all": {}}}
+    keys = {main.es_call_fingerprint("search", {"index": pattern, "body": body})
+            for pattern in ["apm-*", "apm-*-transaction-*", "*"]}
+    assert len(keys) == 3
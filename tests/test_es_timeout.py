@@ -0,0 +1,37 @@
+import asyncio
+
+import main
+
+DSL = {"size": 0, "aggs": {"services": {"terms": {"field": "service.name", "size": 10}}}}
+
+
+class CapturingES:
+    """记录search/msearch参数的ES替身"""
+
+    def __init__(self):
+        self.requests = []
+
+    def options(self, **_):
+        return self
+
+    async def search(self, **kwargs):
+        self.requests.append(kwargs)
+        return {"took": 1, "timed_out": False, "hits": {"total": {"value": 0}, "hits": []}}
+
+    async def msearch(self, searches):
+        self.requests.append(searches)
+        return {"responses": [{"took": 1, "status": 200, "hits": {"hits": []}} for _ in searches[::2]]}
+
+
+def test_subsecond_timeout_is_sent_in_milliseconds(monkeypatch):
+    es = CapturingES()
+    monkeypatch.setattr(main, "es_client", es)
+    asyncio.run(main.execute_es_query(DSL, timeout=0.2))
+    asyncio.run(main.execute_es_msearch([DSL, DSL], timeout=0.75))
+    assert es.requests[0]["timeout"] == "200ms"
+    assert [item["timeout"] for item in es.requests[1][1::2]] == ["750ms", "750ms"]
+
+
+def test_default_timeout_in_milliseconds():
+    assert main.es_search_timeout(main.resolve_query_timeout(None)) == f"{int(main.ES_DEFAULT_QUERY_TIMEOUT * 1000)}ms"
+    assert main.es_search_timeout(0.0001) == "1ms"
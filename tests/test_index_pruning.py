@@ -0,0 +1,42 @@
+import fnmatch
+import time
+
+import main
+
+HOUR_MS = 3600 * 1000
+
+
+def load_catalog(aliases=None):
+    now_ms = int(time.time() * 1000)
+    catalog = main.IndexCatalog()
+    catalog.load(
+        ["apm-7.17.0-transaction-000001", "apm-7.17.0-transaction-000002"],
+        {"apm-7.17.0-transaction-000001": (now_ms - 48 * HOUR_MS, now_ms - 24 * HOUR_MS),
+         "apm-7.17.0-transaction-000002": (now_ms - 24 * HOUR_MS, now_ms - 60 * 1000)},
+        aliases=aliases
+    )
+    return catalog, now_ms
+
+
+def covers(targets, index_name):
+    return any(fnmatch.fnmatch(index_name, target) for target in targets)
+
+
+def test_recent_window_covers_index_created_after_load():
+    catalog, now_ms = load_catalog()
+    # 目录刷新后发生滚动，新索引不在目录中
+    targets = catalog.overlapping("transaction", now_ms - 15 * 60 * 1000, now_ms + 1000)
+    assert covers(targets, "apm-7.17.0-transaction-000003")
+    assert "apm-7.17.0-transaction-000001" not in targets
+
+
+def test_recent_window_uses_write_alias_when_available():
+    catalog, now_ms = load_catalog({"apm-transaction": ["apm-7.17.0-transaction-000002"]})
+    targets = catalog.overlapping("transaction", now_ms - 15 * 60 * 1000, now_ms + 1000)
+    assert targets == ["apm-7.17.0-transaction-000002", "apm-transaction"]
+
+
+def test_window_before_refresh_is_pruned_to_catalog():
+    catalog, now_ms = load_catalog()
+    targets = catalog.overlapping("transaction", now_ms - 40 * HOUR_MS, now_ms - 30 * HOUR_MS)
+    assert targets == ["apm-7.17.0-transaction-000001"]
@@ -0,0 +1,23 @@
+import main
+
+ERROR_ANALYSIS_DSL = {
+    "size": 0,
+    "query": {"bool": {"filter": [
+        {"range": {"@timestamp": {"gte": "now-1h", "lte": "now"}}},
+        {"term": {"event.outcome": "failure"}}
+    ]}},
+    "aggs": {"error_types": {"terms": {"field": "error.exception.type", "size": 10}}}
+}
+
+
+def test_error_analysis_dsl_routes_to_error_index():
+    assert main.determine_event_types(main.analyze_dsl(ERROR_ANALYSIS_DSL)) == ["error"]
+    assert main.determine_index_pattern(ERROR_ANALYSIS_DSL) == main.APM_SCHEMA["error_index"]
+
+
+def test_conflicting_fields_resolve_independently_of_field_order():
+    analysis = main.DSLAnalysis()
+    analysis.fields = {"transaction.duration.us", "error.exception.type"}
+    first = main.determine_event_types(analysis)
+    analysis.fields = set(reversed(sorted(analysis.fields)))
+    assert main.determine_event_types(analysis) == first
@@ -0,0 +1,13 @@
+import main
+
+
+def test_truncated_object_inside_code_fence_is_closed():
+    content = '```json\n{"size": 0, "aggs": {"svc": {"terms": {"field": "service.name"}}},\n```'
+    result, repairs = main.extract_json_with_repairs(content)
+    assert result == {"size": 0, "aggs": {"svc": {"terms": {"field": "service.name"}}}}
+    assert "补全被截断的JSON" in repairs
+
+
+def test_backtick_inside_string_is_kept():
+    result, _ = main.extract_json_with_repairs('```json\n{"message": "a`b"}\n```')
+    assert result == {"message": "a`b"}
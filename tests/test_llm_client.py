@@ -0,0 +1,23 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def test_llm_client_requires_complete():
+    class NamedOnlyClient(main.LLMClient):
+        name = "named-only"
+
+    with pytest.raises(TypeError):
+        NamedOnlyClient()
+
+
+def test_llm_client_close_defaults_to_noop():
+    class EchoClient(main.LLMClient):
+        async def complete(self, prompt, purpose, context=None):
+            return prompt
+
+    client = EchoClient()
+    assert asyncio.run(client.complete("ping", "dsl")) == "ping"
+    assert asyncio.run(client.close()) is None
@@ -0,0 +1,37 @@
+import os
+import runpy
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER = "import main; main.ERRORS.labels('parse').inc({n}); main.HTTP_IN_FLIGHT.labels('/x').inc(); print(main.os.getpid())"
+SCRAPE = "import asyncio, main; print(asyncio.run(main.metrics()).body.decode())"
+
+
+def run_python(code, env):
+    return subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, check=True,
+                          capture_output=True, text=True).stdout
+
+
+class FakeWorker:
+    def __init__(self, pid):
+        self.pid = pid
+
+
+def test_metrics_aggregate_all_worker_processes(tmp_path, monkeypatch):
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+    first_pid = int(run_python(WORKER.format(n=2), env))
+    run_python(WORKER.format(n=3), env)
+
+    output = run_python(SCRAPE, env)
+    assert 'text2dsl_errors_total{category="parse"} 5.0' in output
+    assert 'text2dsl_http_in_flight_requests{endpoint="/x"} 2.0' in output
+
+    # gunicorn的child_exit钩子标记退出的worker后，livesum的Gauge不再计入它，计数器保留
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    hooks = runpy.run_path(os.path.join(ROOT, "gunicorn.conf.py"))
+    hooks["child_exit"](None, FakeWorker(first_pid))
+    output = run_python(SCRAPE, env)
+    assert 'text2dsl_errors_total{category="parse"} 5.0' in output
+    assert 'text2dsl_http_in_flight_requests{endpoint="/x"} 1.0' in output
@@ -0,0 +1,61 @@
+import main
+
+
+def status_code_terms():
+    return {"aggregations": {"status_codes": {
+        "doc_count_error_upper_bound": 0,
+        "sum_other_doc_count": 0,
+        "buckets": [{"key": 200, "doc_count": 900}, {"key": 404, "doc_count": 50},
+                    {"key": 500, "doc_count": 30}, {"key": 302, "doc_count": 20}]
+    }}}
+
+
+def test_numeric_terms_buckets_are_truncated_not_merged():
+    reduced, report = main.reduce_es_results(status_code_terms(), max_buckets=2, max_points=2)
+    agg = reduced["aggregations"]["status_codes"]
+    assert agg["buckets"] == [{"key": 200, "doc_count": 900}, {"key": 404, "doc_count": 50}]
+    assert agg["sum_other_doc_count"] == 50
+    assert not any("直方图" in note for note in report["truncated"])
+
+
+def test_date_histogram_buckets_are_merged():
+    buckets = [{"key": 1718500000000 + i * 60000, "key_as_string": str(i), "doc_count": 10} for i in range(4)]
+    reduced, report = main.reduce_es_results({"aggregations": {"per_minute": {"buckets": buckets}}}, max_points=2)
+    merged = reduced["aggregations"]["per_minute"]["buckets"]
+    assert [b["doc_count"] for b in merged] == [20, 20]
+    assert any("直方图" in note for note in report["truncated"])
+
+
+def test_numeric_histogram_with_empty_buckets_dropped_is_merged():
+    buckets = [{"key": k, "doc_count": 1} for k in (0, 100, 300, 400)]
+    assert main.is_histogram_buckets(buckets)
+    assert not main.is_histogram_buckets([{"key": k, "doc_count": 1} for k in (200, 302, 404, 500)])
+
+
+def many_services(count=200):
+    buckets = [{"key": f"service-{i:03d}", "doc_count": 1000 - i, "avg_duration": {"value": 1234.5 + i}}
+               for i in range(count)]
+    return {"took": 12, "hits": {"total": {"value": 99999}, "hits": []},
+            "aggregations": {"services": {"buckets": buckets}}}
+
+
+def test_small_analysis_budget_is_enforced():
+    for budget in (1200, 2000, 4000):
+        prompt, report = main.generate_analysis_prompt("哪个服务最慢", many_services(), "performance",
+                                                       max_bytes=budget)
+        assert len(prompt.encode("utf-8")) <= budget
+        assert report["prompt_bytes"] <= budget
+        assert report["truncated"]
+
+
+def test_budget_without_room_for_results_omits_them():
+    template = main.get_prompt_template("analysis")
+    overhead = template.render(original_query="哪个服务最慢", took=12, total=99999, query_type="performance",
+                               results="", truncation_note=main.ANALYSIS_TRUNCATION_NOTE)
+    # 只比模板多出不足以放下截断标记的空间
+    budget = len(overhead.encode("utf-8")) + 10
+    prompt, report = main.generate_analysis_prompt("哪个服务最慢", many_services(), "performance", max_bytes=budget)
+    assert len(prompt.encode("utf-8")) <= budget
+    assert "service-000" not in prompt
+    assert report["result_bytes"] == 0
+    assert any("省略" in note for note in report["truncated"])
@@ -0,0 +1,64 @@
+import asyncio
+
+import main
+
+DSL = {
+    "size": 0,
+    "query": {"bool": {"filter": [{"range": {"@timestamp": {"gte": "2025-06-16T03:00:00+00:00",
+                                                            "lte": "2025-06-16T04:00:00+00:00"}}}]}},
+    "aggs": {"services": {"terms": {"field": "service.name", "size": 10}}}
+}
+
+
+class SlowES:
+    """search耗时固定的ES替身，记录实际发出的请求数"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.calls = 0
+
+    def options(self, **_):
+        return self
+
+    async def search(self, **_):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return {"took": 1, "timed_out": False, "hits": {"total": {"value": 1}, "hits": []}}
+
+
+def test_leader_is_not_limited_by_follower_wait_budget(monkeypatch):
+    es = SlowES(0.1)
+    monkeypatch.setattr(main, "es_client", es)
+    monkeypatch.setattr(main, "ES_CLIENT_TIMEOUT_MARGIN", 0)
+    monkeypatch.setattr(main, "ES_QUEUE_TIMEOUT", 1)
+
+    async def scenario():
+        # 并发槽位被占用0.4秒：查询先排队再执行，总耗时超过“查询超时 + 余量”
+        monkeypatch.setattr(main, "es_query_semaphore", asyncio.Semaphore(1))
+        await main.es_query_semaphore.acquire()
+        asyncio.get_running_loop().call_later(0.4, main.es_query_semaphore.release)
+        return await asyncio.gather(*[main.execute_es_query_cached(DSL, timeout=0.2, bypass_cache=True)
+                                      for _ in range(3)])
+
+    results = asyncio.run(scenario())
+    assert es.calls == 1
+    assert all(result["hits"]["total"]["value"] == 1 for result, _ in results)
+
+
+def test_follower_wait_timeout_has_message(monkeypatch):
+    es = SlowES(0.5)
+    monkeypatch.setattr(main, "es_client", es)
+    monkeypatch.setattr(main, "ES_CLIENT_TIMEOUT_MARGIN", 0)
+    monkeypatch.setattr(main, "ES_QUEUE_TIMEOUT", 0.1)
+
+    async def scenario():
+        leader = asyncio.ensure_future(main.execute_es_query_cached(DSL, timeout=0.1, bypass_cache=True))
+        await asyncio.sleep(0)
+        follower = main.execute_es_query_cached(DSL, timeout=0.1, bypass_cache=True)
+        return await asyncio.gather(leader, follower, return_exceptions=True)
+
+    leader_result, follower_error = asyncio.run(scenario())
+    assert es.calls == 1
+    assert leader_result[0]["timed_out"] is False
+    assert isinstance(follower_error, main.ESQueryError)
+    assert "等待进行中的相同查询超时" in str(follower_error)
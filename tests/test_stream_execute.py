@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+from fastapi import HTTPException
+
+import main
+
+
+def collect(request):
+    async def run():
+        return [frame async for frame in main.stream_execute_query(request)]
+    return asyncio.run(run())
+
+
+def test_stream_emits_error_frame_when_execution_raises(monkeypatch):
+    async def failing(_request):
+        raise HTTPException(status_code=500, detail="查询处理失败: boom")
+
+    monkeypatch.setattr(main, "execute_query_stage", failing)
+    request = main.DSLRequest(dsl={"size": 0}, original_query="x", stream="ndjson")
+
+    events = [json.loads(line) for line in collect(request)]
+
+    assert [e["event"] for e in events] == ["start", "error", "end"]
+    assert events[1]["status_code"] == 500
+    assert events[1]["error_message"] == "查询处理失败: boom"
+    assert events[2]["execution_success"] is False
+
+
+def test_sse_error_frame(monkeypatch):
+    async def failing(_request):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(main, "execute_query_stage", failing)
+    frames = collect(main.DSLRequest(dsl={"size": 0}, original_query="x", stream="sse"))
+    assert frames[1].startswith("event: error\ndata: ")
+
+
+class BucketES:
+    def options(self, **_):
+        return self
+
+    async def search(self, **_):
+        buckets = [{"key": f"service-{i}", "doc_count": 10 - i} for i in range(3)]
+        return {"took": 4, "timed_out": False, "hits": {"total": {"value": 27}, "hits": []},
+                "aggregations": {"services": {"buckets": buckets}}}
+
+
+def test_results_are_streamed_before_analysis_prompt_is_built(monkeypatch):
+    monkeypatch.setattr(main, "es_client", BucketES())
+    generate = main.generate_analysis_prompt
+    prompt_calls = []
+
+    def spy(*args, **kwargs):
+        prompt_calls.append(args)
+        return generate(*args, **kwargs)
+
+    monkeypatch.setattr(main, "generate_analysis_prompt", spy)
+    request = main.DSLRequest(dsl={"size": 0, "aggs": {"services": {"terms": {"field": "service.name"}}}},
+                              original_query="哪个服务请求最多", stream="ndjson", bypass_cache=True)
+
+    async def run():
+        events = []
+        async for frame in main.stream_execute_query(request):
+            event = json.loads(frame)
+            # 结果帧发出时还没有开始生成提示词
+            event["prompt_built"] = bool(prompt_calls)
+            events.append(event)
+        return events
+
+    events = asyncio.run(run())
+    names = [e["event"] for e in events]
+    assert names == ["start", "metadata", "aggregation", "bucket", "bucket", "bucket", "analysis_prompt", "end"]
+    assert not any(e["prompt_built"] for e in events if e["event"] in ("metadata", "aggregation", "bucket"))
+    assert events[1]["total"] == {"value": 27}
+    assert events[-2]["analysis_prompt"]
+    assert "truncation_report" in events[-2]
+    assert events[-1]["execution_success"] is True
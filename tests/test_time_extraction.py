@@ -0,0 +1,36 @@
+from datetime import datetime, timezone
+
+import main
+
+NOW = datetime(2025, 6, 16, 12, 0, tzinfo=timezone.utc)
+
+
+def test_relative_window_wins_over_calendar_day():
+    result = main.extract_time_range("今天最近30分钟的错误", now=NOW)
+    assert result["time_range"] == "30m"
+    assert result["start_time"] == "2025-06-16T11:30:00+00:00"
+
+
+def test_calendar_day_without_relative_window():
+    assert main.extract_time_range("今天的错误", now=NOW)["time_range"] == "today"
+
+
+def test_month_units():
+    assert main.extract_time_range("最近一个月的慢请求", now=NOW)["time_range"] == "30d"
+    assert main.extract_time_range("past 2 months", now=NOW)["time_range"] == "60d"
+    assert main.extract_time_range("过去半个月", now=NOW)["time_range"] == "15d"
+    assert main.extract_time_range("上个月", now=NOW)["time_range"] == "last_month"
+
+
+def test_compact_units():
+    cases = {"last 2h": "2h", "最近2h": "2h", "last 30m": "30m", "past 7d": "7d", "最近1w的错误": "1w",
+             "最近15min内": "15m", "2h内": "2h"}
+    for query, expected in cases.items():
+        result = main.extract_time_range(query, now=NOW)
+        assert (result["time_range"], result["confidence"]) == (expected, "high"), query
+
+
+def test_compact_units_need_relative_cue():
+    # 没有“最近/内”提示的紧凑写法多为大小或阈值
+    assert main.extract_time_range("内存超过512m", now=NOW)["time_range"] is None
+    assert main.extract_time_range("512m内存", now=NOW)["time_range"] is None
@@ -0,0 +1,31 @@
+import asyncio
+import re
+
+import main
+
+
+class RecordingES:
+    """记录search请求参数的ES替身"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def search(self, **kwargs):
+        self.requests.append(kwargs)
+        return {"aggregations": {"service.name": {"buckets": [{"key": "order-service", "doc_count": 42}]}}}
+
+
+def test_refresh_top_values_sends_integer_timeout(monkeypatch):
+    es = RecordingES()
+    monkeypatch.setattr(main, "es_client", es)
+    monkeypatch.setattr(main, "ES_DEFAULT_QUERY_TIMEOUT", 30.0)
+
+    asyncio.run(main.refresh_top_values())
+
+    assert len(es.requests) == 1
+    request = es.requests[0]
+    # ES不接受带小数的时间单位(如"30.0s")
+    assert re.fullmatch(r"\d+s", request["timeout"]), request["timeout"]
+    assert request["size"] == 0
+    assert set(request["aggs"]) == set(main.top_values_fields())
+    assert main.top_values_cache.values["service.name"] == [("order-service", 42)]